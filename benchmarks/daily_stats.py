@@ -0,0 +1,84 @@
+"""Замер скорости _increment_daily_event: синхронная запись против буфера.
+
+Запуск из корня репозитория:
+
+    python benchmarks/daily_stats.py --events 20000 --threads 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.chdir(BASE_DIR)
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+# Хранилища и статистика бота создаются при импорте — не в корне репозитория.
+_STATE_DIR = tempfile.TemporaryDirectory(prefix="taro-bench-")
+os.environ["STATE_DIR"] = _STATE_DIR.name
+
+import bot  # noqa: E402
+
+EVENTS = (
+    bot.DAILY_EVENT_START,
+    bot.DAILY_EVENT_SINGLE_CARD_BUTTON,
+    bot.DAILY_EVENT_SINGLE_CARD_READING,
+    bot.DAILY_EVENT_YES_NO_READING,
+)
+
+
+def _legacy_increment(event_name: str) -> None:
+    """Прежнее поведение: перезапись stats/<date>.json на каждое событие."""
+    today = datetime.now(timezone.utc).date().isoformat()
+
+    with bot._stats_lock:
+        stats = bot._daily_stats.setdefault(today, {})
+        stats[event_name] = stats.get(event_name, 0) + 1
+        bot._save_daily_stats(today, stats)
+
+
+def _run(increment, total: int, threads: int) -> float:
+    per_thread = total // threads
+
+    def worker() -> None:
+        for i in range(per_thread):
+            increment(EVENTS[i % len(EVENTS)])
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    bot._flush_daily_stats()
+    elapsed = time.perf_counter() - started
+
+    return per_thread * threads / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot.STATS_DIR = tmp_dir
+
+        bot._daily_stats.clear()
+        before = _run(_legacy_increment, args.events, args.threads)
+
+        bot._daily_stats.clear()
+        after = _run(bot._increment_daily_event, args.events, args.threads)
+
+    print(f"синхронная запись: {before:12.0f} событий/с")
+    print(f"буфер + сброс:     {after:12.0f} событий/с")
+    print(f"ускорение:         {after / before:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
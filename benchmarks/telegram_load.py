@@ -0,0 +1,476 @@
+"""Нагрузочный прогон бота против локальной заглушки Telegram Bot API.
+
+Бот запускается отдельным процессом в копии репозитория во временной папке и
+ходит не в api.telegram.org, а в заглушку, которая отдаёт синтетические
+апдейты через getUpdates и отвечает на sendMessage/sendPhoto/sendInvoice и
+прочие вызовы с заданной задержкой, долей ответов 429 и долей оборванных
+соединений (--drop-rate), как при сбросе keep-alive на стороне Telegram.
+
+Сценарии (каждый — новый пользователь): /start, одна карта, три карты,
+да/нет, две карты из web app, оплата консультации. Каждый шаг сценария
+отправляется через --think-ms после ответа бота на предыдущий (человек не
+успевает нажать кнопку раньше, чем бот запомнит следующий шаг диалога). Задержка шага — время от
+выдачи апдейта в getUpdates до первого ответа бота в этот чат.
+
+Запуск из корня репозитория:
+
+    python benchmarks/telegram_load.py --rate 50 --duration 30 --latency-ms 40 --rate-429 0.01
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.server
+from collections import Counter
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "0:benchmark"
+# Первый пользователь сценариев; у каждого сценария свой id, чтобы дневные
+# лимиты не обрывали расклады.
+FIRST_USER_ID = 10_000_000
+READING_SCENARIOS = {"one_card", "three_cards", "yes_no", "web_app"}
+SCENARIO_WEIGHTS = {
+    "start": 2,
+    "one_card": 4,
+    "three_cards": 2,
+    "yes_no": 2,
+    "web_app": 2,
+    "payment": 1,
+}
+# Ответ на эти методы пользователь видит в чате — по ним считаем задержку.
+REPLY_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendDocument",
+    "sendInvoice",
+    "sendMediaGroup",
+    "editMessageText",
+    "answerPreCheckoutQuery",
+}
+_CHAT_ID_RE = re.compile(rb'(?:chat_id|pre_checkout_query_id)(?:=|"\r\n\r\n)(-?\d+)')
+
+# Подставляет адрес заглушки в telebot и запускает bot.py как обычно.
+BOOTSTRAP = """
+import runpy, sys
+import telebot.apihelper
+telebot.apihelper.API_URL = sys.argv[1] + "/bot{0}/{1}"
+try:
+    import telebot.asyncio_helper
+    telebot.asyncio_helper.API_URL = sys.argv[1] + "/bot{0}/{1}"
+except ImportError:
+    pass
+runpy.run_path("bot.py", run_name="__main__")
+"""
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FakeTelegram:
+    """Состояние заглушки: очередь апдейтов и ожидающие ответа чаты."""
+
+    def __init__(self, latency: float, rate_429: float, drop_rate: float) -> None:
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self.updates: "queue.Queue[dict]" = queue.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        self.lock = threading.Lock()
+        # chat_id -> (время выдачи апдейта боту, колбэк «бот ответил»)
+        self.pending: dict[int, tuple[float | None, object]] = {}
+        self.calls: Counter[str] = Counter()
+        self.throttled: Counter[str] = Counter()
+        self.latencies: list[float] = []
+
+    def push(self, chat_id: int, update: dict, on_reply) -> None:
+        with self.lock:
+            self.update_id += 1
+            update["update_id"] = self.update_id
+            self.pending[chat_id] = (None, on_reply)
+        self.updates.put(update)
+
+    def take_updates(self, timeout: float) -> list[dict]:
+        batch = []
+        try:
+            batch.append(self.updates.get(timeout=timeout))
+            while len(batch) < 100:
+                batch.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+
+        now = time.perf_counter()
+        with self.lock:
+            for update in batch:
+                chat_id = _update_chat_id(update)
+                if chat_id in self.pending:
+                    self.pending[chat_id] = (now, self.pending[chat_id][1])
+        return batch
+
+    def reply_seen(self, chat_id: int) -> None:
+        with self.lock:
+            entry = self.pending.pop(chat_id, None)
+        if entry is None:
+            return
+
+        delivered_at, on_reply = entry
+        if delivered_at is not None:
+            self.latencies.append(time.perf_counter() - delivered_at)
+        on_reply()
+
+    def next_message(self, chat_id: int) -> dict:
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "photo": [
+                {
+                    "file_id": f"photo-{message_id}",
+                    "file_unique_id": f"u{message_id}",
+                    "width": 1,
+                    "height": 1,
+                }
+            ],
+        }
+
+
+def _update_chat_id(update: dict) -> int | None:
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    if "pre_checkout_query" in update:
+        return int(update["pre_checkout_query"]["id"])
+    return None
+
+
+def _make_handler(fake: FakeTelegram):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Заголовки и тело уходят отдельными пакетами — без этого Nagle и
+        # отложенный ACK добавляют к каждому вызову десятки миллисекунд.
+        disable_nagle_algorithm = True
+
+        def _respond(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self) -> None:
+            length = int(self.headers.get("Content-Length", "0") or 0)
+            raw = self.path.encode("utf-8") + b"\n" + (self.rfile.read(length) if length else b"")
+            method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+            fake.calls[method] += 1
+
+            if method == "getUpdates":
+                self._respond(200, {"ok": True, "result": fake.take_updates(timeout=1.0)})
+                return
+            if method == "getMe":
+                self._respond(
+                    200,
+                    {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}},
+                )
+                return
+
+            if fake.drop_rate and random.random() < fake.drop_rate:
+                # Рвём соединение, не ответив: клиент увидит сброс, как в nohup.out.
+                fake.dropped += 1
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+            time.sleep(fake.latency)
+            match = _CHAT_ID_RE.search(raw)
+            chat_id = int(match.group(1)) if match else None
+
+            if fake.rate_429 and random.random() < fake.rate_429:
+                fake.throttled[method] += 1
+                self._respond(
+                    429,
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    },
+                )
+                return
+
+            if method in ("sendMessage", "sendPhoto", "sendDocument", "sendInvoice", "editMessageText"):
+                result = fake.next_message(chat_id or 0)
+            else:
+                result = True
+            self._respond(200, {"ok": True, "result": result})
+
+            if chat_id is not None and method in REPLY_METHODS:
+                fake.reply_seen(chat_id)
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args) -> None:  # noqa: A002 - сигнатура http.server
+            pass
+
+    return Handler
+
+
+class _QuietServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # Клиент telebot рвёт keep-alive соединения при остановке — это не ошибка.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "language_code": "ru"}
+
+
+def _message(user_id: int, **fields) -> dict:
+    message = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+    }
+    message.update(fields)
+    return {"message": message}
+
+
+def _scenario_steps(kind: str, user_id: int, content) -> list[dict]:
+    topic = random.choice(content.topics)
+
+    if kind == "start":
+        return [_message(user_id, text="/start")]
+    if kind == "one_card":
+        return [_message(user_id, text="🃏 Одна карта"), _message(user_id, text=topic)]
+    if kind == "three_cards":
+        return [_message(user_id, text="🔮 Три карты"), _message(user_id, text=topic)]
+    if kind == "yes_no":
+        return [
+            _message(user_id, text=content.yes_no_label),
+            {
+                "callback_query": {
+                    "id": str(user_id),
+                    "from": _user(user_id),
+                    "chat_instance": "bench",
+                    "data": content.yes_no_callback,
+                    "message": {
+                        "message_id": 1,
+                        "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"},
+                    },
+                }
+            },
+        ]
+    if kind == "web_app":
+        card1, card2 = random.sample(content.deck, 2)
+        data = json.dumps({"card1": card1, "card2": card2}, ensure_ascii=False)
+        return [_message(user_id, web_app_data={"data": data, "button_text": "🃏🃏 Две карты"})]
+    if kind == "payment":
+        payment = {
+            "currency": "XTR",
+            "total_amount": content.price,
+            "invoice_payload": content.payload,
+        }
+        return [
+            {"pre_checkout_query": dict(payment, id=str(user_id), **{"from": _user(user_id)})},
+            _message(
+                user_id,
+                successful_payment=dict(
+                    payment,
+                    telegram_payment_charge_id=f"bench-{user_id}",
+                    provider_payment_charge_id=f"bench-{user_id}",
+                ),
+            ),
+        ]
+    raise ValueError(kind)
+
+
+class _Content:
+    """То немногое из bot.py, что нужно для сценариев: кнопки, темы и колода."""
+
+    def __init__(self, workdir: str) -> None:
+        sys.path.insert(0, workdir)
+        os.environ.setdefault("BOT_TOKEN", TOKEN)
+        import bot  # noqa: E402 - импортируется из копии во временной папке
+
+        self.topics = [title for row in bot._TOPIC_SELECTION_LAYOUT for title in row]
+        self.deck = list(bot._draw_tables.deck_cards)
+        self.yes_no_label = bot.YES_NO_BUTTON_LABEL
+        self.yes_no_callback = bot.YES_NO_CALLBACK_DRAW
+        self.payload = bot.CONSULTATION_PAYLOAD
+        self.price = bot.CONSULTATION_PRICE_UNITS
+
+
+def _prepare_workdir(workdir: str) -> None:
+    for entry in os.listdir(BASE_DIR):
+        source = os.path.join(BASE_DIR, entry)
+        if entry == "bot.py" or entry == "content.pickle" or (
+            entry.endswith(".json") and os.path.isfile(source)
+        ):
+            shutil.copy2(source, workdir)
+    # Картинки только читаются, поэтому копировать их незачем.
+    os.symlink(os.path.join(BASE_DIR, "images"), os.path.join(workdir, "images"))
+
+
+def _read_proc_io(pid: int) -> dict[str, int] | None:
+    try:
+        with open(f"/proc/{pid}/io", "r", encoding="utf-8") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except (OSError, ValueError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20.0, help="новых сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=20.0, help="сколько секунд подавать нагрузку")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="задержка ответа заглушки")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="доля оборванных соединений")
+    parser.add_argument("--think-ms", type=float, default=100.0, help="пауза «пользователя» между шагами")
+    parser.add_argument("--drain", type=float, default=15.0, help="сколько ждать хвост после подачи")
+    parser.add_argument("--mode", choices=("polling", "async"), default="polling")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="taro-bench-")
+    _prepare_workdir(workdir)
+    os.chdir(workdir)
+    content = _Content(workdir)
+
+    fake = FakeTelegram(args.latency_ms / 1000, args.rate_429, args.drop_rate)
+    server = _QuietServer(("127.0.0.1", 0), _make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        BOT_RUN_MODE=args.mode,
+        # Фоновое обновление комбинаций ходит в интернет — в прогоне оно не нужно.
+        TWO_CARDS_REFRESH_INTERVAL_SECONDS="86400",
+    )
+    bot_log = open(os.path.join(workdir, "bot.log"), "w", encoding="utf-8")
+    process = subprocess.Popen(
+        [sys.executable, "-c", BOOTSTRAP, api_url],
+        cwd=workdir,
+        env=env,
+        stdout=bot_log,
+        stderr=subprocess.STDOUT,
+    )
+
+    sessions_done: Counter[str] = Counter()
+    readings = 0
+    readings_lock = threading.Lock()
+
+    def run_step(kind: str, user_id: int, steps: list[dict], index: int) -> None:
+        nonlocal readings
+
+        if index == len(steps):
+            with readings_lock:
+                sessions_done[kind] += 1
+                if kind in READING_SCENARIOS:
+                    readings += 1
+            return
+
+        def next_step() -> None:
+            timer = threading.Timer(args.think_ms / 1000, run_step, (kind, user_id, steps, index + 1))
+            timer.daemon = True
+            timer.start()
+
+        fake.push(user_id, steps[index], next_step)
+
+    try:
+        # Ждём, пока бот начнёт опрашивать getUpdates.
+        deadline = time.monotonic() + 30
+        while fake.calls["getUpdates"] == 0:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise SystemExit("Бот не запустился — проверь, что bot.py импортируется.")
+            time.sleep(0.05)
+
+        io_before = _read_proc_io(process.pid)
+        kinds = list(SCENARIO_WEIGHTS)
+        weights = [SCENARIO_WEIGHTS[kind] for kind in kinds]
+        started = time.perf_counter()
+        user_id = FIRST_USER_ID
+        sessions_started: Counter[str] = Counter()
+
+        while time.perf_counter() - started < args.duration:
+            kind = random.choices(kinds, weights)[0]
+            sessions_started[kind] += 1
+            run_step(kind, user_id, _scenario_steps(kind, user_id, content), 0)
+            user_id += 1
+            time.sleep(1 / args.rate)
+
+        drain_deadline = time.monotonic() + args.drain
+        while (
+            sum(sessions_done.values()) < sum(sessions_started.values())
+            and time.monotonic() < drain_deadline
+        ):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        io_after = _read_proc_io(process.pid)
+        exit_code = process.poll()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        bot_log.close()
+        server.shutdown()
+        os.chdir(BASE_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies_ms = [value * 1000 for value in fake.latencies]
+    print(f"режим:                {args.mode}, задержка API {args.latency_ms:.0f} мс, 429: {args.rate_429:.1%}")
+    print(f"сценариев начато:     {sum(sessions_started.values())}")
+    print(f"сценариев завершено:  {sum(sessions_done.values())}  {dict(sessions_done)}")
+    print(f"без ответа:           {sum(sessions_started.values()) - sum(sessions_done.values())}")
+    print(f"ответов 429:          {sum(fake.throttled.values())}")
+    print(f"оборвано соединений:  {fake.dropped}")
+    print(f"шагов в секунду:      {len(latencies_ms) / elapsed:.1f}")
+    print(f"задержка p50:         {_percentile(latencies_ms, 0.50):.1f} мс")
+    print(f"задержка p99:         {_percentile(latencies_ms, 0.99):.1f} мс")
+    print(f"раскладов:            {readings}")
+    print(f"вызовы API:           {dict(fake.calls)}")
+    if exit_code is not None:
+        print(f"бот завершился во время прогона с кодом {exit_code} — см. bot.log (--keep)")
+
+    if io_before and io_after and readings:
+        write_bytes = io_after["write_bytes"] - io_before["write_bytes"]
+        write_calls = io_after["syscw"] - io_before["syscw"]
+        print(f"записи на диск:       {write_bytes / readings:.0f} Б и {write_calls / readings:.1f} write() на расклад")
+    else:
+        print("записи на диск:       нет данных (/proc/<pid>/io недоступен)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,42 @@
+import array
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import cProfile
 import csv
+import functools
+import hashlib
+import hmac
 import html
+import http.server
 import io
+import itertools
 import os
+import pickle
+import pstats
+import queue
 import telebot
 import json
 import random
 import requests
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
 import time
 import threading
 from collections import Counter
-from typing import Dict
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple
+from datetime import date, datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from telebot import Handler
 from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import HandlerBackend
 from telebot.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -21,6 +46,11 @@ from telebot.types import (
     LabeledPrice,
 )
 
+try:
+    import fcntl
+except ImportError:  # Windows: там бот работает одним процессом
+    fcntl = None
+
 # === Настройки ===
 TOKEN = os.getenv("BOT_TOKEN")
 CARDS_FOLDER = "images"
@@ -28,8 +58,25 @@ WEBAPP_URL = "https://nimixiss.github.io/tarot-webapp/"
 CONSULTATION_URL = "https://t.me/helenatarotbot"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-USAGE_STORAGE_PATH = os.path.join(BASE_DIR, "single_card_usage.json")
-STATS_DIR = os.path.join(BASE_DIR, "stats")
+# Изменяемое состояние (лимиты, пользователи, статистика, диалоги, рассылка).
+# Чтобы несколько процессов обслуживали одного бота, укажи общий каталог
+# и STATE_BACKEND=shared. SQLite в режиме WAL требует, чтобы все процессы
+# работали на одной машине: сетевые ФС вроде NFS для него не подходят.
+STATE_DIR = os.getenv("STATE_DIR", BASE_DIR)
+# local — один процесс, лимиты проверяются по памяти; shared — по общему хранилищу.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local").strip().lower()
+USAGE_STORAGE_PATH = os.path.join(STATE_DIR, "single_card_usage.json")
+USAGE_DB_PATH = os.path.join(STATE_DIR, "single_card_usage.sqlite3")
+USAGE_BINARY_PATH = os.path.join(STATE_DIR, "single_card_usage.bin")
+# sqlite — основное хранилище, json — старый формат с полной перезаписью файла,
+# binary — то же, но в компактном двоичном формате реестра пользователей.
+USAGE_STORE_BACKEND = os.getenv("USAGE_STORE_BACKEND", "sqlite").strip().lower()
+STATS_DIR = os.path.join(STATE_DIR, "stats")
+PHOTO_FILE_ID_CACHE_PATH = os.path.join(STATE_DIR, "photo_file_ids.json")
+# Служебные команды (`python bot.py compile-content` и другие) работают только
+# с файлами: хранилища, статистику и фоновые потоки для них не поднимаем.
+_CLI_COMMANDS = ("compile-content", "build-images", "usage-convert")
+_RUNNING_CLI_COMMAND = __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in _CLI_COMMANDS
 
 # Для Telegram Stars при продаже цифровых услуг можно передавать
 # пустой provider_token – это корректно по официальной документации.
@@ -58,6 +105,15 @@ READING_TYPE_SINGLE = "single"
 READING_TYPE_TWO_CARDS = "two_cards"
 READING_TYPE_THREE_CARDS = "three_cards"
 READING_TYPE_YES_NO = "yes_no"
+# Хранится рядом с датами раскладов: дата, когда Telegram отказал в отправке
+# (403 или «chat not found»). Такие пользователи убираются после рассылки.
+USER_INACTIVE_KEY = "inactive_since"
+# Положение пользователя в его личной колоде для одной карты: "seed:index".
+DECK_CURSOR_KEY = "deck_cursor"
+# День последнего обращения к боту: по нему неактивных уносим в архив.
+USER_LAST_SEEN_KEY = "last_seen"
+# Подписка на ежедневную карту дня: часовой пояс пользователя, "+03:00".
+USER_CARD_OF_DAY_PUSH_KEY = "card_of_day_push"
 
 YES_NO_BUTTON_LABEL = "🎯 Ответ да/нет"
 YES_NO_CALLBACK_DRAW = "yes_no_draw"
@@ -66,982 +122,4922 @@ YES_NO_PROMPT_TEXT = (
     "чтобы получить ответ."
 )
 
-single_card_usage: Dict[str, Dict[str, str]] = {}
-_usage_lock = threading.Lock()
-_daily_stats: Dict[str, Dict[str, int]] = {}
+# === Метрики ===
+# Текстовые метрики в формате Prometheus. Отдаются на METRICS_PORT (0 — выключено)
+# и собираются в памяти процесса: задержки обработчиков и вызовов Telegram API,
+# ожидание блокировок, длительность записи на диск и глубина очередей.
+METRICS_LISTEN_HOST = os.getenv("METRICS_LISTEN_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+_METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Все созданные метрики в порядке объявления — так их и отдаёт /metrics.
+_registered_metrics: list = []
 
 
-DAILY_EVENT_START = "start"
-DAILY_EVENT_SINGLE_CARD_BUTTON = "single_card_button"
-DAILY_EVENT_SINGLE_CARD_READING = "single_card_reading"
-DAILY_EVENT_TWO_CARDS_READING = "two_cards_reading"
-DAILY_EVENT_THREE_CARDS_BUTTON = "three_cards_button"
-DAILY_EVENT_THREE_CARDS_READING = "three_cards_reading"
-DAILY_EVENT_YES_NO_BUTTON = "yes_no_button"
-DAILY_EVENT_YES_NO_READING = "yes_no_reading"
+def _escape_metric_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
 
-DAILY_EVENT_LABELS = {
-    DAILY_EVENT_START: "Команда /start",
-    DAILY_EVENT_SINGLE_CARD_BUTTON: "Нажатия «Одна карта»",
-    DAILY_EVENT_SINGLE_CARD_READING: "Расклады на одну карту",
-    DAILY_EVENT_TWO_CARDS_READING: "Расклады на две карты",
-    DAILY_EVENT_THREE_CARDS_BUTTON: "Нажатия «Три карты»",
-    DAILY_EVENT_THREE_CARDS_READING: "Расклады на три карты",
-    DAILY_EVENT_YES_NO_BUTTON: "Нажатия «Ответ да/нет»",
-    DAILY_EVENT_YES_NO_READING: "Ответы да/нет",
-}
+def _format_metric_labels(label_names: tuple[str, ...], label_values: tuple, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{_escape_metric_label(value)}"' for name, value in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _HistogramMetric:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...],
+        trace_phase: str | None = None,
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        # Фаза трассировки апдейта, к которой относятся замеры (см. PROFILE_HANDLERS).
+        self.trace_phase = trace_phase
+        self._lock = threading.Lock()
+        # метки -> [счётчики по корзинам..., сумма, количество]
+        self._series: dict[tuple, list] = {}
+        _registered_metrics.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        position = bisect.bisect_left(_METRIC_BUCKETS, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(_METRIC_BUCKETS) + [0.0, 0]
+            if position < len(_METRIC_BUCKETS):
+                series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+
+        for label_values, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(_METRIC_BUCKETS, series):
+                cumulative += count
+                labels = _format_metric_labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_metric_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_metric_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class _CounterMetric:
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values: Counter[tuple] = Counter()
+        _registered_metrics.append(self)
+
+    def inc(self, *label_values) -> None:
+        with self._lock:
+            self._values[label_values] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_values, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_metric_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+_handler_seconds = _HistogramMetric(
+    "taro_handler_seconds", "Время работы обработчика апдейта.", ("handler",)
+)
+_handler_errors = _CounterMetric(
+    "taro_handler_errors_total", "Исключения, вылетевшие из обработчика.", ("handler",)
+)
+_telegram_api_seconds = _HistogramMetric(
+    "taro_telegram_api_seconds",
+    "Длительность вызова Telegram Bot API.",
+    ("method",),
+    trace_phase="telegram",
+)
+_telegram_api_errors = _CounterMetric(
+    "taro_telegram_api_errors_total", "Ошибки вызовов Telegram Bot API.", ("method", "code")
+)
+_lock_wait_seconds = _HistogramMetric(
+    "taro_lock_wait_seconds", "Ожидание захвата общей блокировки.", ("lock",)
+)
+_persist_seconds = _HistogramMetric(
+    "taro_persist_seconds",
+    "Длительность записи состояния на диск.",
+    ("target",),
+    trace_phase="persist",
+)
+# Имя очереди -> функция, возвращающая её текущую глубину.
+_queue_depth_sources: dict[str, object] = {}
+
+
+def _register_queue_depth(name: str, source) -> None:
+    _queue_depth_sources[name] = source
+
+
+def _render_metrics() -> str:
+    lines: list[str] = []
+    for metric in _registered_metrics:
+        lines.extend(metric.render())
 
+    lines.append("# HELP taro_queue_depth Сколько задач ждёт в очереди.")
+    lines.append("# TYPE taro_queue_depth gauge")
+    for name, source in sorted(_queue_depth_sources.items()):
+        try:
+            depth = source()
+        except Exception:  # noqa: BLE001 - метрика не должна ронять выдачу
+            continue
+        lines.append(f'taro_queue_depth{{queue="{name}"}} {depth}')
+
+    return "\n".join(lines) + "\n"
+
+
+# === Профилирование обработчиков ===
+# PROFILE_HANDLERS=1 раскладывает время каждого апдейта на поиск контента,
+# запись на диск и сетевые вызовы Telegram. Апдейты дольше
+# SLOW_REQUEST_THRESHOLD_MS пишутся в slow_requests.jsonl с ротацией.
+# Команда /profile N независимо от этого снимает cProfile за N секунд.
+PROFILE_HANDLERS = os.getenv("PROFILE_HANDLERS", "0").strip().lower() in ("1", "true", "yes")
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "500"))
+SLOW_REQUEST_LOG_PATH = os.path.join(BASE_DIR, "slow_requests.jsonl")
+SLOW_REQUEST_LOG_MAX_BYTES = int(os.getenv("SLOW_REQUEST_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+SLOW_REQUEST_LOG_BACKUPS = 3
+PROFILES_DIR = os.path.join(BASE_DIR, "profiles")
+PROFILE_MAX_SECONDS = 600
+TRACE_PHASES = ("content", "persist", "telegram")
+
+
+class _RequestTrace:
+    """Время одного апдейта по фазам; вложенная фаза вычитается из внешней."""
+
+    __slots__ = ("phases", "_stack")
 
-def _load_single_card_usage() -> None:
-    """Загружает историю вытягивания карт из файла."""
-    global single_card_usage
+    def __init__(self) -> None:
+        self.phases = dict.fromkeys(TRACE_PHASES, 0.0)
+        self._stack: list[list] = []
 
-    if not os.path.exists(USAGE_STORAGE_PATH):
-        single_card_usage = {}
+    def enter(self, phase: str) -> None:
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self) -> None:
+        phase, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.phases[phase] += elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+
+_current_trace: "contextvars.ContextVar[_RequestTrace | None]" = contextvars.ContextVar(
+    "taro_request_trace", default=None
+)
+_slow_request_log_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _trace_phase(phase: str | None):
+    trace = _current_trace.get()
+    if trace is None or phase is None:
+        yield
         return
 
+    trace.enter(phase)
     try:
-        with open(USAGE_STORAGE_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except (OSError, json.JSONDecodeError) as exc:
-        print(
-            f"Не удалось загрузить историю вытягивания карт: {exc}",
-            flush=True,
-        )
-        single_card_usage = {}
+        yield
+    finally:
+        trace.exit()
+
+
+def _traced_content(func):
+    """Относит время функции к поиску контента. Без PROFILE_HANDLERS ничего не делает."""
+    if not PROFILE_HANDLERS:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _trace_phase("content"):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _rotate_slow_request_log() -> None:
+    """Вызывается под _slow_request_log_lock."""
+    for index in range(SLOW_REQUEST_LOG_BACKUPS - 1, 0, -1):
+        source = f"{SLOW_REQUEST_LOG_PATH}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{SLOW_REQUEST_LOG_PATH}.{index + 1}")
+    os.replace(SLOW_REQUEST_LOG_PATH, f"{SLOW_REQUEST_LOG_PATH}.1")
+
+
+def _write_slow_request(record: dict) -> None:
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+
+    with _slow_request_log_lock:
+        try:
+            if (
+                os.path.exists(SLOW_REQUEST_LOG_PATH)
+                and os.path.getsize(SLOW_REQUEST_LOG_PATH) + len(line) > SLOW_REQUEST_LOG_MAX_BYTES
+            ):
+                _rotate_slow_request_log()
+            with open(SLOW_REQUEST_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as exc:
+            print(f"Не удалось записать медленный запрос: {exc}", flush=True)
+
+
+def _update_chat_id(update) -> int | None:
+    chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    return getattr(getattr(update, "from_user", None), "id", None)
+
+
+def _finish_request_trace(name: str, update, trace: _RequestTrace, wall: float, error) -> None:
+    if wall * 1000 < SLOW_REQUEST_THRESHOLD_MS:
         return
 
-    if isinstance(data, dict):
-        normalized: Dict[str, Dict[str, str]] = {}
+    record = {
+        "at": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "handler": name,
+        "chat_id": _update_chat_id(update),
+        "wall_ms": round(wall * 1000, 2),
+    }
+    for phase, seconds in trace.phases.items():
+        record[f"{phase}_ms"] = round(seconds * 1000, 2)
+    record["other_ms"] = round((wall - sum(trace.phases.values())) * 1000, 2)
+    if error is not None:
+        record["error"] = type(error).__name__
+    _write_slow_request(record)
+
+
+class _ProfileSession:
+    """Окно /profile: профили отдельных вызовов обработчиков складываются в один."""
+
+    def __init__(self, chat_id: int, seconds: int) -> None:
+        self.chat_id = chat_id
+        self.seconds = seconds
+        self.until = time.monotonic() + seconds
+        self.calls = 0
+        self.skipped = 0
+        self.stats: pstats.Stats | None = None
+        self.loop_profiler: cProfile.Profile | None = None
+        self._lock = threading.Lock()
+        self._profiler_lock = threading.Lock()
+
+    def is_active(self) -> bool:
+        return time.monotonic() < self.until
+
+    def add(self, profiler: cProfile.Profile) -> None:
+        with self._lock:
+            self.calls += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
 
-        for user_id, value in data.items():
-            str_user_id = str(user_id)
+    def runcall(self, func, *args, **kwargs):
+        """Выполняет обработчик под профилировщиком, если тот свободен.
 
-            if isinstance(value, dict):
-                normalized[str_user_id] = {
-                    str(key): str(date_str)
-                    for key, date_str in value.items()
-                    if isinstance(key, str) and isinstance(date_str, str)
-                }
-                continue
+        С Python 3.12 в процессе может работать только один cProfile, и
+        второй падает с ValueError. Поэтому параллельные обработчики
+        выполняются без профиля и лишь учитываются в skipped.
+        """
+        if self._profiler_lock.acquire(blocking=False):
+            try:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # Профилировщик уже занят, например циклом асинхронного режима.
+                    pass
+                else:
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        profiler.disable()
+                        self.add(profiler)
+            finally:
+                self._profiler_lock.release()
+
+        with self._lock:
+            self.skipped += 1
+        return func(*args, **kwargs)
+
+
+_profile_session: _ProfileSession | None = None
+_profile_session_lock = threading.Lock()
+# Цикл событий асинхронного режима: там профилируется весь поток цикла.
+_async_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _start_profile_session(chat_id: int, seconds: int) -> bool:
+    global _profile_session
+
+    with _profile_session_lock:
+        if _profile_session is not None:
+            return False
+        session = _profile_session = _ProfileSession(chat_id, seconds)
+
+    if _async_loop is not None:
+        session.loop_profiler = cProfile.Profile()
+        _async_loop.call_soon_threadsafe(session.loop_profiler.enable)
+
+    timer = threading.Timer(seconds, _finish_profile_session)
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def _finish_profile_session() -> None:
+    global _profile_session
+
+    with _profile_session_lock:
+        session, _profile_session = _profile_session, None
+    if session is None:
+        return
 
-            if isinstance(value, str):
-                normalized[str_user_id] = {READING_TYPE_SINGLE: value}
+    if session.loop_profiler is not None and _async_loop is not None:
+        stopped = threading.Event()
 
-        single_card_usage = normalized
-    else:
-        single_card_usage = {}
+        def stop_loop_profiler() -> None:
+            session.loop_profiler.disable()
+            stopped.set()
+
+        _async_loop.call_soon_threadsafe(stop_loop_profiler)
+        if stopped.wait(5):
+            session.add(session.loop_profiler)
 
+    if session.stats is None:
+        bot.send_message(
+            session.chat_id,
+            f"За {session.seconds} с не было ни одного апдейта — профилировать нечего.",
+        )
+        return
 
-def _save_single_card_usage() -> None:
-    """Сохраняет историю вытягивания карт в файл."""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    dump_path = os.path.join(PROFILES_DIR, f"profile-{stamp}.pstats")
     try:
-        tmp_path = f"{USAGE_STORAGE_PATH}.tmp"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(single_card_usage, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, USAGE_STORAGE_PATH)
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        session.stats.dump_stats(dump_path)
     except OSError as exc:
-        print(
-            f"Не удалось сохранить историю вытягивания карт: {exc}",
-            flush=True,
-        )
+        print(f"Не удалось сохранить профиль: {exc}", flush=True)
+        dump_path = None
+
+    report = io.StringIO()
+    session.stats.stream = report
+    session.stats.sort_stats("cumulative").print_stats(40)
+
+    caption = f"⏱ Профиль за {session.seconds} с, обработчиков: {session.calls}."
+    if session.skipped:
+        caption += f"\nБез профиля (шли параллельно): {session.skipped}."
+    if dump_path:
+        caption += f"\nПолный дамп: {os.path.relpath(dump_path, BASE_DIR)}"
+    bot.send_document(
+        session.chat_id,
+        telebot.types.InputFile(
+            io.BytesIO(report.getvalue().encode("utf-8")), file_name=f"profile-{stamp}.txt"
+        ),
+        caption=caption,
+    )
 
 
-_load_single_card_usage()
+@contextlib.contextmanager
+def _observe_duration(histogram: _HistogramMetric, *label_values):
+    started = time.perf_counter()
+    try:
+        with _trace_phase(histogram.trace_phase):
+            yield
+    finally:
+        histogram.observe(time.perf_counter() - started, *label_values)
 
 
-def _get_daily_stats_file_path(date_str: str) -> str:
-    return os.path.join(STATS_DIR, f"{date_str}.json")
+class _TimedLock:
+    """threading.Lock, который записывает в метрики время ожидания захвата."""
 
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._lock = threading.Lock()
 
-def _load_daily_stats_for_date(date_str: str) -> dict[str, int]:
-    path = _get_daily_stats_file_path(date_str)
+    def __enter__(self):
+        started = time.perf_counter()
+        self._lock.acquire()
+        _lock_wait_seconds.observe(time.perf_counter() - started, self._name)
+        return self
 
-    if not os.path.exists(path):
-        return {}
+    def __exit__(self, *exc_info) -> None:
+        self._lock.release()
 
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            raw_data = json.load(f)
-    except (OSError, json.JSONDecodeError) as exc:
-        print(
-            f"Не удалось загрузить статистику за {date_str}: {exc}",
-            flush=True,
-        )
-        return {}
 
-    if not isinstance(raw_data, dict):
-        return {}
+def _handler_metric_name(func) -> str:
+    return getattr(func, "__name__", repr(func)).removeprefix("_async_")
 
-    normalized: dict[str, int] = {}
-    for key, value in raw_data.items():
-        if isinstance(key, str) and isinstance(value, int):
-            normalized[key] = value
 
-    return normalized
+def _timed_handler(func):
+    """Оборачивает обработчик telebot замером времени, счётчиком ошибок и трассировкой."""
+    if getattr(func, "_metrics_wrapped", False):
+        return func
 
+    name = _handler_metric_name(func)
 
-def _save_daily_stats(date_str: str, data: dict[str, int]) -> None:
-    path = _get_daily_stats_file_path(date_str)
-    tmp_path = f"{path}.tmp"
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(update, *args, **kwargs):
+            trace = _RequestTrace() if PROFILE_HANDLERS and _current_trace.get() is None else None
+            token = _current_trace.set(trace) if trace is not None else None
+            started = time.perf_counter()
+            error = None
+            try:
+                return await func(update, *args, **kwargs)
+            except Exception as exc:
+                error = exc
+                _handler_errors.inc(name)
+                raise
+            finally:
+                wall = time.perf_counter() - started
+                _handler_seconds.observe(wall, name)
+                if trace is not None:
+                    _current_trace.reset(token)
+                    _finish_request_trace(name, update, trace, wall, error)
+
+        async_wrapper._metrics_wrapped = True
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        trace = _RequestTrace() if PROFILE_HANDLERS and _current_trace.get() is None else None
+        token = _current_trace.set(trace) if trace is not None else None
+        session = _profile_session
+        started = time.perf_counter()
+        error = None
+        try:
+            if session is not None and session.is_active():
+                return session.runcall(func, update, *args, **kwargs)
+            return func(update, *args, **kwargs)
+        except Exception as exc:
+            error = exc
+            _handler_errors.inc(name)
+            raise
+        finally:
+            wall = time.perf_counter() - started
+            _handler_seconds.observe(wall, name)
+            if trace is not None:
+                _current_trace.reset(token)
+                _finish_request_trace(name, update, trace, wall, error)
+
+    wrapper._metrics_wrapped = True
+    return wrapper
+
+
+def _instrument_handlers(target_bot) -> None:
+    """Оборачивает все зарегистрированные обработчики бота замером времени."""
+    for attr_name, handlers in vars(target_bot).items():
+        if not attr_name.endswith("_handlers") or not isinstance(handlers, list):
+            continue
+        for handler in handlers:
+            if isinstance(handler, dict) and callable(handler.get("function")):
+                handler["function"] = _timed_handler(handler["function"])
 
-    try:
-        os.makedirs(STATS_DIR, exist_ok=True)
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, path)
-    except OSError as exc:
-        print(
-            f"Не удалось сохранить статистику за {date_str}: {exc}",
-            flush=True,
-        )
 
+def _telegram_error_code(exc: Exception) -> str:
+    if isinstance(exc, ApiTelegramException):
+        return str(exc.error_code)
+    return type(exc).__name__
 
-def _initialize_daily_stats() -> None:
-    try:
-        os.makedirs(STATS_DIR, exist_ok=True)
-    except OSError as exc:
-        print(f"Не удалось создать директорию статистики: {exc}", flush=True)
+
+def _instrument_telegram_api() -> None:
+    """Замеряет каждый запрос к Bot API в синхронном клиенте telebot."""
+    original = telebot.apihelper._make_request
+    if getattr(original, "_metrics_wrapped", False):
         return
 
-    today = datetime.now(timezone.utc).date().isoformat()
-    with _usage_lock:
-        _daily_stats[today] = _load_daily_stats_for_date(today)
+    @functools.wraps(original)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        try:
+            with _observe_duration(_telegram_api_seconds, method_name):
+                return original(token, method_name, *args, **kwargs)
+        except Exception as exc:
+            _telegram_api_errors.inc(method_name, _telegram_error_code(exc))
+            raise
 
+    timed_make_request._metrics_wrapped = True
+    telebot.apihelper._make_request = timed_make_request
 
-def _increment_daily_event(event_name: str) -> None:
-    today = datetime.now(timezone.utc).date().isoformat()
 
-    with _usage_lock:
-        stats = _daily_stats.get(today)
-        if stats is None:
-            stats = _load_daily_stats_for_date(today)
-            _daily_stats[today] = stats
+def _instrument_async_telegram_api(asyncio_helper) -> None:
+    """То же для asyncio-клиента: там все методы идут через _process_request."""
+    original = asyncio_helper._process_request
+    if getattr(original, "_metrics_wrapped", False):
+        return
 
-        stats[event_name] = stats.get(event_name, 0) + 1
-        _save_daily_stats(today, stats)
+    @functools.wraps(original)
+    async def timed_process_request(token, url, *args, **kwargs):
+        try:
+            with _observe_duration(_telegram_api_seconds, url):
+                return await original(token, url, *args, **kwargs)
+        except Exception as exc:
+            _telegram_api_errors.inc(url, _telegram_error_code(exc))
+            raise
+
+    timed_process_request._metrics_wrapped = True
+    asyncio_helper._process_request = timed_process_request
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # noqa: N802 - имя задаёт http.server
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
 
-        for stored_date in list(_daily_stats.keys()):
-            if stored_date != today:
-                _daily_stats.pop(stored_date, None)
+        body = _render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
+    def log_message(self, format, *args) -> None:  # noqa: A002 - сигнатура http.server
+        pass
 
-def _format_event_label(event_name: str) -> str:
-    return DAILY_EVENT_LABELS.get(event_name, event_name)
 
+def _start_metrics_server() -> None:
+    if METRICS_PORT <= 0:
+        return
 
-def _format_daily_stats(date_str: str, stats: dict[str, int]) -> str:
-    if not stats:
-        return f"За {date_str} пока нет записей."
+    server = http.server.ThreadingHTTPServer(
+        (METRICS_LISTEN_HOST, METRICS_PORT), _MetricsRequestHandler
+    )
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    print(f"Метрики доступны на http://{METRICS_LISTEN_HOST}:{METRICS_PORT}/metrics", flush=True)
 
-    lines = [f"📊 Статистика за {date_str}:"]
 
-    for event_name, count in sorted(stats.items()):
-        lines.append(f"• {_format_event_label(event_name)}: {count}")
+# === Блокировки между процессами ===
+def _is_shared_state() -> bool:
+    return STATE_BACKEND == "shared"
 
-    return "\n".join(lines)
 
+@contextlib.contextmanager
+def _interprocess_lock(path: str):
+    """flock на файле-замке: read-modify-write одного файла из разных процессов."""
+    if fcntl is None:
+        yield
+        return
 
-def _prepare_stats_csv() -> tuple[str, io.BytesIO, Counter[str]] | None:
-    if not os.path.isdir(STATS_DIR):
-        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    files = [
-        entry
-        for entry in os.listdir(STATS_DIR)
-        if entry.endswith(".json") and os.path.isfile(os.path.join(STATS_DIR, entry))
-    ]
 
-    if not files:
-        return None
+def _try_interprocess_lock(path: str):
+    """Неблокирующий захват. Возвращает открытый файл-замок или None, если он занят."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_file = open(path, "a", encoding="utf-8")
+    if fcntl is None:
+        return lock_file
 
-    totals: Counter[str] = Counter()
-    csv_buffer = io.StringIO()
-    writer = csv.writer(csv_buffer)
-    writer.writerow(["date", "event", "count"])
-    has_rows = False
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+os.makedirs(STATE_DIR, exist_ok=True)
+
+
+# === Реестр пользователей ===
+# История раскладов каждого пользователя живёт в памяти, поэтому вместо
+# словаря словарей со строками — параллельные массивы, упорядоченные по id:
+# около 20 байт на пользователя вместо ~450. Даты хранятся номером дня
+# от 1970-01-01 (0 — «не было»), курсор колоды — seed и номер карты.
+# Значения, которые так не кодируются без потерь, лежат в _extras.
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_USER_DAY_FIELDS = (
+    READING_TYPE_SINGLE,
+    READING_TYPE_TWO_CARDS,
+    READING_TYPE_THREE_CARDS,
+    READING_TYPE_YES_NO,
+    USER_INACTIVE_KEY,
+    USER_LAST_SEEN_KEY,
+)
+# Дни, которые считаются активностью пользователя.
+_USER_ACTIVITY_FIELDS = tuple(field for field in _USER_DAY_FIELDS if field != USER_INACTIVE_KEY)
+USER_REGISTRY_MAGIC = b"TARU"
+USER_REGISTRY_VERSION = 3
+# Часовой пояс подписчика карты дня хранится байтом: число четвертей часа
+# от UTC плюс смещение, 0 — подписки нет.
+_PUSH_SLOT_BIAS = 64
 
-    for filename in sorted(files):
-        date_part = filename[:-5]
-        stats = _load_daily_stats_for_date(date_part)
 
-        if not stats:
-            continue
+def _day_to_iso(day: int) -> str:
+    return date.fromordinal(day + _EPOCH_ORDINAL).isoformat()
 
-        for event_name, count in stats.items():
-            writer.writerow([date_part, event_name, count])
-            totals[event_name] += count
-            has_rows = True
 
-    if not has_rows:
+def _iso_to_day(value: str | None) -> int | None:
+    try:
+        day = date.fromisoformat(value).toordinal() - _EPOCH_ORDINAL
+    except (TypeError, ValueError):
         return None
+    if not 0 < day <= 0xFFFF or _day_to_iso(day) != value:
+        return None
+    return day
 
-    data = csv_buffer.getvalue().encode("utf-8")
-    binary = io.BytesIO(data)
-    filename = "stats_export.csv"
-    binary.name = filename
-    binary.seek(0)
 
-    return filename, binary, totals
+# Таблица для bytes.translate: меняет флаги 0 и 1 местами.
+_INVERT_FLAG = bytes([1, 0]) + bytes(254)
 
 
-_initialize_daily_stats()
+def _today_day() -> int:
+    return datetime.now(timezone.utc).date().toordinal() - _EPOCH_ORDINAL
 
-# Для режима с одной картой формируем «колоду», чтобы карты не повторялись,
-# пока не будут вытянуты все 78.
-_shuffled_single_card_deck: list[str] = []
 
-# === Загрузка данных ===
-with open("tarot_cards.json", "r", encoding="utf-8") as f:
-    tarot_deck = json.load(f)
+def _encode_deck_cursor(value: str | None) -> tuple[int, int] | None:
+    seed_str, _, index_str = (value or "").partition(":")
+    if not (seed_str.isdigit() and index_str.isdigit()):
+        return None
+    seed, index = int(seed_str), int(index_str)
+    if seed > 0xFFFFFFFF or not 0 < index <= 0xFF or f"{seed}:{index}" != value:
+        return None
+    return seed, index
 
-TOPICS_FILE = "tarot_cards_topics.json"
-if os.path.exists(TOPICS_FILE):
-    with open(TOPICS_FILE, "r", encoding="utf-8") as f:
-        tarot_topics = json.load(f)
-else:
-    # Файл с темами может отсутствовать на некоторых развёртываниях.
-    # В этом случае используем данные из tarot_cards.json, если они
-    # уже содержат тематические значения.
-    tarot_topics = {}
-    for card_name, card_data in tarot_deck.items():
-        if isinstance(card_data, dict):
-            filtered_topics = {
-                topic: values
-                for topic, values in card_data.items()
-                if isinstance(values, list)
-            }
-            if filtered_topics:
-                tarot_topics[card_name] = filtered_topics
 
+def _parse_utc_offset(value: str | None) -> int | None:
+    """"+3", "UTC-5", "+05:30" → смещение в минутах; None, если не разобрать."""
+    text = (value or "").strip().upper().removeprefix("UTC").removeprefix("GMT")
+    if not text or text[0] not in "+-":
+        return None
 
-def _collect_all_meanings(card_data):
-    """Возвращает плоский список значений карты из любых доступных структур."""
-    if isinstance(card_data, list):
-        return [value for value in card_data if isinstance(value, str)]
+    hours_str, _, minutes_str = text[1:].partition(":")
+    if not hours_str.isdigit() or (minutes_str and not minutes_str.isdigit()):
+        return None
+    minutes = int(hours_str) * 60 + int(minutes_str or 0)
+    if int(minutes_str or 0) >= 60 or minutes % 15:
+        return None
 
-    if isinstance(card_data, dict):
-        collected = []
-        for values in card_data.values():
-            if isinstance(values, list):
-                collected.extend(v for v in values if isinstance(v, str))
-        return collected
+    offset = -minutes if text[0] == "-" else minutes
+    if not -12 * 60 <= offset <= 14 * 60:
+        return None
+    return offset
 
-    return []
 
+def _format_utc_offset(offset: int) -> str:
+    sign = "-" if offset < 0 else "+"
+    hours, minutes = divmod(abs(offset), 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
 
-TOPIC_TO_KEY = {
-    "❤️ Любовь": "love",
-    "💼 Карьера": "career",
-    "💰 Финансы": "finance",
-    "🧘‍♀️ Здоровье": "health",
-    "🧿 Совет дня": "advice",
-}
 
-with open("combinations.json", "r", encoding="utf-8") as f:
-    _raw_three_card_data = json.load(f)
+def _offset_to_push_slot(offset: int) -> int:
+    return offset // 15 + _PUSH_SLOT_BIAS
 
-CARD_OF_DAY_FILE = "cardoftheday.json"
-try:
-    with open(CARD_OF_DAY_FILE, "r", encoding="utf-8") as f:
-        raw_card_of_day_data = json.load(f)
-    if isinstance(raw_card_of_day_data, dict):
-        card_of_day_schedule: Dict[str, Dict[str, str]] = {}
-        for date_key, payload in raw_card_of_day_data.items():
-            if not isinstance(date_key, str):
-                continue
-            if not isinstance(payload, dict):
-                continue
-            card = payload.get("card")
-            meaning = payload.get("meaning")
-            if isinstance(card, str) and isinstance(meaning, str):
-                card_of_day_schedule[date_key.strip()] = {
-                    "card": card.strip(),
-                    "meaning": meaning.strip(),
-                }
-    else:
-        card_of_day_schedule = {}
-except (OSError, json.JSONDecodeError) as exc:
-    print(f"Не удалось загрузить карты дня: {exc}", flush=True)
-    card_of_day_schedule = {}
 
-YES_NO_FILE = "yesnot.json"
-if os.path.exists(YES_NO_FILE):
+def _push_slot_to_offset(slot: int) -> int:
+    return (slot - _PUSH_SLOT_BIAS) * 15
+
+
+def _parse_user_id(value) -> int | None:
     try:
-        with open(YES_NO_FILE, "r", encoding="utf-8") as f:
-            _yes_no_answers: Dict[str, str] = {
-                str(name): str(value)
-                for name, value in json.load(f).items()
-                if isinstance(name, str) and isinstance(value, str)
-            }
-    except (OSError, json.JSONDecodeError) as exc:
-        print(f"Не удалось загрузить файл ответов да/нет: {exc}", flush=True)
-        _yes_no_answers = {}
-else:
-    _yes_no_answers = {}
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
-def _normalize_three_card_combinations(raw_data) -> tuple[Dict[str, dict[str, str]], list[tuple[str, str]]]:
-    """Подготавливает расклады на три карты и формирует общий пул."""
+class _UserRegistry:
+    """Пользователи и их история раскладов в компактном виде.
 
-    normalized: Dict[str, dict[str, str]] = {}
-    fallback_pool: list[tuple[str, str]] = []
+    Сам по себе не потокобезопасен: все обращения идут под _usage_lock.
+    """
 
-    if not isinstance(raw_data, dict):
-        return normalized, fallback_pool
+    def __init__(self, user_ids=()) -> None:
+        ids = sorted(set(user_ids))
+        count = len(ids)
+        self._ids = array.array("q", ids)
+        self._days = {field: array.array("H", bytes(2 * count)) for field in _USER_DAY_FIELDS}
+        self._cursor_seeds = array.array("I", bytes(4 * count))
+        self._cursor_indexes = array.array("B", bytes(count))
+        self._push_slots = array.array("B", bytes(count))
+        self._extras: dict[int, dict[str, str]] = {}
+
+    def _columns(self) -> list[array.array]:
+        return [
+            self._ids,
+            *self._days.values(),
+            self._cursor_seeds,
+            self._cursor_indexes,
+            self._push_slots,
+        ]
 
-    for topic_key, topic_data in raw_data.items():
-        if not (isinstance(topic_key, str) and isinstance(topic_data, dict)):
-            continue
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._locate(user_id) is not None
+
+    def _locate(self, user_id: int, create: bool = False) -> int | None:
+        position = bisect.bisect_left(self._ids, user_id)
+        if position < len(self._ids) and self._ids[position] == user_id:
+            return position
+        if not create:
+            return None
+
+        # Вставка сдвигает хвост массивов: ~1 мс на миллион пользователей,
+        # а новые пользователи приходят куда реже, чем идут расклады.
+        for column in self._columns():
+            column.insert(position, 0)
+        self._ids[position] = user_id
+        return position
+
+    def add(self, user_id: int) -> bool:
+        """Добавляет пользователя; False — он уже был."""
+        size = len(self._ids)
+        self._locate(user_id, create=True)
+        return len(self._ids) != size
+
+    def remove(self, user_id: int) -> bool:
+        position = self._locate(user_id)
+        if position is None:
+            return False
+
+        for column in self._columns():
+            del column[position]
+        self._extras.pop(user_id, None)
+        return True
+
+    def remove_many(self, user_ids) -> int:
+        """Удаляет сразу многих: один проход по массивам вместо сдвига на каждого."""
+        doomed = set(user_ids)
+        drop = bytes(map(doomed.__contains__, self._ids))
+        removed = drop.count(1)
+        if not removed:
+            return 0
+
+        keep = drop.translate(_INVERT_FLAG)
+        for column in self._columns():
+            column[:] = array.array(column.typecode, itertools.compress(column, keep))
+        for user_id in doomed:
+            self._extras.pop(user_id, None)
+        return removed
+
+    def get_day(self, user_id: int, field: str) -> int:
+        position = self._locate(user_id)
+        return 0 if position is None else self._days[field][position]
+
+    def set_day(self, user_id: int, field: str, day: int) -> None:
+        position = self._locate(user_id, create=True)
+        self._days[field][position] = day
+        self._drop_extra(user_id, field)
+
+    def get(self, user_id: int, key: str) -> str | None:
+        """Значение в формате хранилища: ISO-дата или "seed:index"."""
+        position = self._locate(user_id)
+        if position is None:
+            return None
+
+        if key in self._days:
+            day = self._days[key][position]
+            if day:
+                return _day_to_iso(day)
+        elif key == DECK_CURSOR_KEY:
+            index = self._cursor_indexes[position]
+            if index:
+                return f"{self._cursor_seeds[position]}:{index}"
+        elif key == USER_CARD_OF_DAY_PUSH_KEY:
+            slot = self._push_slots[position]
+            if slot:
+                return _format_utc_offset(_push_slot_to_offset(slot))
+
+        return self._extras.get(user_id, {}).get(key)
+
+    def set(self, user_id: int, key: str, value: str | None) -> None:
+        position = self._locate(user_id, create=True)
+        self._drop_extra(user_id, key)
+
+        if key in self._days:
+            day = _iso_to_day(value)
+            self._days[key][position] = day or 0
+            if day is not None or value is None:
+                return
+        elif key == DECK_CURSOR_KEY:
+            seed, index = _encode_deck_cursor(value) or (0, 0)
+            self._cursor_seeds[position] = seed
+            self._cursor_indexes[position] = index
+            if index or value is None:
+                return
+        elif key == USER_CARD_OF_DAY_PUSH_KEY:
+            offset = _parse_utc_offset(value)
+            if offset is not None and _format_utc_offset(offset) == value:
+                self._push_slots[position] = _offset_to_push_slot(offset)
+                return
+            self._push_slots[position] = 0
+            if value is None:
+                return
+        elif value is None:
+            return
 
-        topic_combinations: dict[str, str] = {}
-        for combo_key, meaning in topic_data.items():
-            if not (isinstance(combo_key, str) and isinstance(meaning, str)):
-                continue
+        self._extras.setdefault(user_id, {})[key] = value
+
+    def _drop_extra(self, user_id: int, key: str) -> None:
+        extras = self._extras.get(user_id)
+        if extras is not None and extras.pop(key, None) is not None and not extras:
+            del self._extras[user_id]
+
+    def get_user(self, user_id: int) -> Dict[str, str] | None:
+        position = self._locate(user_id)
+        if position is None:
+            return None
+
+        usage = {
+            field: _day_to_iso(days[position])
+            for field, days in self._days.items()
+            if days[position]
+        }
+        if self._cursor_indexes[position]:
+            usage[DECK_CURSOR_KEY] = f"{self._cursor_seeds[position]}:{self._cursor_indexes[position]}"
+        if self._push_slots[position]:
+            usage[USER_CARD_OF_DAY_PUSH_KEY] = _format_utc_offset(
+                _push_slot_to_offset(self._push_slots[position])
+            )
+        usage.update(self._extras.get(user_id, {}))
+        return usage
 
-            cards = [part.strip() for part in combo_key.split("|") if isinstance(part, str) and part.strip()]
-            if len(cards) != 3:
-                continue
+    def replace_user(self, user_id: int, usage: Dict[str, str] | None) -> None:
+        self.remove(user_id)
+        if usage is None:
+            return
 
-            normalized_key = "|".join(cards)
-            clean_meaning = meaning.strip()
-            topic_combinations[normalized_key] = clean_meaning
-            fallback_pool.append((normalized_key, clean_meaning))
+        self.add(user_id)
+        for key, value in usage.items():
+            self.set(user_id, key, value)
 
-        if topic_combinations:
-            normalized[topic_key] = topic_combinations
+    def unreachable_user_ids(self) -> list[int]:
+        """Пользователи, на которых Telegram ответил 403 или «chat not found»."""
+        return [
+            user_id
+            for user_id, inactive_since in zip(self._ids, self._days[USER_INACTIVE_KEY])
+            if inactive_since or USER_INACTIVE_KEY in self._extras.get(user_id, ())
+        ]
 
-    return normalized, fallback_pool
+    def stale_user_ids(self, before_day: int) -> tuple[list[int], list[int]]:
+        """Кто не появлялся с before_day, и у кого нет ни одной даты вовсе.
 
+        Подписчиков карты дня не трогаем: они получают её, не заходя в бота.
+        """
+        stale: list[int] = []
+        undated: list[int] = []
+        columns = [self._days[field] for field in _USER_ACTIVITY_FIELDS]
+        for user_id, last_day, push_slot in zip(
+            self._ids, map(max, *columns), self._push_slots
+        ):
+            if push_slot:
+                continue
+            if not last_day:
+                undated.append(user_id)
+            elif last_day < before_day:
+                stale.append(user_id)
+        return stale, undated
+
+    def push_slots(self) -> frozenset[int]:
+        """Часовые пояса, в которых есть подписчики карты дня."""
+        return frozenset(self._push_slots) - {0}
+
+    def push_subscribers(self, slot: int) -> list[int]:
+        inactive = self._days[USER_INACTIVE_KEY]
+        return [
+            user_id
+            for user_id, user_slot, inactive_since in zip(self._ids, self._push_slots, inactive)
+            if user_slot == slot and not inactive_since
+        ]
 
-_MAJOR_ARCANA_IMAGE_MAP = {
-    "шут (0)": "fool",
-    "маг (i)": "magician",
-    "верховная жрица (ii)": "high_priestess",
-    "императрица (iii)": "empress",
-    "император (iv)": "emperor",
-    "иерофант (v)": "hierophant",
-    "влюбленные (vi)": "lovers",
-    "колесница (vii)": "chariot",
-    "сила (viii)": "strength",
-    "отшельник (ix)": "hermit",
-    "колесо фортуны (x)": "wheel_of_fortune",
-    "справедливость (xi)": "justice",
-    "повешенный (xii)": "hanged_man",
-    "смерть (xiii)": "death",
-    "умереность (xiv)": "temperance",
-    "умеренность (xiv)": "temperance",
-    "дьявол (xv)": "devil",
-    "башня (xvi)": "tower",
-    "звезда (xvii)": "star",
-    "луна (xviii)": "moon",
-    "солнце (xix)": "sun",
-    "суд (xx)": "judgement",
-    "мир (xxi)": "world",
+    def active_user_ids(self) -> list[int]:
+        """Пользователи, не заблокировавшие бота, — без разбора строк."""
+        inactive_extras = {
+            user_id for user_id, extras in self._extras.items() if USER_INACTIVE_KEY in extras
+        }
+        return [
+            user_id
+            for user_id, inactive_since in zip(self._ids, self._days[USER_INACTIVE_KEY])
+            if not inactive_since and user_id not in inactive_extras
+        ]
+
+    # Старый формат: {"<id>": {"<тип>": "<значение>"}}, как в single_card_usage.json.
+    @classmethod
+    def from_usage(cls, usage: Dict[str, Dict[str, str]]) -> "_UserRegistry":
+        parsed = {_parse_user_id(user_id): values for user_id, values in usage.items()}
+        parsed.pop(None, None)
+
+        registry = cls(parsed)
+        for user_id, values in parsed.items():
+            for key, value in values.items():
+                registry.set(user_id, key, value)
+        return registry
+
+    def to_usage(self) -> Dict[str, Dict[str, str]]:
+        return {str(user_id): self.get_user(user_id) for user_id in self._ids}
+
+    # Двоичный формат: заголовок, столбцы массивов в little-endian и JSON с _extras.
+    def dump(self, f) -> None:
+        f.write(USER_REGISTRY_MAGIC)
+        f.write(struct.pack("<HI", USER_REGISTRY_VERSION, len(self._ids)))
+        for column in self._columns():
+            if sys.byteorder != "little":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+        extras = json.dumps(
+            {str(user_id): values for user_id, values in self._extras.items()},
+            ensure_ascii=False,
+        ).encode("utf-8")
+        f.write(struct.pack("<I", len(extras)))
+        f.write(extras)
+
+    @classmethod
+    def load(cls, f) -> "_UserRegistry":
+        if f.read(len(USER_REGISTRY_MAGIC)) != USER_REGISTRY_MAGIC:
+            raise ValueError("это не файл реестра пользователей")
+        version, count = struct.unpack("<HI", f.read(6))
+        if not 1 <= version <= USER_REGISTRY_VERSION:
+            raise ValueError(f"неизвестная версия реестра пользователей: {version}")
+
+        registry = cls()
+        # В версии 1 ещё не было столбца last_seen, до версии 3 — подписки на карту дня.
+        stored_fields = [
+            field for field in _USER_DAY_FIELDS if version > 1 or field != USER_LAST_SEEN_KEY
+        ]
+        columns = [
+            registry._ids,
+            *(registry._days[field] for field in stored_fields),
+            registry._cursor_seeds,
+            registry._cursor_indexes,
+        ]
+        if version >= 3:
+            columns.append(registry._push_slots)
+        for column in columns:
+            data = f.read(column.itemsize * count)
+            if len(data) != column.itemsize * count:
+                raise ValueError("файл реестра пользователей обрезан")
+            column.frombytes(data)
+            if sys.byteorder != "little":
+                column.byteswap()
+        for field in _USER_DAY_FIELDS:
+            if field not in stored_fields:
+                registry._days[field].frombytes(bytes(2 * count))
+        if version < 3:
+            registry._push_slots.frombytes(bytes(count))
+
+        (extras_size,) = struct.unpack("<I", f.read(4))
+        extras = json.loads(f.read(extras_size).decode("utf-8"))
+        registry._extras = {int(user_id): values for user_id, values in extras.items()}
+        return registry
+
+
+_user_registry = _UserRegistry()
+_usage_lock = _TimedLock("usage")
+_daily_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = _TimedLock("stats")
+_stats_flush_lock = threading.Lock()
+_stats_flush_requested = threading.Event()
+# Приращения, ещё не сложенные с файлом дня. Файл пополняется, а не
+# перезаписывается, поэтому счётчики нескольких процессов не теряются.
+_stats_pending_deltas: dict[str, Counter[str]] = {}
+_stats_pending_increments = 0
+
+# Счётчики статистики копятся в памяти и сбрасываются на диск не реже, чем
+# раз в STATS_FLUSH_INTERVAL_SECONDS, либо после STATS_FLUSH_MAX_PENDING
+# нажатий — при падении процесса теряется не больше этого окна.
+STATS_FLUSH_INTERVAL_SECONDS = float(os.getenv("STATS_FLUSH_INTERVAL_SECONDS", "5"))
+STATS_FLUSH_MAX_PENDING = int(os.getenv("STATS_FLUSH_MAX_PENDING", "500"))
+
+
+DAILY_EVENT_START = "start"
+DAILY_EVENT_SINGLE_CARD_BUTTON = "single_card_button"
+DAILY_EVENT_SINGLE_CARD_READING = "single_card_reading"
+DAILY_EVENT_TWO_CARDS_READING = "two_cards_reading"
+DAILY_EVENT_THREE_CARDS_BUTTON = "three_cards_button"
+DAILY_EVENT_THREE_CARDS_READING = "three_cards_reading"
+DAILY_EVENT_YES_NO_BUTTON = "yes_no_button"
+DAILY_EVENT_YES_NO_READING = "yes_no_reading"
+DAILY_EVENT_CONSULTATION_CLICK = "consultation_click"
+DAILY_EVENT_CONSULTATION_PAID = "consultation_paid"
+
+
+DAILY_EVENT_LABELS = {
+    DAILY_EVENT_START: "Команда /start",
+    DAILY_EVENT_SINGLE_CARD_BUTTON: "Нажатия «Одна карта»",
+    DAILY_EVENT_SINGLE_CARD_READING: "Расклады на одну карту",
+    DAILY_EVENT_TWO_CARDS_READING: "Расклады на две карты",
+    DAILY_EVENT_THREE_CARDS_BUTTON: "Нажатия «Три карты»",
+    DAILY_EVENT_THREE_CARDS_READING: "Расклады на три карты",
+    DAILY_EVENT_YES_NO_BUTTON: "Нажатия «Ответ да/нет»",
+    DAILY_EVENT_YES_NO_READING: "Ответы да/нет",
+    DAILY_EVENT_CONSULTATION_CLICK: "Клики «Получить консультацию»",
+    DAILY_EVENT_CONSULTATION_PAID: "Оплаты консультации",
 }
 
-_RANK_IMAGE_MAP = {
-    "туз": "ace",
-    "двойка": "two",
-    "тройка": "three",
-    "четверка": "four",
-    "пятерка": "five",
-    "шестерка": "six",
-    "семерка": "seven",
-    "восьмерка": "eight",
-    "девятка": "nine",
-    "десятка": "ten",
-    "паж": "page",
-    "рыцарь": "knight",
-    "королева": "queen",
-    "король": "king",
-}
 
-_SUIT_IMAGE_MAP = {
-    "жезлов": "wands",
-    "жезла": "wands",
-    "жезлы": "wands",
-    "кубков": "cups",
-    "кубки": "cups",
-    "кубка": "cups",
-    "мечей": "swords",
-    "мечи": "swords",
-    "меча": "swords",
-    "пентакли": "pentacles",
-    "пентаклей": "pentacles",
-    "пентакля": "pentacles",
-}
+def _read_usage_json(path: str) -> Dict[str, Dict[str, str]]:
+    """Читает историю вытягивания карт из JSON-файла старого формата."""
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(
+            f"Не удалось загрузить историю вытягивания карт: {exc}",
+            flush=True,
+        )
+        return {}
+
+    if not isinstance(data, dict):
+        return {}
+
+    normalized: Dict[str, Dict[str, str]] = {}
+
+    for user_id, value in data.items():
+        str_user_id = str(user_id)
+
+        if isinstance(value, dict):
+            normalized[str_user_id] = {
+                str(key): str(date_str)
+                for key, date_str in value.items()
+                if isinstance(key, str) and isinstance(date_str, str)
+            }
+            continue
+
+        if isinstance(value, str):
+            normalized[str_user_id] = {READING_TYPE_SINGLE: value}
+
+    return normalized
+
+
+class _JsonUsageStore:
+    """Старое хранилище: весь словарь переписывается в JSON при каждом событии."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file_lock = threading.Lock()
+
+    def load(self) -> _UserRegistry:
+        return _UserRegistry.from_usage(_read_usage_json(self.path))
+
+    def load_user(self, user_id: str) -> Dict[str, str] | None:
+        return self.load().get_user(int(user_id))
+
+    def _save(self) -> None:
+        with _usage_lock:
+            snapshot = _user_registry.to_usage()
+
+        with self._file_lock:
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.path)
+            except OSError as exc:
+                print(
+                    f"Не удалось сохранить историю вытягивания карт: {exc}",
+                    flush=True,
+                )
+
+    def register_user(self, user_id: str) -> None:
+        self._save()
+
+    def record_reading(self, user_id: str, reading_type: str, date_str: str) -> None:
+        self._save()
+
+    def forget_reading(self, user_id: str, reading_type: str) -> None:
+        self._save()
+
+    def release_reading(
+        self, user_id: str, reading_type: str, date_str: str, previous: str | None
+    ) -> None:
+        self._save()
+
+    def record_many(self, rows: list[tuple[str, str, str]]) -> None:
+        self._save()
+
+    def save_deck_cursors(self, rows: list[tuple[str, int, int]]) -> None:
+        self._save()
+
+    def set_card_of_day_push(self, user_id: str, utc_offset: str | None) -> None:
+        self._save()
+
+    def forget_users(self, expected: Dict[str, Dict[str, str]]) -> list[str]:
+        # Файл — снимок памяти, а там пользователей уже сверили и удалили.
+        self._save()
+        return list(expected)
+
+    def close(self) -> None:
+        pass
+
+
+class _BinaryUsageStore(_JsonUsageStore):
+    """Полная перезапись, как у JSON, но файл в несколько раз меньше и пишется одним куском."""
+
+    def __init__(self, path: str, legacy_json_path: str | None = None) -> None:
+        super().__init__(path)
+        self.legacy_json_path = legacy_json_path
+
+    def load(self) -> _UserRegistry:
+        if not os.path.exists(self.path):
+            if self.legacy_json_path and os.path.exists(self.legacy_json_path):
+                print(f"Реестр пользователей переносим из {self.legacy_json_path}.", flush=True)
+                return _UserRegistry.from_usage(_read_usage_json(self.legacy_json_path))
+            return _UserRegistry()
+
+        try:
+            with open(self.path, "rb") as f:
+                return _UserRegistry.load(f)
+        except (OSError, ValueError, struct.error) as exc:
+            print(f"Не удалось загрузить реестр пользователей: {exc}", flush=True)
+            return _UserRegistry()
+
+    def _save(self) -> None:
+        # Под _usage_lock только копирование массивов в буфер, запись — уже без него.
+        buffer = io.BytesIO()
+        with _usage_lock:
+            _user_registry.dump(buffer)
+
+        with self._file_lock:
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(buffer.getbuffer())
+                os.replace(tmp_path, self.path)
+            except OSError as exc:
+                print(
+                    f"Не удалось сохранить историю вытягивания карт: {exc}",
+                    flush=True,
+                )
+
+
+class _SqliteUsageStore:
+    """Хранилище в SQLite (WAL): каждое событие — одна маленькая запись."""
+
+    def __init__(self, path: str, legacy_json_path: str | None = None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=10
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS readings (
+                user_id TEXT NOT NULL,
+                reading_type TEXT NOT NULL,
+                date TEXT NOT NULL,
+                PRIMARY KEY (user_id, reading_type)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS deck_cursors (
+                user_id TEXT PRIMARY KEY,
+                seed INTEGER NOT NULL,
+                position INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS card_of_day_push (
+                user_id TEXT PRIMARY KEY,
+                utc_offset TEXT NOT NULL
+            );
+            """
+        )
+        self._move_out_of_readings(DECK_CURSOR_KEY)
+        self._move_out_of_readings(USER_CARD_OF_DAY_PUSH_KEY)
+        if legacy_json_path:
+            self._import_legacy_json(legacy_json_path)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Транзакция записи; вызывать под self._lock.
+
+        BEGIN IMMEDIATE сразу берёт блокировку записи (и ждёт её до timeout),
+        а при любой ошибке делаем ROLLBACK — иначе соединение осталось бы
+        в открытой транзакции и все следующие записи падали бы.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _write_rows(self, rows: list[tuple[str, str, str]]) -> None:
+        """Раскладывает строки (user_id, ключ, значение) по таблицам; вызывать в транзакции."""
+        readings, cursors, pushes = [], [], []
+        for user_id, key, value in rows:
+            if key == DECK_CURSOR_KEY:
+                cursor = _encode_deck_cursor(value)
+                if cursor is not None:
+                    cursors.append((user_id, *cursor))
+            elif key == USER_CARD_OF_DAY_PUSH_KEY:
+                pushes.append((user_id, value))
+            else:
+                readings.append((user_id, key, value))
+
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+            ((user_id,) for user_id, _, _ in rows),
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO readings (user_id, reading_type, date) VALUES (?, ?, ?)",
+            readings,
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO deck_cursors (user_id, seed, position) VALUES (?, ?, ?)",
+            cursors,
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO card_of_day_push (user_id, utc_offset) VALUES (?, ?)",
+            pushes,
+        )
+
+    def _move_out_of_readings(self, key: str) -> None:
+        """Один раз переносит key из readings, где он раньше лежал под видом даты, в свою таблицу."""
+        meta_key = f"moved_out_of_readings:{key}"
+        with self._lock, self._transaction():
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = ?", (meta_key,)).fetchone():
+                return
+            rows = self._conn.execute(
+                "SELECT user_id, reading_type, date FROM readings WHERE reading_type = ?", (key,)
+            ).fetchall()
+            self._write_rows(rows)
+            self._conn.execute("DELETE FROM readings WHERE reading_type = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                (meta_key, datetime.now(timezone.utc).isoformat()),
+            )
+
+    def _import_legacy_json(self, json_path: str) -> None:
+        """Один раз переносит данные из single_card_usage.json."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_json_imported'"
+            ).fetchone()
+            if row is not None:
+                return
+
+            data = _read_usage_json(json_path)
+            with self._transaction():
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                    ((user_id,) for user_id in data),
+                )
+                self._write_rows(
+                    [
+                        (user_id, reading_type, date_str)
+                        for user_id, usage in data.items()
+                        for reading_type, date_str in usage.items()
+                    ]
+                )
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('legacy_json_imported', ?)",
+                    (datetime.now(timezone.utc).isoformat(),),
+                )
+
+        if data:
+            print(
+                f"История вытягивания карт перенесена из {json_path} в SQLite: "
+                f"{len(data)} пользователей.",
+                flush=True,
+            )
+
+    def load(self) -> _UserRegistry:
+        # Строки читаем потоком прямо в массивы реестра, без промежуточных словарей.
+        with self._lock:
+            registry = _UserRegistry(
+                user_id
+                for (raw_id,) in self._conn.execute("SELECT user_id FROM users")
+                if (user_id := _parse_user_id(raw_id)) is not None
+            )
+            for raw_id, reading_type, date_str in self._conn.execute(
+                "SELECT user_id, reading_type, date FROM readings"
+            ):
+                user_id = _parse_user_id(raw_id)
+                if user_id is not None:
+                    registry.set(user_id, reading_type, date_str)
+            for raw_id, seed, position in self._conn.execute(
+                "SELECT user_id, seed, position FROM deck_cursors JOIN users USING (user_id)"
+            ):
+                user_id = _parse_user_id(raw_id)
+                if user_id is not None:
+                    registry.set(user_id, DECK_CURSOR_KEY, f"{seed}:{position}")
+            for raw_id, utc_offset in self._conn.execute(
+                "SELECT user_id, utc_offset FROM card_of_day_push JOIN users USING (user_id)"
+            ):
+                user_id = _parse_user_id(raw_id)
+                if user_id is not None:
+                    registry.set(user_id, USER_CARD_OF_DAY_PUSH_KEY, utc_offset)
+        return registry
+
+    def load_user(self, user_id: str) -> Dict[str, str] | None:
+        with self._lock:
+            known = self._conn.execute(
+                "SELECT 1 FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            readings = self._conn.execute(
+                "SELECT reading_type, date FROM readings WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            cursor = self._conn.execute(
+                "SELECT seed, position FROM deck_cursors WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            push = self._conn.execute(
+                "SELECT utc_offset FROM card_of_day_push WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+        if known is None and not readings:
+            return None
+        usage = dict(readings)
+        if cursor is not None:
+            usage[DECK_CURSOR_KEY] = f"{cursor[0]}:{cursor[1]}"
+        if push is not None:
+            usage[USER_CARD_OF_DAY_PUSH_KEY] = push[0]
+        return usage
+
+    def register_user(self, user_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)
+            )
+
+    def record_reading(self, user_id: str, reading_type: str, date_str: str) -> None:
+        with self._lock, self._transaction():
+            self._write_rows([(user_id, reading_type, date_str)])
+
+    def forget_reading(self, user_id: str, reading_type: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM readings WHERE user_id = ? AND reading_type = ?",
+                (user_id, reading_type),
+            )
+
+    def record_many(self, rows: list[tuple[str, str, str]]) -> None:
+        """Пакетная record_reading: (user_id, reading_type, date) одной транзакцией."""
+        with self._lock, self._transaction():
+            self._write_rows(rows)
+
+    def save_deck_cursors(self, rows: list[tuple[str, int, int]]) -> None:
+        """Сохраняет положения в колоде: (user_id, seed, position) одной транзакцией."""
+        with self._lock, self._transaction():
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                ((user_id,) for user_id, _, _ in rows),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deck_cursors (user_id, seed, position) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def set_card_of_day_push(self, user_id: str, utc_offset: str | None) -> None:
+        """Подписывает на карту дня в часовом поясе utc_offset ("+03:00"); None — отписка."""
+        with self._lock, self._transaction():
+            if utc_offset is None:
+                self._conn.execute("DELETE FROM card_of_day_push WHERE user_id = ?", (user_id,))
+                return
+            self._conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO card_of_day_push (user_id, utc_offset) VALUES (?, ?)",
+                (user_id, utc_offset),
+            )
+
+    def forget_users(self, expected: Dict[str, Dict[str, str]]) -> list[str]:
+        """Удаляет пользователей, чьи даты в базе всё ещё равны expected.
+
+        Проверка и удаление идут в одной транзакции: если пользователь успел
+        снова появиться (в том числе через другой процесс), его даты уже
+        другие, и он остаётся. Возвращает тех, кого удалили.
+        """
+        query = (
+            "SELECT reading_type, date FROM readings WHERE user_id = ? AND reading_type IN "
+            f"({', '.join('?' * len(_USER_DAY_FIELDS))})"
+        )
+        items = list(expected.items())
+        forgotten = []
+        # Пачками, чтобы не держать блокировку записи на всё время архивации.
+        for start in range(0, len(items), USERS_FORGET_BATCH_SIZE):
+            with self._lock, self._transaction():
+                batch = [
+                    (user_id,)
+                    for user_id, days in items[start:start + USERS_FORGET_BATCH_SIZE]
+                    if dict(self._conn.execute(query, (user_id, *_USER_DAY_FIELDS))) == days
+                ]
+                self._conn.executemany("DELETE FROM readings WHERE user_id = ?", batch)
+                self._conn.executemany("DELETE FROM deck_cursors WHERE user_id = ?", batch)
+                self._conn.executemany("DELETE FROM card_of_day_push WHERE user_id = ?", batch)
+                self._conn.executemany("DELETE FROM users WHERE user_id = ?", batch)
+            forgotten.extend(user_id for (user_id,) in batch)
+        return forgotten
+
+    def reserve_reading(
+        self, user_id: str, reading_type: str, date_str: str
+    ) -> tuple[bool, str | None]:
+        """Атомарно занимает расклад на date_str; возвращает (успех, прежняя дата).
+
+        BEGIN IMMEDIATE берёт блокировку записи сразу, поэтому проверку и
+        отметку не разорвут ни другие потоки, ни другие процессы.
+        """
+        with self._lock, self._transaction():
+            row = self._conn.execute(
+                "SELECT date FROM readings WHERE user_id = ? AND reading_type = ?",
+                (user_id, reading_type),
+            ).fetchone()
+            previous = row[0] if row else None
+            if previous == date_str:
+                return False, previous
+
+            self._conn.execute(
+                "INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO readings (user_id, reading_type, date) VALUES (?, ?, ?)",
+                (user_id, reading_type, date_str),
+            )
+        return True, previous
+
+    def release_reading(
+        self, user_id: str, reading_type: str, date_str: str, previous: str | None
+    ) -> None:
+        """Возвращает слот, если его никто не занял заново после reserve_reading."""
+        with self._lock, self._transaction():
+            if previous is None:
+                self._conn.execute(
+                    "DELETE FROM readings WHERE user_id = ? AND reading_type = ? AND date = ?",
+                    (user_id, reading_type, date_str),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE readings SET date = ? WHERE user_id = ? AND reading_type = ? AND date = ?",
+                    (previous, user_id, reading_type, date_str),
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _create_usage_store():
+    if USAGE_STORE_BACKEND in ("json", "binary"):
+        if not _is_shared_state():
+            if USAGE_STORE_BACKEND == "binary":
+                return _BinaryUsageStore(USAGE_BINARY_PATH, legacy_json_path=USAGE_STORAGE_PATH)
+            return _JsonUsageStore(USAGE_STORAGE_PATH)
+        # Файл переписывается целиком — процессы затирали бы друг друга.
+        print("STATE_BACKEND=shared: историю раскладов храним в SQLite.", flush=True)
+
+    if USAGE_STORE_BACKEND != "sqlite":
+        print(
+            f"Неизвестное хранилище истории «{USAGE_STORE_BACKEND}», используем sqlite.",
+            flush=True,
+        )
+
+    try:
+        return _SqliteUsageStore(USAGE_DB_PATH, legacy_json_path=USAGE_STORAGE_PATH)
+    except sqlite3.Error as exc:
+        print(
+            f"Не удалось открыть SQLite-хранилище истории, используем JSON: {exc}",
+            flush=True,
+        )
+        return _JsonUsageStore(USAGE_STORAGE_PATH)
+
+
+def _load_user_registry() -> None:
+    """Загружает историю вытягивания карт из хранилища.
+
+    При ошибке остаётся то, что уже было в памяти.
+    """
+    global _user_registry
+
+    try:
+        loaded = _usage_store.load()
+    except sqlite3.Error as exc:
+        print(
+            f"Не удалось загрузить историю вытягивания карт: {exc}",
+            flush=True,
+        )
+        return
+
+    with _usage_lock:
+        _user_registry = loaded
+
+
+if _RUNNING_CLI_COMMAND:
+    _usage_store = None
+else:
+    _usage_store = _create_usage_store()
+    _load_user_registry()
+
+
+def _convert_usage_file(source: str, target: str) -> int:
+    """`python bot.py usage-convert SRC DST`: JSON, SQLite → JSON или двоичный реестр.
+
+    Формат определяется по расширению: .json, .sqlite3, остальное — двоичный.
+    """
+    if not os.path.exists(source):
+        print(f"Файл {source} не найден.", flush=True)
+        return 1
+
+    try:
+        if source.endswith(".json"):
+            registry = _UserRegistry.from_usage(_read_usage_json(source))
+        elif source.endswith(".sqlite3"):
+            store = _SqliteUsageStore(source)
+            registry = store.load()
+            store.close()
+        else:
+            with open(source, "rb") as f:
+                registry = _UserRegistry.load(f)
+
+        tmp_path = f"{target}.tmp"
+        if target.endswith(".json"):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(registry.to_usage(), f, ensure_ascii=False, indent=2)
+        else:
+            with open(tmp_path, "wb") as f:
+                registry.dump(f)
+        os.replace(tmp_path, target)
+    except (OSError, ValueError, struct.error, sqlite3.Error) as exc:
+        print(f"Не удалось перенести историю из {source} в {target}: {exc}", flush=True)
+        return 1
+
+    print(f"Перенесено пользователей: {len(registry)} ({source} → {target}).", flush=True)
+    return 0
+
+
+def _get_daily_stats_file_path(date_str: str) -> str:
+    return os.path.join(STATS_DIR, f"{date_str}.json")
+
+
+def _load_daily_stats_for_date(date_str: str) -> dict[str, int]:
+    path = _get_daily_stats_file_path(date_str)
+
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw_data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(
+            f"Не удалось загрузить статистику за {date_str}: {exc}",
+            flush=True,
+        )
+        return {}
+
+    if not isinstance(raw_data, dict):
+        return {}
+
+    normalized: dict[str, int] = {}
+    for key, value in raw_data.items():
+        if isinstance(key, str) and isinstance(value, int):
+            normalized[key] = value
+
+    return normalized
+
+
+def _save_daily_stats(date_str: str, data: dict[str, int]) -> bool:
+    path = _get_daily_stats_file_path(date_str)
+    tmp_path = f"{path}.tmp"
+
+    try:
+        os.makedirs(STATS_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        print(
+            f"Не удалось сохранить статистику за {date_str}: {exc}",
+            flush=True,
+        )
+        return False
+
+    return True
+
+
+def _initialize_daily_stats() -> None:
+    try:
+        os.makedirs(STATS_DIR, exist_ok=True)
+    except OSError as exc:
+        print(f"Не удалось создать директорию статистики: {exc}", flush=True)
+        return
+
+    today = datetime.now(timezone.utc).date().isoformat()
+    with _stats_lock:
+        _daily_stats[today] = _load_daily_stats_for_date(today)
+
+
+def _increment_daily_event(event_name: str) -> None:
+    """Увеличивает счётчик в памяти; на диск он попадёт при ближайшем сбросе."""
+    global _stats_pending_increments
+
+    today = datetime.now(timezone.utc).date().isoformat()
+
+    with _stats_lock:
+        stats = _daily_stats.get(today)
+        if stats is None:
+            # Наступили новые сутки по UTC: вчерашние счётчики остаются
+            # в памяти до сброса, чтобы не потерять последние нажатия.
+            stats = _load_daily_stats_for_date(today)
+            _daily_stats[today] = stats
+            _stats_flush_requested.set()
+
+        stats[event_name] = stats.get(event_name, 0) + 1
+        _stats_pending_deltas.setdefault(today, Counter())[event_name] += 1
+        _stats_pending_increments += 1
+
+        if _stats_pending_increments >= STATS_FLUSH_MAX_PENDING:
+            _stats_flush_requested.set()
+
+
+def _get_stats_lock_path() -> str:
+    return os.path.join(STATS_DIR, ".lock")
+
+
+def _flush_daily_stats() -> None:
+    """Добавляет накопленные приращения к файлам дней и забывает закрытые дни."""
+    global _stats_pending_increments
+
+    with _stats_flush_lock, _observe_duration(_persist_seconds, "daily_stats"):
+        today = datetime.now(timezone.utc).date().isoformat()
+
+        with _stats_lock:
+            deltas = dict(_stats_pending_deltas)
+            _stats_pending_deltas.clear()
+            _stats_pending_increments = 0
+
+        dates = set(deltas)
+        if _is_shared_state():
+            # Подтягиваем нажатия, которые записали другие процессы.
+            dates.add(today)
+
+        merged: dict[str, Counter[str]] = {}
+        failed: dict[str, Counter[str]] = {}
+        with _interprocess_lock(_get_stats_lock_path()):
+            for date_str in dates:
+                stored = Counter(_load_daily_stats_for_date(date_str))
+                delta = deltas.get(date_str)
+                if delta:
+                    stored.update(delta)
+                    if not _save_daily_stats(date_str, dict(stored)):
+                        failed[date_str] = delta
+                        continue
+                merged[date_str] = stored
+
+        with _stats_lock:
+            for date_str, delta in failed.items():
+                _stats_pending_deltas.setdefault(date_str, Counter()).update(delta)
+            for date_str, stored in merged.items():
+                if date_str in _daily_stats:
+                    # Файл уже содержит наши приращения, добавляем только
+                    # пришедшие за время записи.
+                    stored.update(_stats_pending_deltas.get(date_str, {}))
+                    _daily_stats[date_str] = dict(stored)
+            closed_dates = [
+                stored_date
+                for stored_date in _daily_stats
+                if stored_date != today and stored_date not in _stats_pending_deltas
+            ]
+            for stored_date in closed_dates:
+                _daily_stats.pop(stored_date, None)
+
+    if closed_dates:
+        _roll_up_closed_days()
+
+
+def _stats_flush_loop() -> None:
+    while True:
+        _stats_flush_requested.wait(STATS_FLUSH_INTERVAL_SECONDS)
+        _stats_flush_requested.clear()
+        try:
+            _flush_daily_stats()
+        except Exception as exc:  # noqa: BLE001 - поток сброса не должен умирать
+            print(f"Ошибка сброса статистики: {exc}", flush=True)
+
+
+def _start_stats_flusher() -> None:
+    thread = threading.Thread(target=_stats_flush_loop, name="stats-flusher", daemon=True)
+    thread.start()
+    atexit.register(_flush_daily_stats)
+
+
+def _get_daily_stats(date_str: str) -> dict[str, int]:
+    """Возвращает статистику за день с учётом ещё не сброшенных счётчиков."""
+    with _stats_lock:
+        stats = _daily_stats.get(date_str)
+        if stats is not None:
+            return dict(stats)
+
+    return _load_daily_stats_for_date(date_str)
+
+
+def _format_event_label(event_name: str) -> str:
+    return DAILY_EVENT_LABELS.get(event_name, event_name)
+
+
+def _format_daily_stats(date_str: str, stats: dict[str, int]) -> str:
+    if not stats:
+        return f"За {date_str} пока нет записей."
+
+    lines = [f"📊 Статистика за {date_str}:"]
+
+    for event_name, count in sorted(stats.items()):
+        lines.append(f"• {_format_event_label(event_name)}: {count}")
+
+    return "\n".join(lines)
+
+
+# === Сводная статистика ===
+# Когда день закрывается, его счётчики один раз добавляются в сводки по
+# неделям и месяцам и в накопительные суммы по датам. Поэтому период любой
+# длины считается двумя поисками по отсортированному списку дней, а не по
+# файлу на каждый день.
+# День сворачивается не сразу после полуночи, а спустя STATS_ROLLUP_GRACE_DAYS:
+# другие процессы могут ещё досбрасывать в него последние нажатия.
+STATS_ROLLUP_GRACE_DAYS = int(os.getenv("STATS_ROLLUP_GRACE_DAYS", "1"))
+# Версия 2: накопительные суммы — строки чисел в порядке списка events,
+# а не словарь на каждый день.
+STATS_ROLLUP_VERSION = 2
+_stats_rollup_lock = threading.Lock()
+# Свёрнутые дни больше не меняются, так что сводки держим в памяти и
+# перечитываем с диска, только когда закрылся очередной день.
+_stats_rollups: dict | None = None
+
+
+def _get_stats_rollup_path() -> str:
+    # Отдельная папка, чтобы сводки не путались с файлами дней при выгрузке.
+    return os.path.join(STATS_DIR, "rollups", "rollups.json")
+
+
+def _week_key(day: date) -> str:
+    iso = day.isocalendar()
+    return f"{iso.year}-W{iso.week:02d}"
+
+
+def _empty_stats_rollups() -> dict:
+    return {
+        "version": STATS_ROLLUP_VERSION,
+        # Последний день, который уже свёрнут (или проверен и пуст).
+        "checked_through": None,
+        "events": [],
+        "days": [],
+        "cumulative": [],
+        "weeks": {},
+        "months": {},
+    }
+
+
+def _upgrade_stats_rollups(data: dict) -> dict:
+    """Версия 1 хранила накопительные суммы словарём {день: {событие: число}}."""
+    cumulative = data.get("cumulative") if isinstance(data.get("cumulative"), dict) else {}
+    rollups = _empty_stats_rollups()
+    rollups["checked_through"] = data.get("closed_through")
+    rollups["events"] = sorted({name for totals in cumulative.values() for name in totals})
+    rollups["days"] = sorted(cumulative)
+    rollups["cumulative"] = [
+        [cumulative[day].get(name, 0) for name in rollups["events"]] for day in rollups["days"]
+    ]
+    for key in ("weeks", "months"):
+        if isinstance(data.get(key), dict):
+            rollups[key] = data[key]
+    return rollups
+
+
+def _load_stats_rollups() -> dict:
+    path = _get_stats_rollup_path()
+
+    if not os.path.exists(path):
+        return _empty_stats_rollups()
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось загрузить сводную статистику: {exc}", flush=True)
+        return _empty_stats_rollups()
+
+    if not isinstance(data, dict):
+        return _empty_stats_rollups()
+    if data.get("version") != STATS_ROLLUP_VERSION:
+        # Читаем под замком статистики, так что переписать файл здесь безопасно.
+        rollups = _upgrade_stats_rollups(data)
+        _save_stats_rollups(rollups)
+        return rollups
+
+    rollups = _empty_stats_rollups()
+    rollups.update(data)
+    return rollups
+
+
+def _save_stats_rollups(rollups: dict) -> None:
+    path = _get_stats_rollup_path()
+    tmp_path = f"{path}.tmp"
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _observe_duration(_persist_seconds, "stats_rollups"):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(rollups, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+    except OSError as exc:
+        print(f"Не удалось сохранить сводную статистику: {exc}", flush=True)
+
+
+def _get_rollup_cutoff() -> date:
+    """Первый день, который ещё не сворачивается в сводки."""
+    return datetime.now(timezone.utc).date() - timedelta(days=STATS_ROLLUP_GRACE_DAYS)
+
+
+def _closed_days_to_roll_up(checked_through: str | None, last_closed: date) -> list[str]:
+    """Дни с файлами статистики после checked_through по last_closed включительно."""
+    if checked_through is None:
+        # Сводок ещё нет: один раз просматриваем папку целиком.
+        if not os.path.isdir(STATS_DIR):
+            return []
+        return sorted(
+            entry[:-5]
+            for entry in os.listdir(STATS_DIR)
+            if entry.endswith(".json") and entry[:-5] <= last_closed.isoformat()
+        )
+
+    # Обычно это один день, закрывшийся с прошлого раза.
+    pending = []
+    day = date.fromisoformat(checked_through) + timedelta(days=1)
+    while day <= last_closed:
+        if os.path.exists(_get_daily_stats_file_path(day.isoformat())):
+            pending.append(day.isoformat())
+        day += timedelta(days=1)
+    return pending
+
+
+def _add_days_to_rollups(rollups: dict, pending: list[str]) -> None:
+    """Сворачивает дни pending (по возрастанию) в недели, месяцы и накопительные суммы."""
+    events = rollups["events"]
+    columns = {name: index for index, name in enumerate(events)}
+    running = list(rollups["cumulative"][-1]) if rollups["cumulative"] else []
+
+    for date_str in pending:
+        try:
+            day = date.fromisoformat(date_str)
+        except ValueError:
+            continue
+
+        stats = _load_daily_stats_for_date(date_str)
+        for event_name, count in stats.items():
+            if event_name not in columns:
+                columns[event_name] = len(events)
+                events.append(event_name)
+            running.extend([0] * (len(events) - len(running)))
+            running[columns[event_name]] += count
+        rollups["days"].append(date_str)
+        rollups["cumulative"].append(list(running))
+
+        for bucket, key in (
+            (rollups["weeks"], _week_key(day)),
+            (rollups["months"], date_str[:7]),
+        ):
+            totals = Counter(bucket.get(key, {}))
+            totals.update(stats)
+            bucket[key] = dict(totals)
+
+
+def _roll_up_closed_days() -> dict:
+    """Добавляет в сводки дни, закрывшиеся с прошлого раза, и возвращает сводки."""
+    global _stats_rollups
+
+    last_closed = _get_rollup_cutoff() - timedelta(days=1)
+
+    with _stats_rollup_lock:
+        rollups = _stats_rollups
+        if rollups is not None and (rollups["checked_through"] or "") >= last_closed.isoformat():
+            return rollups
+
+        # Сводки перечитываются с диска: их мог уже обновить другой процесс.
+        with _interprocess_lock(_get_stats_lock_path()):
+            rollups = _load_stats_rollups()
+            if (rollups["checked_through"] or "") < last_closed.isoformat():
+                _add_days_to_rollups(
+                    rollups, _closed_days_to_roll_up(rollups["checked_through"], last_closed)
+                )
+                rollups["checked_through"] = last_closed.isoformat()
+                _save_stats_rollups(rollups)
+
+        _stats_rollups = rollups
+        return rollups
+
+
+def _cumulative_through(rollups: dict, date_str: str) -> Counter[str]:
+    """Накопительные суммы по указанную дату включительно."""
+    position = bisect.bisect_right(rollups["days"], date_str)
+    if position == 0:
+        return Counter()
+    return Counter(dict(zip(rollups["events"], rollups["cumulative"][position - 1])))
+
+
+def _sum_unrolled_days(rollups: dict, start: date, end: date) -> Counter[str]:
+    """Дни периода, ещё не попавшие в сводки, — из памяти или по файлам дней.
+
+    Это не больше STATS_ROLLUP_GRACE_DAYS + 1 дней. Сегодняшние нажатия этого
+    процесса берутся из памяти, так что сбрасывать статистику перед отчётом
+    не нужно; нажатия других процессов видны после их очередного сброса.
+    """
+    first = max(start, _get_rollup_cutoff())
+    checked_through = rollups["checked_through"]
+    if checked_through is not None:
+        first = max(first, date.fromisoformat(checked_through) + timedelta(days=1))
+    last = min(end, datetime.now(timezone.utc).date())
+
+    totals: Counter[str] = Counter()
+    day = first
+    while day <= last:
+        totals.update(_get_daily_stats(day.isoformat()))
+        day += timedelta(days=1)
+    return totals
+
+
+def _get_stats_for_period(start: date, end: date) -> dict[str, int]:
+    """Счётчики за период [start, end] включительно, сегодняшний день — из памяти."""
+    rollups = _roll_up_closed_days()
+
+    totals: Counter[str] = Counter()
+    checked_through = rollups["checked_through"]
+    if checked_through is not None:
+        closed_end = min(end, date.fromisoformat(checked_through))
+        if start <= closed_end:
+            totals = _cumulative_through(rollups, closed_end.isoformat())
+            totals.subtract(
+                _cumulative_through(rollups, (start - timedelta(days=1)).isoformat())
+            )
+
+    totals.update(_sum_unrolled_days(rollups, start, end))
+    return {event_name: count for event_name, count in totals.items() if count > 0}
+
+
+def _get_bucket_bounds(kind: str, key: str) -> tuple[date, date] | None:
+    try:
+        if kind == "weeks":
+            year, week = int(key[:4]), int(key[6:])
+            return date.fromisocalendar(year, week, 1), date.fromisocalendar(year, week, 7)
+
+        year, month = int(key[:4]), int(key[5:7])
+        next_month = date(year + month // 12, month % 12 + 1, 1)
+        return date(year, month, 1), next_month - timedelta(days=1)
+    except ValueError:
+        return None
+
+
+def _get_stats_for_bucket(kind: str, key: str) -> dict[str, int]:
+    """Счётчики за неделю («2026-W41») или месяц («2026-09»)."""
+    rollups = _roll_up_closed_days()
+    totals = Counter(rollups[kind].get(key, {}))
+
+    bounds = _get_bucket_bounds(kind, key)
+    if bounds is not None:
+        totals.update(_sum_unrolled_days(rollups, *bounds))
+
+    return dict(totals)
+
+
+_FUNNEL_STAGES = (
+    (
+        "Нажатия кнопок раскладов",
+        (
+            DAILY_EVENT_SINGLE_CARD_BUTTON,
+            DAILY_EVENT_THREE_CARDS_BUTTON,
+            DAILY_EVENT_YES_NO_BUTTON,
+        ),
+    ),
+    (
+        "Расклады",
+        (
+            DAILY_EVENT_SINGLE_CARD_READING,
+            DAILY_EVENT_TWO_CARDS_READING,
+            DAILY_EVENT_THREE_CARDS_READING,
+            DAILY_EVENT_YES_NO_READING,
+        ),
+    ),
+    ("Клики «Получить консультацию»", (DAILY_EVENT_CONSULTATION_CLICK,)),
+    ("Оплаты консультации", (DAILY_EVENT_CONSULTATION_PAID,)),
+)
+
+
+def _format_funnel(label: str, stats: dict[str, int]) -> str:
+    lines = [f"🔻 Воронка за {label}:"]
+    previous = None
+
+    for title, events in _FUNNEL_STAGES:
+        count = sum(stats.get(event_name, 0) for event_name in events)
+        line = f"• {title}: {count}"
+        if previous:
+            line += f" ({count / previous:.1%} от предыдущего шага)"
+        lines.append(line)
+        previous = count
+
+    return "\n".join(lines)
+
+
+def _resolve_stats_period(arg: str) -> tuple[str, dict[str, int]] | None:
+    """Понимает «7d», «30d», «2026-09» и «2026-W41»."""
+    today = datetime.now(timezone.utc).date()
+
+    if arg.endswith("d") and arg[:-1].isdigit() and int(arg[:-1]) > 0:
+        days = int(arg[:-1])
+        start = today - timedelta(days=days - 1)
+        return f"последние {days} дн.", _get_stats_for_period(start, today)
+
+    if len(arg) == 7 and arg[4] == "-" and arg[:4].isdigit() and arg[5:].isdigit():
+        return arg, _get_stats_for_bucket("months", arg)
+
+    upper = arg.upper()
+    if len(upper) == 8 and upper[4:6] == "-W" and upper[:4].isdigit() and upper[6:].isdigit():
+        return upper, _get_stats_for_bucket("weeks", upper)
+
+    return None
+
+
+STATS_EXPORT_WORKERS = int(os.getenv("STATS_EXPORT_WORKERS", "8"))
+# Выгрузка держится в памяти до этого размера, дальше уходит во временный файл.
+STATS_EXPORT_SPOOL_BYTES = 1024 * 1024
+
+# Прошедшие дни уже не меняются, поэтому их разобранные счётчики кэшируем
+# по (mtime, size) файла — пересчитывать приходится только сегодняшний день.
+_closed_day_stats_cache: Dict[str, tuple[tuple[int, int], dict[str, int]]] = {}
+_closed_day_stats_lock = threading.Lock()
+
+
+def _load_day_stats_for_export(date_str: str, today: str) -> dict[str, int]:
+    if date_str >= today:
+        return _get_daily_stats(date_str)
+
+    try:
+        stat = os.stat(_get_daily_stats_file_path(date_str))
+    except OSError:
+        return {}
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+
+    with _closed_day_stats_lock:
+        cached = _closed_day_stats_cache.get(date_str)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    stats = _load_daily_stats_for_date(date_str)
+    with _closed_day_stats_lock:
+        _closed_day_stats_cache[date_str] = (fingerprint, stats)
+    return stats
+
+
+def _parse_stats_date_range(raw: str) -> tuple[str | None, str | None]:
+    """Разбирает «ГГГГ-ММ-ДД..ГГГГ-ММ-ДД»; любая из границ может быть пустой."""
+    start_raw, separator, end_raw = raw.partition("..")
+    if not separator:
+        raise ValueError(raw)
+
+    start = datetime.fromisoformat(start_raw).date().isoformat() if start_raw else None
+    end = datetime.fromisoformat(end_raw).date().isoformat() if end_raw else None
+    if start and end and start > end:
+        raise ValueError(raw)
+    return start, end
+
+
+def _prepare_stats_csv(
+    start: str | None = None, end: str | None = None
+) -> tuple[str, tempfile.SpooledTemporaryFile, Counter[str]] | None:
+    """Готовит CSV за период. Вызывающий должен закрыть возвращённый файл."""
+    _flush_daily_stats()
+
+    if not os.path.isdir(STATS_DIR):
+        return None
+
+    dates = sorted(
+        entry[:-5]
+        for entry in os.listdir(STATS_DIR)
+        if entry.endswith(".json") and os.path.isfile(os.path.join(STATS_DIR, entry))
+    )
+    dates = [
+        date_str
+        for date_str in dates
+        if (start is None or date_str >= start) and (end is None or date_str <= end)
+    ]
+
+    if not dates:
+        return None
+
+    today = datetime.now(timezone.utc).date().isoformat()
+    totals: Counter[str] = Counter()
+    spooled = tempfile.SpooledTemporaryFile(max_size=STATS_EXPORT_SPOOL_BYTES, mode="w+b")
+    text_stream = io.TextIOWrapper(spooled, encoding="utf-8", newline="")
+    writer = csv.writer(text_stream)
+    writer.writerow(["date", "event", "count"])
+    has_rows = False
+
+    with ThreadPoolExecutor(max_workers=STATS_EXPORT_WORKERS) as executor:
+        # map сохраняет порядок дат, а файлы читаются параллельно.
+        day_stats = executor.map(lambda date_str: _load_day_stats_for_export(date_str, today), dates)
+        for date_part, stats in zip(dates, day_stats):
+            for event_name, count in stats.items():
+                writer.writerow([date_part, event_name, count])
+                totals[event_name] += count
+                has_rows = True
+
+    text_stream.flush()
+    text_stream.detach()
+
+    if not has_rows:
+        spooled.close()
+        return None
+
+    if start or end:
+        filename = f"stats_{start or dates[0]}_{end or dates[-1]}.csv"
+    else:
+        filename = "stats_export.csv"
+    spooled.seek(0)
+
+    return filename, spooled, totals
+
+
+if not _RUNNING_CLI_COMMAND:
+    _initialize_daily_stats()
+    _start_stats_flusher()
+
+# === Загрузка данных ===
+TAROT_DECK_FILE = "tarot_cards.json"
+TOPICS_FILE = "tarot_cards_topics.json"
+
+
+def _load_tarot_deck_json() -> tuple[dict, dict]:
+    """Читает колоду и тематические значения карт."""
+    with open(TAROT_DECK_FILE, "r", encoding="utf-8") as f:
+        deck = json.load(f)
+
+    if os.path.exists(TOPICS_FILE):
+        with open(TOPICS_FILE, "r", encoding="utf-8") as f:
+            return deck, json.load(f)
+
+    # Файл с темами может отсутствовать на некоторых развёртываниях.
+    # В этом случае используем данные из tarot_cards.json, если они
+    # уже содержат тематические значения.
+    topics = {}
+    for card_name, card_data in deck.items():
+        if isinstance(card_data, dict):
+            filtered_topics = {
+                topic: values
+                for topic, values in card_data.items()
+                if isinstance(values, list)
+            }
+            if filtered_topics:
+                topics[card_name] = filtered_topics
+
+    return deck, topics
+
+
+def _collect_all_meanings(card_data):
+    """Возвращает плоский список значений карты из любых доступных структур."""
+    if isinstance(card_data, list):
+        return [value for value in card_data if isinstance(value, str)]
+
+    if isinstance(card_data, dict):
+        collected = []
+        for values in card_data.values():
+            if isinstance(values, list):
+                collected.extend(v for v in values if isinstance(v, str))
+        return collected
+
+    return []
+
+
+TOPIC_TO_KEY = {
+    "❤️ Любовь": "love",
+    "💼 Карьера": "career",
+    "💰 Финансы": "finance",
+    "🧘‍♀️ Здоровье": "health",
+    "🧿 Совет дня": "advice",
+}
+
+THREE_CARDS_FILE = "combinations.json"
+CARD_OF_DAY_FILE = "cardoftheday.json"
+YES_NO_FILE = "yesnot.json"
+
+
+def _load_card_of_day_json() -> Dict[str, Dict[str, str]]:
+    try:
+        with open(CARD_OF_DAY_FILE, "r", encoding="utf-8") as f:
+            raw_card_of_day_data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось загрузить карты дня: {exc}", flush=True)
+        return {}
+
+    schedule: Dict[str, Dict[str, str]] = {}
+    if not isinstance(raw_card_of_day_data, dict):
+        return schedule
+
+    for date_key, payload in raw_card_of_day_data.items():
+        if not isinstance(date_key, str):
+            continue
+        if not isinstance(payload, dict):
+            continue
+        card = payload.get("card")
+        meaning = payload.get("meaning")
+        if isinstance(card, str) and isinstance(meaning, str):
+            schedule[date_key.strip()] = {
+                "card": card.strip(),
+                "meaning": meaning.strip(),
+            }
+
+    return schedule
+
+
+def _load_yes_no_json() -> Dict[str, str]:
+    if not os.path.exists(YES_NO_FILE):
+        return {}
+
+    try:
+        with open(YES_NO_FILE, "r", encoding="utf-8") as f:
+            return {
+                str(name): str(value)
+                for name, value in json.load(f).items()
+                if isinstance(name, str) and isinstance(value, str)
+            }
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось загрузить файл ответов да/нет: {exc}", flush=True)
+        return {}
+
+
+def _normalize_three_card_combinations(raw_data) -> tuple[Dict[str, dict[str, str]], list[tuple[str, str]]]:
+    """Подготавливает расклады на три карты и формирует общий пул."""
+
+    normalized: Dict[str, dict[str, str]] = {}
+    fallback_pool: list[tuple[str, str]] = []
+
+    if not isinstance(raw_data, dict):
+        return normalized, fallback_pool
+
+    for topic_key, topic_data in raw_data.items():
+        if not (isinstance(topic_key, str) and isinstance(topic_data, dict)):
+            continue
+
+        topic_combinations: dict[str, str] = {}
+        for combo_key, meaning in topic_data.items():
+            if not (isinstance(combo_key, str) and isinstance(meaning, str)):
+                continue
+
+            cards = [part.strip() for part in combo_key.split("|") if isinstance(part, str) and part.strip()]
+            if len(cards) != 3:
+                continue
+
+            normalized_key = "|".join(cards)
+            clean_meaning = meaning.strip()
+            topic_combinations[normalized_key] = clean_meaning
+            fallback_pool.append((normalized_key, clean_meaning))
+
+        if topic_combinations:
+            normalized[topic_key] = topic_combinations
+
+    return normalized, fallback_pool
+
+
+_MAJOR_ARCANA_IMAGE_MAP = {
+    "шут (0)": "fool",
+    "маг (i)": "magician",
+    "верховная жрица (ii)": "high_priestess",
+    "императрица (iii)": "empress",
+    "император (iv)": "emperor",
+    "иерофант (v)": "hierophant",
+    "влюбленные (vi)": "lovers",
+    "колесница (vii)": "chariot",
+    "сила (viii)": "strength",
+    "отшельник (ix)": "hermit",
+    "колесо фортуны (x)": "wheel_of_fortune",
+    "справедливость (xi)": "justice",
+    "повешенный (xii)": "hanged_man",
+    "смерть (xiii)": "death",
+    "умереность (xiv)": "temperance",
+    "умеренность (xiv)": "temperance",
+    "дьявол (xv)": "devil",
+    "башня (xvi)": "tower",
+    "звезда (xvii)": "star",
+    "луна (xviii)": "moon",
+    "солнце (xix)": "sun",
+    "суд (xx)": "judgement",
+    "мир (xxi)": "world",
+}
+
+_RANK_IMAGE_MAP = {
+    "туз": "ace",
+    "двойка": "two",
+    "тройка": "three",
+    "четверка": "four",
+    "пятерка": "five",
+    "шестерка": "six",
+    "семерка": "seven",
+    "восьмерка": "eight",
+    "девятка": "nine",
+    "десятка": "ten",
+    "паж": "page",
+    "рыцарь": "knight",
+    "королева": "queen",
+    "король": "king",
+}
+
+_SUIT_IMAGE_MAP = {
+    "жезлов": "wands",
+    "жезла": "wands",
+    "жезлы": "wands",
+    "кубков": "cups",
+    "кубки": "cups",
+    "кубка": "cups",
+    "мечей": "swords",
+    "мечи": "swords",
+    "меча": "swords",
+    "пентакли": "pentacles",
+    "пентаклей": "pentacles",
+    "пентакля": "pentacles",
+}
+
+
+def _normalize_card_key(name: str) -> str:
+    return name.strip().lower().replace("ё", "е")
+
+
+def _get_card_image_basename(card_name: str) -> str | None:
+    normalized = _normalize_card_key(card_name)
+
+    major = _MAJOR_ARCANA_IMAGE_MAP.get(normalized)
+    if major:
+        return major
+
+    parts = normalized.split()
+    if len(parts) < 2:
+        return None
+
+    rank = parts[0]
+    suit = parts[-1]
+
+    rank_en = _RANK_IMAGE_MAP.get(rank)
+    suit_en = _SUIT_IMAGE_MAP.get(suit)
+
+    if rank_en and suit_en:
+        return f"{rank_en}_of_{suit_en}"
+
+    return None
+
+
+# === Оптимизированные картинки ===
+# `python bot.py build-images [jpeg|webp]` пережимает PNG из images/ в
+# варианты не крупнее, чем Telegram хранит фото, и пишет манифест. Для
+# сборки нужен Pillow; самому боту он не требуется — без манифеста
+# отправляются исходные PNG.
+OPTIMIZED_CARDS_FOLDER = os.path.join(CARDS_FOLDER, "optimized")
+IMAGE_MANIFEST_PATH = os.path.join(OPTIMIZED_CARDS_FOLDER, "manifest.json")
+IMAGE_MANIFEST_VERSION = 1
+TELEGRAM_PHOTO_MAX_SIDE = 1280
+IMAGE_VARIANT_QUALITY = 85
+# Для отчёта: оценка времени загрузки при таком исходящем канале.
+UPLOAD_ESTIMATE_KBIT_PER_SECOND = 1000
+
+_image_manifest: Dict[str, str] = {}
+
+
+def _load_image_manifest() -> None:
+    """Читает манифест и пропускает варианты, чей исходник успел измениться."""
+    global _image_manifest
+
+    if not os.path.exists(IMAGE_MANIFEST_PATH):
+        _image_manifest = {}
+        return
+
+    try:
+        with open(IMAGE_MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось прочитать манифест картинок: {exc}", flush=True)
+        _image_manifest = {}
+        return
+
+    if not isinstance(manifest, dict) or manifest.get("version") != IMAGE_MANIFEST_VERSION:
+        _image_manifest = {}
+        return
+
+    resolved: Dict[str, str] = {}
+    for basename, entry in (manifest.get("variants") or {}).items():
+        if not isinstance(entry, dict):
+            continue
+        try:
+            source_stat = os.stat(os.path.join(CARDS_FOLDER, f"{basename}.png"))
+        except OSError:
+            continue
+        if [source_stat.st_mtime_ns, source_stat.st_size] != entry.get("source"):
+            print(f"Вариант картинки {basename} устарел — отправляем PNG.", flush=True)
+            continue
+        if os.path.exists(entry.get("path", "")):
+            resolved[basename] = entry["path"]
+
+    _image_manifest = resolved
+
+
+def _estimate_upload_seconds(size_bytes: int) -> float:
+    return size_bytes * 8 / (UPLOAD_ESTIMATE_KBIT_PER_SECOND * 1000)
+
+
+def _build_image_variants(image_format: str = "jpeg") -> int:
+    """Собирает оптимизированные варианты картинок. Возвращает код выхода."""
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Для сборки картинок нужен Pillow: pip install Pillow", flush=True)
+        return 1
+
+    image_format = image_format.lower()
+    extension = {"jpeg": "jpg", "webp": "webp"}.get(image_format)
+    if extension is None:
+        print(f"Неизвестный формат {image_format}, доступны jpeg и webp.", flush=True)
+        return 1
+
+    os.makedirs(OPTIMIZED_CARDS_FOLDER, exist_ok=True)
+    variants: Dict[str, dict] = {}
+    original_total = 0
+    optimized_total = 0
+
+    for filename in sorted(os.listdir(CARDS_FOLDER)):
+        if not filename.endswith(".png"):
+            continue
+
+        basename = filename[:-4]
+        source_path = os.path.join(CARDS_FOLDER, filename)
+        target_path = os.path.join(OPTIMIZED_CARDS_FOLDER, f"{basename}.{extension}")
+        source_stat = os.stat(source_path)
+
+        with Image.open(source_path) as image:
+            image.thumbnail((TELEGRAM_PHOTO_MAX_SIDE, TELEGRAM_PHOTO_MAX_SIDE))
+            if image.mode in ("RGBA", "LA", "P"):
+                # Telegram всё равно сохраняет фото без прозрачности — кладём на белый.
+                rgba = image.convert("RGBA")
+                flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel("A"))
+                image = flattened
+            else:
+                image = image.convert("RGB")
+
+            if image_format == "jpeg":
+                image.save(
+                    target_path,
+                    "JPEG",
+                    quality=IMAGE_VARIANT_QUALITY,
+                    optimize=True,
+                    progressive=True,
+                )
+            else:
+                image.save(target_path, "WEBP", quality=IMAGE_VARIANT_QUALITY, method=6)
+
+        optimized_size = os.path.getsize(target_path)
+        original_total += source_stat.st_size
+        optimized_total += optimized_size
+        variants[basename] = {
+            "path": target_path,
+            "format": image_format,
+            "source": [source_stat.st_mtime_ns, source_stat.st_size],
+            "bytes": optimized_size,
+        }
+
+    manifest = {"version": IMAGE_MANIFEST_VERSION, "variants": variants}
+    tmp_path = f"{IMAGE_MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, IMAGE_MANIFEST_PATH)
+
+    if not variants:
+        print("В папке с картинками нет PNG.", flush=True)
+        return 0
+
+    count = len(variants)
+    saved = original_total - optimized_total
+    print(
+        f"Картинок: {count}\n"
+        f"PNG: {original_total / 1024:.0f} КБ, {image_format}: {optimized_total / 1024:.0f} КБ, "
+        f"экономия {saved / 1024:.0f} КБ ({saved / original_total:.0%}, "
+        f"в {original_total / max(optimized_total, 1):.1f} раза)\n"
+        f"Загрузка одной картинки при {UPLOAD_ESTIMATE_KBIT_PER_SECOND} кбит/с: "
+        f"{_estimate_upload_seconds(original_total // count) * 1000:.0f} мс → "
+        f"{_estimate_upload_seconds(optimized_total // count) * 1000:.0f} мс",
+        flush=True,
+    )
+    return 0
+
+
+# === Индекс картинок ===
+# Путь к картинке для каждой известной карты вычисляется один раз при
+# загрузке контента. Фоновый опрос mtime пересобирает индекс, только если
+# в images/ что-то поменялось, поэтому при ответе файловая система не нужна.
+IMAGE_INDEX_POLL_SECONDS = float(os.getenv("IMAGE_INDEX_POLL_SECONDS", "30"))
+
+
+class _CardImage(NamedTuple):
+    path: str
+    mtime_ns: int
+    size: int
+
+
+_card_image_index: Dict[str, _CardImage | None] = {}
+_image_fingerprints: Dict[str, tuple[int, int]] = {}
+_image_index_signature: tuple = ()
+
+
+def _resolve_card_image(card_name: str) -> _CardImage | None:
+    basename = _get_card_image_basename(card_name)
+    if not basename:
+        return None
+
+    candidates = [os.path.join(CARDS_FOLDER, f"{basename}.png")]
+    variant = _image_manifest.get(basename)
+    if variant:
+        candidates.insert(0, variant)
+
+    for path in candidates:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        return _CardImage(path, stat.st_mtime_ns, stat.st_size)
+
+    return None
+
+
+def _indexed_card_names() -> set[str]:
+    names: set[str] = set(tarot_deck)
+    names.update(_yes_no_answers)
+    names.update(payload["card"] for payload in card_of_day_schedule.values())
+    for entries in _draw_tables.three_cards_by_topic.values():
+        for cards, _ in entries:
+            names.update(cards)
+    return names
+
+
+def _image_folder_signature(paths) -> tuple:
+    signature = []
+    for path in (CARDS_FOLDER, OPTIMIZED_CARDS_FOLDER, IMAGE_MANIFEST_PATH, *sorted(paths)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature.append((path, None))
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _rebuild_image_index() -> None:
+    global _card_image_index, _image_fingerprints, _image_index_signature
+
+    _load_image_manifest()
+    index = {name: _resolve_card_image(name) for name in _indexed_card_names()}
+    fingerprints = {
+        image.path: (image.mtime_ns, image.size) for image in index.values() if image
+    }
+
+    _card_image_index = index
+    _image_fingerprints = fingerprints
+    _image_index_signature = _image_folder_signature(fingerprints)
+
+    missing = sorted(name for name, image in index.items() if image is None)
+    if missing:
+        print(
+            f"Нет картинок для {len(missing)} карт: " + ", ".join(missing),
+            flush=True,
+        )
+
+
+def _image_index_poll_loop() -> None:
+    while True:
+        time.sleep(IMAGE_INDEX_POLL_SECONDS)
+        if _image_folder_signature(_image_fingerprints) != _image_index_signature:
+            print("Картинки изменились — пересобираем индекс.", flush=True)
+            _rebuild_image_index()
+
+
+def _start_image_index_poller() -> None:
+    thread = threading.Thread(target=_image_index_poll_loop, name="image-index", daemon=True)
+    thread.start()
+
+
+def _get_image_fingerprint(path: str) -> tuple[int, int] | None:
+    fingerprint = _image_fingerprints.get(path)
+    if fingerprint is not None:
+        return fingerprint
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+@_traced_content
+def _get_card_image_path(card_name: str) -> str | None:
+    if card_name in _card_image_index:
+        image = _card_image_index[card_name]
+    else:
+        # Имени нет в контенте (например, его прислал WebApp). В индекс его
+        # не кладём: иначе любой клиент раздувал бы его своими строками.
+        image = _resolve_card_image(card_name)
+
+    return image.path if image else None
+
+
+@_traced_content
+def _draw_yes_no_answer() -> tuple[str, str] | None:
+    entries = _draw_tables.yes_no
+    if not entries:
+        return None
+
+    return random.choice(entries)
+
+
+def _build_yes_no_prompt_keyboard() -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("🔁 Получить ответ", callback_data=YES_NO_CALLBACK_DRAW))
+    return markup
+
+
+def _build_yes_no_repeat_keyboard() -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("🔁 Спросить ещё", callback_data=YES_NO_CALLBACK_DRAW))
+    return markup
+
+
+# === Скомпилированный контент ===
+# `python bot.py compile-content` один раз проверяет и нормализует все
+# JSON-файлы и сохраняет результат в pickle. При старте бот берёт готовый
+# артефакт, а если исходники новее — читает JSON как раньше.
+CONTENT_ARTIFACT_PATH = os.path.join(BASE_DIR, "content.pickle")
+CONTENT_ARTIFACT_VERSION = 1
+CONTENT_SOURCE_FILES = (
+    TAROT_DECK_FILE,
+    TOPICS_FILE,
+    THREE_CARDS_FILE,
+    CARD_OF_DAY_FILE,
+    YES_NO_FILE,
+)
+
+
+def _content_source_fingerprint() -> Dict[str, list[int] | None]:
+    fingerprint: Dict[str, list[int] | None] = {}
+    for path in CONTENT_SOURCE_FILES:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            fingerprint[path] = None
+            continue
+        fingerprint[path] = [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+
+def _load_content_from_json() -> dict:
+    deck, topics = _load_tarot_deck_json()
+
+    with open(THREE_CARDS_FILE, "r", encoding="utf-8") as f:
+        raw_three_card_data = json.load(f)
+    three_cards_by_topic, three_card_fallback_pool = _normalize_three_card_combinations(
+        raw_three_card_data
+    )
+
+    return {
+        "tarot_deck": deck,
+        "tarot_topics": topics,
+        "combinations_3cards_by_topic": three_cards_by_topic,
+        "three_card_fallback_pool": three_card_fallback_pool,
+        "card_of_day_schedule": _load_card_of_day_json(),
+        "yes_no_answers": _load_yes_no_json(),
+    }
+
+
+def _intern_content(content: dict) -> dict:
+    """Интернирует названия карт, чтобы одинаковые строки не дублировались."""
+    intern = sys.intern
+
+    content["tarot_deck"] = {intern(card): data for card, data in content["tarot_deck"].items()}
+    content["tarot_topics"] = {
+        intern(card): data for card, data in content["tarot_topics"].items()
+    }
+    content["combinations_3cards_by_topic"] = {
+        intern(topic): {
+            "|".join(intern(card) for card in combo_key.split("|")): meaning
+            for combo_key, meaning in combos.items()
+        }
+        for topic, combos in content["combinations_3cards_by_topic"].items()
+    }
+    content["three_card_fallback_pool"] = [
+        ("|".join(intern(card) for card in combo_key.split("|")), meaning)
+        for combo_key, meaning in content["three_card_fallback_pool"]
+    ]
+    for payload in content["card_of_day_schedule"].values():
+        payload["card"] = intern(payload["card"])
+    content["yes_no_answers"] = {
+        intern(card): answer for card, answer in content["yes_no_answers"].items()
+    }
+    return content
+
+
+def _validate_content(content: dict) -> list[str]:
+    """Ищет карты, которых нет в колоде или у которых нет картинки."""
+    deck = content["tarot_deck"]
+    problems: list[str] = []
+
+    referenced: set[str] = set(deck)
+    for combo_key, _ in content["three_card_fallback_pool"]:
+        referenced.update(combo_key.split("|"))
+    referenced.update(payload["card"] for payload in content["card_of_day_schedule"].values())
+    referenced.update(content["yes_no_answers"])
+
+    for card in sorted(referenced):
+        if card not in deck:
+            problems.append(f"Карта не найдена в {TAROT_DECK_FILE}: {card}")
+        if _get_card_image_path(card) is None:
+            problems.append(f"Нет картинки для карты: {card}")
+
+    return problems
+
+
+def _compile_content() -> int:
+    """Собирает content.pickle. Возвращает код выхода для командной строки."""
+    started = time.perf_counter()
+    fingerprint = _content_source_fingerprint()
+    content = _intern_content(_load_content_from_json())
+
+    for problem in _validate_content(content):
+        print(f"⚠️ {problem}", flush=True)
+
+    artifact = {
+        "version": CONTENT_ARTIFACT_VERSION,
+        "sources": fingerprint,
+        "content": content,
+    }
+
+    try:
+        tmp_path = f"{CONTENT_ARTIFACT_PATH}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CONTENT_ARTIFACT_PATH)
+    except OSError as exc:
+        print(f"Не удалось сохранить {CONTENT_ARTIFACT_PATH}: {exc}", flush=True)
+        return 1
+
+    print(
+        f"Контент скомпилирован в {CONTENT_ARTIFACT_PATH} "
+        f"за {time.perf_counter() - started:.3f} с.",
+        flush=True,
+    )
+    return 0
+
+
+def _load_compiled_content() -> dict | None:
+    if not os.path.exists(CONTENT_ARTIFACT_PATH):
+        return None
+
+    try:
+        with open(CONTENT_ARTIFACT_PATH, "rb") as f:
+            artifact = pickle.load(f)
+    except Exception as exc:  # noqa: BLE001 - чужой или устаревший pickle падает как угодно
+        # ImportError, ValueError, IndexError… — в любом случае читаем JSON.
+        print(f"Не удалось прочитать {CONTENT_ARTIFACT_PATH}: {exc!r}", flush=True)
+        return None
+
+    if not isinstance(artifact, dict) or artifact.get("version") != CONTENT_ARTIFACT_VERSION:
+        print("Скомпилированный контент другой версии — читаем JSON.", flush=True)
+        return None
+
+    if artifact.get("sources") != _content_source_fingerprint():
+        print("Скомпилированный контент устарел — читаем JSON.", flush=True)
+        return None
+
+    return artifact.get("content")
+
+
+def _apply_content(content: dict) -> None:
+    global tarot_deck, tarot_topics, combinations_3cards_by_topic
+    global _three_card_fallback_pool, card_of_day_schedule, _yes_no_answers
+
+    tarot_deck = content["tarot_deck"]
+    tarot_topics = content["tarot_topics"]
+    combinations_3cards_by_topic = content["combinations_3cards_by_topic"]
+    _three_card_fallback_pool = content["three_card_fallback_pool"]
+    card_of_day_schedule = content["card_of_day_schedule"]
+    _yes_no_answers = content["yes_no_answers"]
+    _rebuild_draw_tables()
+    _rebuild_image_index()
+
+
+# === Таблицы для розыгрыша ===
+# Собираются один раз при загрузке контента, чтобы каждый расклад был
+# random.choice по готовому кортежу без копирования словарей.
+class _DrawTables(NamedTuple):
+    three_cards_by_topic: Dict[str, tuple[tuple[tuple[str, ...], str], ...]]
+    three_cards_fallback: tuple[tuple[tuple[str, ...], str], ...]
+    yes_no: tuple[tuple[str, str], ...]
+    deck_cards: tuple[str, ...]
+    card_meanings: Dict[str, tuple[str, ...]]
+
+
+def _build_three_card_entries(pairs) -> tuple[tuple[tuple[str, ...], str], ...]:
+    entries = []
+    for combo_key, meaning in pairs:
+        cards = tuple(part.strip() for part in combo_key.split("|") if part.strip())
+        if len(cards) == 3:
+            entries.append((cards, meaning))
+    return tuple(entries)
+
+
+def _rebuild_draw_tables() -> None:
+    global _draw_tables
+
+    deck_cards = tuple(card for card in tarot_deck.keys() if isinstance(card, str))
+    _draw_tables = _DrawTables(
+        three_cards_by_topic={
+            topic_key: _build_three_card_entries(topic_combinations.items())
+            for topic_key, topic_combinations in combinations_3cards_by_topic.items()
+            if isinstance(topic_combinations, dict) and topic_combinations
+        },
+        three_cards_fallback=_build_three_card_entries(_three_card_fallback_pool),
+        yes_no=tuple(_yes_no_answers.items()),
+        deck_cards=deck_cards,
+        card_meanings={
+            card: tuple(_collect_all_meanings(tarot_deck.get(card))) for card in deck_cards
+        },
+    )
+
+
+def _load_content() -> None:
+    content = _load_compiled_content()
+    if content is None:
+        content = _load_content_from_json()
+    _apply_content(content)
+
+
+_load_content()
+
+
+def _normalize_two_card_key(card1: str, card2: str) -> str:
+    """Возвращает ключ для двух карт в отсортированном виде."""
+
+    return "|".join(sorted([card1.strip(), card2.strip()]))
+
+
+@_traced_content
+def _draw_three_card_reading(topic_key: str) -> tuple[tuple[str, ...], str] | None:
+    """Выбирает расклад из трёх карт по теме или из общего пула."""
+
+    tables = _draw_tables
+    entries = tables.three_cards_by_topic.get(topic_key) or tables.three_cards_fallback
+
+    if not entries:
+        return None
+
+    return random.choice(entries)
+
+
+def _split_two_card_key(key: str) -> list[str]:
+    """Разбивает ключ расклада на названия карт."""
+
+    if "|" in key:
+        parts = key.split("|")
+    elif "," in key:
+        parts = key.split(",")
+    else:
+        parts = key.split()
+
+    return [part.strip() for part in parts if isinstance(part, str) and part.strip()]
+
+
+def _extract_two_card_meaning(value) -> str | None:
+    """Достаёт текст толкования из разных структур данных."""
+
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+
+    if isinstance(value, dict):
+        for key in ("meaning", "text", "description", "value"):
+            nested = value.get(key)
+            if isinstance(nested, str) and nested.strip():
+                return nested.strip()
+
+    return None
+
+
+def _normalize_two_card_combinations(raw_data) -> Dict[str, str]:
+    """Приводит данные раскладов на две карты к словарю."""
+
+    normalized: Dict[str, str] = {}
+
+    def _add_pair(card1: str, card2: str, meaning: str) -> None:
+        if not (isinstance(card1, str) and isinstance(card2, str) and isinstance(meaning, str)):
+            return
+
+        card1 = card1.strip()
+        card2 = card2.strip()
+        meaning = meaning.strip()
+
+        if not card1 or not card2 or not meaning:
+            return
+
+        normalized[_normalize_two_card_key(card1, card2)] = meaning
+
+    def _process(obj) -> None:
+        if isinstance(obj, dict):
+            cards_field = obj.get("cards")
+            meaning_field = _extract_two_card_meaning(obj)
+
+            if isinstance(cards_field, (list, tuple)) and len(cards_field) >= 2 and meaning_field:
+                cards = [
+                    card for card in cards_field if isinstance(card, str) and card.strip()
+                ]
+                if len(cards) >= 2:
+                    _add_pair(cards[0], cards[1], meaning_field)
+
+            else:
+                card1 = obj.get("card1")
+                card2 = obj.get("card2")
+                if isinstance(card1, str) and isinstance(card2, str) and meaning_field:
+                    _add_pair(card1, card2, meaning_field)
+
+            for key, value in obj.items():
+                if isinstance(key, str):
+                    parts = _split_two_card_key(key)
+                    if len(parts) == 2:
+                        meaning = _extract_two_card_meaning(value)
+                        if meaning:
+                            _add_pair(parts[0], parts[1], meaning)
+                            continue
+
+                _process(value)
+
+        elif isinstance(obj, list):
+            for item in obj:
+                _process(item)
+
+    _process(raw_data)
+
+    return normalized
+
+
+TWO_CARDS_URL = "https://raw.githubusercontent.com/nimixiss/tarot-webapp/main/two_card_combinations_full.json"
+TWO_CARDS_CACHE_PATH = os.path.join(BASE_DIR, "two_card_combinations_cache.json")
+TWO_CARDS_REFRESH_INTERVAL_SECONDS = float(os.getenv("TWO_CARDS_REFRESH_INTERVAL_SECONDS", "3600"))
+
+# Комбинации берутся из локального кэша мгновенно, а свежая версия
+# подтягивается фоном с проверкой ETag/Last-Modified.
+combinations_2cards: Dict[str, str] = {}
+_two_card_draw_table: tuple[tuple[str, str, str], ...] = ()
+_two_cards_cache_headers: Dict[str, str] = {}
+
+
+def _set_two_card_combinations(combinations: Dict[str, str]) -> None:
+    """Подменяет словарь комбинаций и заранее разобранную таблицу для розыгрыша."""
+    global combinations_2cards, _two_card_draw_table
+
+    table = []
+    for key, meaning in combinations.items():
+        cards = key.split("|", 1)
+        if len(cards) == 2 and isinstance(meaning, str):
+            table.append((cards[0], cards[1], meaning))
+
+    _two_card_draw_table = tuple(table)
+    combinations_2cards = combinations
+
+
+def _load_two_card_cache() -> None:
+    global _two_cards_cache_headers
+
+    if not os.path.exists(TWO_CARDS_CACHE_PATH):
+        return
+
+    try:
+        with open(TWO_CARDS_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось прочитать кэш комбинаций для двух карт: {exc}", flush=True)
+        return
+
+    if not isinstance(cached, dict):
+        return
+
+    combinations = cached.get("combinations")
+    if isinstance(combinations, dict):
+        # Кэш уже хранит нормализованный словарь — повторно обходить не нужно.
+        _set_two_card_combinations({
+            key: value
+            for key, value in combinations.items()
+            if isinstance(key, str) and isinstance(value, str)
+        })
+    else:
+        _set_two_card_combinations(_normalize_two_card_combinations(cached.get("data")))
+    _two_cards_cache_headers = {
+        key: value
+        for key, value in cached.items()
+        if key in ("etag", "last_modified") and isinstance(value, str)
+    }
+
+
+def _save_two_card_cache(combinations: Dict[str, str], headers: Dict[str, str]) -> None:
+    payload = dict(headers)
+    payload["fetched_at"] = datetime.now(timezone.utc).isoformat()
+    payload["combinations"] = combinations
+
+    try:
+        tmp_path = f"{TWO_CARDS_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, TWO_CARDS_CACHE_PATH)
+    except OSError as exc:
+        print(f"Не удалось сохранить кэш комбинаций для двух карт: {exc}", flush=True)
+
+
+def _refresh_two_card_combinations() -> bool:
+    """Скачивает комбинации, если они изменились. Возвращает True при обновлении."""
+    global _two_cards_cache_headers
+
+    request_headers = {}
+    if "etag" in _two_cards_cache_headers:
+        request_headers["If-None-Match"] = _two_cards_cache_headers["etag"]
+    if "last_modified" in _two_cards_cache_headers:
+        request_headers["If-Modified-Since"] = _two_cards_cache_headers["last_modified"]
+
+    try:
+        response = requests.get(TWO_CARDS_URL, headers=request_headers, timeout=15)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        raw_data = response.json()
+    except (requests.RequestException, ValueError) as exc:
+        print(
+            f"Не удалось загрузить комбинации для двух карт: {exc}",
+            flush=True,
+        )
+        return False
+
+    normalized = _normalize_two_card_combinations(raw_data)
+    if not normalized:
+        print("Свежие комбинации для двух карт пустые — оставляем кэш.", flush=True)
+        return False
+
+    headers = {}
+    if response.headers.get("ETag"):
+        headers["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        headers["last_modified"] = response.headers["Last-Modified"]
+
+    _save_two_card_cache(normalized, headers)
+    # Подменяем словарь целиком: читатели видят либо старую, либо новую версию.
+    _set_two_card_combinations(normalized)
+    _two_cards_cache_headers = headers
+    print(f"Комбинации для двух карт обновлены: {len(normalized)} шт.", flush=True)
+    return True
+
+
+def _two_card_refresh_loop() -> None:
+    while True:
+        _refresh_two_card_combinations()
+        time.sleep(TWO_CARDS_REFRESH_INTERVAL_SECONDS)
+
+
+def _start_two_card_refresher() -> None:
+    thread = threading.Thread(target=_two_card_refresh_loop, name="two-cards-refresher", daemon=True)
+    thread.start()
+
+
+_load_two_card_cache()
+
+
+@_traced_content
+def _get_two_card_meaning(card1: str, card2: str) -> str | None:
+    """Возвращает толкование для пары карт, если оно известно."""
+
+    if not (isinstance(card1, str) and isinstance(card2, str)):
+        return None
+
+    key = _normalize_two_card_key(card1, card2)
+    meaning = combinations_2cards.get(key)
+    if isinstance(meaning, str) and meaning.strip():
+        return meaning
+
+    return None
+
+
+@_traced_content
+def _pick_random_card_meaning(card_name: str) -> str | None:
+    """Возвращает случайное значение для отдельной карты."""
+
+    meanings = _draw_tables.card_meanings.get(card_name)
+    if meanings:
+        return random.choice(meanings)
+
+    return None
+
+
+@_traced_content
+def _draw_general_two_card_fallback() -> tuple[str, str, str] | None:
+    """Создаёт толкование по отдельным картам, если комбинаций нет."""
+
+    deck_cards = _draw_tables.deck_cards
+    if len(deck_cards) < 2:
+        return None
+
+    card1, card2 = random.sample(deck_cards, 2)
+    meaning1 = _pick_random_card_meaning(card1)
+    meaning2 = _pick_random_card_meaning(card2)
+
+    parts = ["(Резервное толкование по отдельным картам)"]
+    if meaning1:
+        parts.append(f"• {card1}: {meaning1}")
+    else:
+        parts.append(f"• {card1}: значение не найдено.")
+
+    if meaning2:
+        parts.append(f"• {card2}: {meaning2}")
+    else:
+        parts.append(f"• {card2}: значение не найдено.")
+
+    return card1, card2, "\n".join(parts)
+
+# === Состояние диалогов ===
+# Ожидаемый «следующий шаг» (выбор сферы, текст рассылки) хранится не в
+# памяти процесса, а в хранилище: после перезапуска или на другой копии
+# бота пользователь продолжит с того же места. Вместо функций храним
+# имя шага, чтобы запись понимали и синхронный, и асинхронный режимы.
+CONVERSATION_STATE_BACKEND = os.getenv("CONVERSATION_STATE_BACKEND", "sqlite").strip().lower()
+CONVERSATION_DB_PATH = os.path.join(STATE_DIR, "conversation_state.sqlite3")
+CONVERSATION_STATE_TTL_SECONDS = float(os.getenv("CONVERSATION_STATE_TTL_SECONDS", "86400"))
+CONVERSATION_SWEEP_INTERVAL_SECONDS = 600.0
+
+STEP_SINGLE_CARD_TOPIC = "single_card_topic"
+STEP_THREE_CARD_TOPIC = "three_card_topic"
+STEP_BROADCAST_TEXT = "broadcast_text"
+
+
+class _MemoryConversationStore:
+    """Шаги в памяти процесса — для разработки и одиночного запуска."""
+
+    def __init__(self) -> None:
+        self._pending: dict[int, tuple[str, list, float]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, chat_id: int, step: str, args: list) -> None:
+        with self._lock:
+            self._pending[chat_id] = (step, args, time.time() + CONVERSATION_STATE_TTL_SECONDS)
+
+    def pop(self, chat_id: int) -> tuple[str, list] | None:
+        with self._lock:
+            pending = self._pending.pop(chat_id, None)
+        if pending is None or pending[2] < time.time():
+            return None
+        return pending[0], pending[1]
+
+    def has(self, chat_id: int) -> bool:
+        pending = self._pending.get(chat_id)
+        return pending is not None and pending[2] >= time.time()
+
+    def clear(self, chat_id: int) -> None:
+        with self._lock:
+            self._pending.pop(chat_id, None)
+
+    def sweep(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [chat_id for chat_id, pending in self._pending.items() if pending[2] < now]
+            for chat_id in expired:
+                del self._pending[chat_id]
+        return len(expired)
+
+
+class _SqliteConversationStore:
+    """Шаги в SQLite: файл можно положить на общий том для нескольких копий бота."""
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=10
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_steps (
+                chat_id INTEGER PRIMARY KEY,
+                step TEXT NOT NULL,
+                args TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+
+    def set(self, chat_id: int, step: str, args: list) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_steps (chat_id, step, args, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    chat_id,
+                    step,
+                    json.dumps(args),
+                    time.time() + CONVERSATION_STATE_TTL_SECONDS,
+                ),
+            )
+
+    def pop(self, chat_id: int) -> tuple[str, list] | None:
+        # DELETE ... RETURNING атомарен: шаг достанется ровно одной копии бота.
+        with self._lock:
+            row = self._conn.execute(
+                "DELETE FROM pending_steps WHERE chat_id = ? RETURNING step, args, expires_at",
+                (chat_id,),
+            ).fetchone()
+        if row is None or row[2] < time.time():
+            return None
+        return row[0], json.loads(row[1])
+
+    def has(self, chat_id: int) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM pending_steps WHERE chat_id = ? AND expires_at >= ?",
+                (chat_id, time.time()),
+            ).fetchone()
+        return row is not None
+
+    def clear(self, chat_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM pending_steps WHERE chat_id = ?", (chat_id,))
+
+    def sweep(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM pending_steps WHERE expires_at < ?", (time.time(),)
+            )
+        return cursor.rowcount
+
+
+def _create_conversation_store():
+    if CONVERSATION_STATE_BACKEND == "memory":
+        if not _is_shared_state():
+            return _MemoryConversationStore()
+        # Следующее сообщение может прийти в другой процесс.
+        print("STATE_BACKEND=shared: шаги диалогов храним в SQLite.", flush=True)
+
+    try:
+        return _SqliteConversationStore(CONVERSATION_DB_PATH)
+    except sqlite3.Error as exc:
+        print(
+            f"Не удалось открыть хранилище диалогов, держим шаги в памяти: {exc}",
+            flush=True,
+        )
+        return _MemoryConversationStore()
+
+
+def _step_callbacks() -> Dict[str, tuple]:
+    """Имя шага → (синхронный обработчик, асинхронный обработчик)."""
+    return {
+        STEP_SINGLE_CARD_TOPIC: (send_single_card_with_topic, _async_send_single_card_with_topic),
+        STEP_THREE_CARD_TOPIC: (send_three_cards_with_topic, _async_send_three_cards_with_topic),
+        STEP_BROADCAST_TEXT: (_handle_broadcast_text_step, _async_handle_broadcast_text_step),
+    }
+
+
+def _step_name_for_callback(callback) -> str | None:
+    for step, callbacks in _step_callbacks().items():
+        if callback in callbacks:
+            return step
+    return None
+
+
+class _PersistentNextStepBackend(HandlerBackend):
+    """Подключает хранилище диалогов к register_next_step_handler из telebot."""
+
+    def __init__(self, store) -> None:
+        super().__init__()
+        self.store = store
+
+    def register_handler(self, handler_group_id, handler):
+        step = _step_name_for_callback(handler.callback)
+        if step is None:
+            raise ValueError(f"Неизвестный шаг диалога: {handler.callback!r}")
+        self.store.set(handler_group_id, step, list(handler.args))
+
+    def clear_handlers(self, handler_group_id):
+        self.store.clear(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        pending = self.store.pop(handler_group_id)
+        if pending is None:
+            return None
+
+        step, args = pending
+        callbacks = _step_callbacks().get(step)
+        if callbacks is None:
+            return None
+        return [Handler(_timed_handler(callbacks[0]), *args)]
+
+
+def _conversation_sweep_loop() -> None:
+    while True:
+        time.sleep(CONVERSATION_SWEEP_INTERVAL_SECONDS)
+        try:
+            removed = _conversation_store.sweep()
+        except sqlite3.Error as exc:
+            print(f"Не удалось очистить устаревшие шаги диалогов: {exc}", flush=True)
+            continue
+        if removed:
+            print(f"Удалено устаревших шагов диалогов: {removed}", flush=True)
+
+
+def _start_conversation_sweeper() -> None:
+    thread = threading.Thread(
+        target=_conversation_sweep_loop, name="conversation-sweeper", daemon=True
+    )
+    thread.start()
+
+
+_conversation_store = None if _RUNNING_CLI_COMMAND else _create_conversation_store()
+
+
+# === Соединение с Telegram API ===
+# Все синхронные вызовы telebot идут через одну сессию requests с пулом
+# keep-alive соединений. Ошибки соединения и 5xx повторяются с
+# экспоненциальной задержкой и джиттером. Отправки (sendMessage, sendPhoto…)
+# после обрыва уже установленного соединения не повторяем: тело могло дойти
+# до Telegram, и пользователь получил бы сообщение дважды. Их повторяем,
+# только если соединение не установилось вовсе (отказ, таймаут подключения). После TELEGRAM_BREAKER_THRESHOLD
+# неудач подряд цепь размыкается: на TELEGRAM_BREAKER_COOLDOWN_SECONDS вызовы
+# сразу падают с requests.ConnectionError, не дожидаясь таймаутов.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "30"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_RETRY_BASE_DELAY = 0.3
+TELEGRAM_RETRY_MAX_DELAY = 5.0
+TELEGRAM_BREAKER_THRESHOLD = int(os.getenv("TELEGRAM_BREAKER_THRESHOLD", "10"))
+TELEGRAM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("TELEGRAM_BREAKER_COOLDOWN_SECONDS", "30"))
+# Коды, при которых запрос до бота Telegram не дошёл, — повтор безопасен.
+_RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+_telegram_retries = _CounterMetric(
+    "taro_telegram_retries_total", "Повторы вызовов Telegram Bot API.", ("reason",)
+)
+_telegram_breaker_trips = _CounterMetric(
+    "taro_telegram_breaker_trips_total", "Сколько раз размыкалась цепь к Telegram API.", ()
+)
+
+
+class _TelegramSession:
+    """Отправитель запросов для apihelper.CUSTOM_REQUEST_SENDER."""
+
+    def __init__(self) -> None:
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TELEGRAM_POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    def _check_breaker(self) -> None:
+        with self._lock:
+            if not self._open_until:
+                return
+            now = time.monotonic()
+            if now < self._open_until:
+                raise requests.ConnectionError("Цепь к Telegram API разомкнута, вызов пропущен")
+            # Пауза прошла: пропускаем один пробный запрос, остальные ждут его исхода.
+            self._open_until = now + TELEGRAM_BREAKER_COOLDOWN_SECONDS
+
+    def _record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_until = 0.0
+
+    def _record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures < TELEGRAM_BREAKER_THRESHOLD:
+                return
+            # Следующая неудача после паузы (пробного запроса) снова разомкнёт цепь.
+            self._consecutive_failures = TELEGRAM_BREAKER_THRESHOLD - 1
+            self._open_until = time.monotonic() + TELEGRAM_BREAKER_COOLDOWN_SECONDS
+
+        _telegram_breaker_trips.inc()
+        print(
+            f"Telegram API недоступен, пауза {TELEGRAM_BREAKER_COOLDOWN_SECONDS:.0f} с",
+            flush=True,
+        )
+
+    @staticmethod
+    def _rewind_files(files) -> None:
+        for value in (files or {}).values():
+            stream = value[1] if isinstance(value, tuple) else value
+            if hasattr(stream, "seek"):
+                stream.seek(0)
+
+    @staticmethod
+    def _failed_before_sending(exc: requests.RequestException) -> bool:
+        """Соединение так и не установилось — запрос до Telegram точно не дошёл."""
+        if isinstance(exc, requests.ConnectTimeout):
+            return True
+        # Отказ в соединении requests заворачивает в ConnectionError(MaxRetryError).
+        reason = getattr(exc.args[0], "reason", None) if exc.args else None
+        return isinstance(reason, ConnectTimeoutError)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        delay = min(TELEGRAM_RETRY_MAX_DELAY, TELEGRAM_RETRY_BASE_DELAY * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        self._check_breaker()
+        # Только чтение (getMe, getUpdates…) можно повторять после любой ошибки
+        # соединения: отправку сообщения Telegram мог уже выполнить.
+        idempotent = url.rsplit("/", 1)[-1].startswith("get")
+
+        attempt = 0
+        while True:
+            try:
+                response = self._session.request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                retryable = idempotent or self._failed_before_sending(exc)
+                if not retryable or attempt >= TELEGRAM_MAX_RETRIES:
+                    self._record_failure()
+                    raise
+                reason = "timeout" if isinstance(exc, requests.Timeout) else "connection"
+            else:
+                if response.status_code not in _RETRYABLE_STATUS_CODES:
+                    self._record_success()
+                    return response
+                if attempt >= TELEGRAM_MAX_RETRIES:
+                    self._record_failure()
+                    return response
+                reason = str(response.status_code)
+
+            _telegram_retries.inc(reason)
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+            self._rewind_files(files)
+
+
+_telegram_session = _TelegramSession()
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _telegram_session.request
+telebot.apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+
+
+# Свой пул telebot не нужен: апдейты раздаёт _dispatcher, и обработчики
+# выполняются прямо в его воркерах.
+bot = telebot.TeleBot(
+    TOKEN,
+    threaded=False,
+    next_step_backend=_PersistentNextStepBackend(_conversation_store),
+)
+_register_queue_depth("stats_pending_increments", lambda: _stats_pending_increments)
+
 
+# === Сценарии обработчиков ===
+# Логика обработчика пишется один раз — генератором, который отдаёт наружу
+# шаги: вызов Bot API (_api) или блокирующую локальную работу (_local) —
+# хранилища, файлы. Результат шага возвращается в генератор через yield,
+# исключение — бросается в него же. Синхронный режим выполняет шаги через
+# _run_flow прямо в потоке воркера, асинхронный — через _async_run_flow:
+# вызовы API ждёт на AsyncTeleBot, а локальную работу уносит в поток.
+class _ApiCall(NamedTuple):
+    method: str  # метод Bot API: у TeleBot и AsyncTeleBot имена одинаковые
+    args: tuple
+    kwargs: dict
 
-def _normalize_card_key(name: str) -> str:
-    return name.strip().lower().replace("ё", "е")
 
+class _LocalCall(NamedTuple):
+    func: object
+    args: tuple
 
-def _get_card_image_basename(card_name: str) -> str | None:
-    normalized = _normalize_card_key(card_name)
 
-    major = _MAJOR_ARCANA_IMAGE_MAP.get(normalized)
-    if major:
-        return major
+def _api(method: str, *args, **kwargs) -> _ApiCall:
+    return _ApiCall(method, args, kwargs)
 
-    parts = normalized.split()
-    if len(parts) < 2:
+
+def _local(func, *args) -> _LocalCall:
+    return _LocalCall(func, args)
+
+
+def _api_flow(method: str, *args, **kwargs):
+    """Сценарий из одного вызова API — чтобы обернуть его, например, в отмену брони."""
+    return (yield _api(method, *args, **kwargs))
+
+
+def _run_flow(flow):
+    """Выполняет сценарий синхронно, через bot."""
+    result = error = None
+    while True:
+        try:
+            step = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        result = error = None
+        try:
+            if isinstance(step, _ApiCall):
+                result = getattr(bot, step.method)(*step.args, **step.kwargs)
+            else:
+                result = step.func(*step.args)
+        except BaseException as exc:  # noqa: BLE001 - исключение уходит обратно в сценарий
+            error = exc
+
+
+def _register_next_step(chat_id: int, step: str, *args) -> None:
+    """Запоминает, каким шагом диалога обработать следующее сообщение чата."""
+    _conversation_store.set(chat_id, step, list(args))
+
+
+def _build_main_menu() -> ReplyKeyboardMarkup:
+    """Создаёт главное меню с раскладами."""
+    markup = ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(
+        KeyboardButton("🃏 Одна карта"),
+        KeyboardButton("🧿 Две карты", web_app=WebAppInfo(url=WEBAPP_URL)),
+    )
+    markup.add(
+        KeyboardButton("🔮 Три карты"),
+        KeyboardButton(YES_NO_BUTTON_LABEL),
+    )
+    markup.add(KeyboardButton(CARD_OF_DAY_BUTTON_LABEL))
+    markup.add(KeyboardButton(CONSULTATION_MENU_LABEL))
+    return markup
+
+
+_TOPIC_SELECTION_LAYOUT = (
+    ("❤️ Любовь", "💼 Карьера"),
+    ("💰 Финансы", "🧘‍♀️ Здоровье"),
+    ("🧿 Совет дня",),
+)
+
+
+def _build_topic_selection_keyboard() -> ReplyKeyboardMarkup:
+    """Клавиатура с выбором тематики расклада."""
+
+    markup = ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in _TOPIC_SELECTION_LAYOUT:
+        buttons = [KeyboardButton(title) for title in row]
+        markup.add(*buttons)
+    markup.add(KeyboardButton(BACK_TO_MENU_LABEL))
+    return markup
+
+
+TOPIC_SELECTION_KEYBOARD = _build_topic_selection_keyboard()
+
+
+def _build_consultation_keyboard() -> InlineKeyboardMarkup:
+    """Кнопка с предложением личной консультации."""
+    markup = InlineKeyboardMarkup()
+    markup.add(
+        InlineKeyboardButton(
+            f"Получить консультацию за {CONSULTATION_PRICE_STARS}⭐️",
+            callback_data="buy_consultation",
+        )
+    )
+    return markup
+
+
+def _consultation_offer_flow(chat_id: int):
+    """
+    Отправляет предложение о личной консультации.
+
+    Даже если STARS_PROVIDER_TOKEN пустой, для цифровых услуг оплата
+    звёздами по доке Telegram разрешена, поэтому мы просто шлём инвойс
+    с тем, что есть.
+    """
+    yield _api(
+        "send_message",
+        chat_id,
+        f"💫 Хочешь разобрать вопрос глубже? Доступна личная консультация "
+        f"с тарологом за {CONSULTATION_PRICE_STARS} звёзд Telegram.",
+        reply_markup=_build_consultation_keyboard(),
+    )
+
+
+# === Кэш file_id для картинок карт ===
+# Telegram возвращает file_id после первой загрузки фото. Повторно
+# отправлять файл по file_id намного дешевле, чем каждый раз грузить PNG.
+_photo_file_id_cache: Dict[str, Dict[str, object]] = {}
+_photo_cache_lock = threading.Lock()
+
+
+def _read_photo_file_id_cache() -> Dict[str, Dict[str, object]]:
+    """Читает кэш file_id с диска; битый или отсутствующий файл — пустой кэш."""
+    if not os.path.exists(PHOTO_FILE_ID_CACHE_PATH):
+        return {}
+
+    try:
+        with open(PHOTO_FILE_ID_CACHE_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось загрузить кэш file_id картинок: {exc}", flush=True)
+        return {}
+
+    if not isinstance(data, dict):
+        return {}
+
+    return {
+        str(path): entry
+        for path, entry in data.items()
+        if isinstance(entry, dict) and isinstance(entry.get("file_id"), str)
+    }
+
+
+def _load_photo_file_id_cache() -> None:
+    """Загружает сохранённые file_id картинок из файла."""
+    global _photo_file_id_cache
+    _photo_file_id_cache = _read_photo_file_id_cache()
+
+
+def _save_photo_file_id_cache(path: str) -> None:
+    """Сохраняет изменение записи path. Вызывается под _photo_cache_lock.
+
+    Файл общий для всех воркеров: под межпроцессным замком перечитываем его,
+    переносим только свою запись и пишем через собственный временный файл,
+    чтобы не затереть file_id, сохранённые другими процессами.
+    """
+    try:
+        with _observe_duration(_persist_seconds, "photo_file_ids"):
+            with _interprocess_lock(f"{PHOTO_FILE_ID_CACHE_PATH}.lock"):
+                merged = _read_photo_file_id_cache()
+                entry = _photo_file_id_cache.get(path)
+                if entry is None:
+                    merged.pop(path, None)
+                else:
+                    merged[path] = entry
+
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=STATE_DIR, prefix="photo_file_ids.", suffix=".tmp"
+                )
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(merged, f, ensure_ascii=False, indent=2)
+                    os.replace(tmp_path, PHOTO_FILE_ID_CACHE_PATH)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp_path)
+                    raise
+    except OSError as exc:
+        print(f"Не удалось сохранить кэш file_id картинок: {exc}", flush=True)
+        return
+
+    # Заодно подхватываем записи, которые добавили другие процессы.
+    _photo_file_id_cache.clear()
+    _photo_file_id_cache.update(merged)
+
+
+def _hash_image_file(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
         return None
 
-    rank = parts[0]
-    suit = parts[-1]
 
-    rank_en = _RANK_IMAGE_MAP.get(rank)
-    suit_en = _SUIT_IMAGE_MAP.get(suit)
+def _get_cached_photo_file_id(path: str) -> str | None:
+    """Возвращает file_id, если картинка не менялась с момента загрузки."""
+    with _photo_cache_lock:
+        entry = _photo_file_id_cache.get(path)
+        if entry is None:
+            return None
 
-    if rank_en and suit_en:
-        return f"{rank_en}_of_{suit_en}"
+        fingerprint = _get_image_fingerprint(path)
+        if fingerprint is None:
+            return None
+        mtime_ns, size = fingerprint
 
-    return None
+        if entry.get("mtime_ns") == mtime_ns and entry.get("size") == size:
+            return entry["file_id"]
 
+        # mtime поменялся — сверяем содержимое, вдруг файл просто «потрогали».
+        if entry.get("size") == size and entry.get("sha256") == _hash_image_file(path):
+            entry["mtime_ns"] = mtime_ns
+            _save_photo_file_id_cache(path)
+            return entry["file_id"]
 
-def _get_card_image_path(card_name: str) -> str | None:
-    basename = _get_card_image_basename(card_name)
-    if not basename:
+        _photo_file_id_cache.pop(path, None)
+        _save_photo_file_id_cache(path)
         return None
 
-    path = os.path.join(CARDS_FOLDER, f"{basename}.png")
-    if os.path.exists(path):
-        return path
 
-    return None
+def _remember_photo_file_id(path: str, sent_message) -> None:
+    photos = getattr(sent_message, "photo", None) or []
+    if not photos:
+        return
 
+    # Последний элемент — самое большое превью, его и переиспользуем.
+    file_id = getattr(photos[-1], "file_id", None)
+    if not isinstance(file_id, str):
+        return
 
-def _draw_yes_no_answer() -> tuple[str, str] | None:
-    if not _yes_no_answers:
+    fingerprint = _get_image_fingerprint(path)
+    if fingerprint is None:
+        return
+
+    with _photo_cache_lock:
+        _photo_file_id_cache[path] = {
+            "file_id": file_id,
+            "mtime_ns": fingerprint[0],
+            "size": fingerprint[1],
+            "sha256": _hash_image_file(path),
+        }
+        _save_photo_file_id_cache(path)
+
+
+def _forget_photo_file_id(path: str) -> None:
+    with _photo_cache_lock:
+        if _photo_file_id_cache.pop(path, None) is not None:
+            _save_photo_file_id_cache(path)
+
+
+# Фрагменты описания ошибки 400, по которым видно, что не принят именно
+# file_id. Остальные 400 (подпись, разметка, чат не найден) повторная
+# загрузка не исправит.
+_STALE_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "file reference",
+    "wrong remote file",
+    "file_id",
+)
+
+
+def _is_stale_file_id_error(exc: ApiTelegramException) -> bool:
+    description = str(exc.description or "").lower()
+    return exc.error_code == 400 and any(marker in description for marker in _STALE_FILE_ID_ERRORS)
+
+
+def _read_image_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _card_photo_flow(chat_id: int, path: str, **kwargs):
+    """Отправляет картинку карты, по возможности используя кэшированный file_id."""
+    file_id = yield _local(_get_cached_photo_file_id, path)
+    if file_id:
+        try:
+            return (yield _api("send_photo", chat_id, file_id, **kwargs))
+        except ApiTelegramException as exc:
+            if not _is_stale_file_id_error(exc):
+                raise
+            # file_id мог протухнуть — загружаем файл заново.
+            print(f"file_id для {path} не принят, загружаем заново: {exc}", flush=True)
+            yield _local(_forget_photo_file_id, path)
+
+    photo = yield _local(_read_image_bytes, path)
+    sent = yield _api("send_photo", chat_id, photo, **kwargs)
+    yield _local(_remember_photo_file_id, path, sent)
+    return sent
+
+
+def _send_card_photo(chat_id: int, path: str, **kwargs):
+    return _run_flow(_card_photo_flow(chat_id, path, **kwargs))
+
+
+_load_photo_file_id_cache()
+
+
+@_traced_content
+def _get_card_of_day_for_date(date: datetime | None = None) -> tuple[str, str] | None:
+    target_date = (date or datetime.now(timezone.utc).date()).isoformat()
+    payload = card_of_day_schedule.get(target_date)
+
+    if not isinstance(payload, dict):
         return None
 
-    card = random.choice(list(_yes_no_answers.keys()))
-    return card, _yes_no_answers[card]
+    card = payload.get("card")
+    meaning = payload.get("meaning")
+
+    if isinstance(card, str) and isinstance(meaning, str):
+        return card, meaning
+
+    return None
+
+
+def _build_card_of_day_caption(card: str, meaning: str) -> str:
+    return (
+        "🗓️ <b>Карта дня</b>\n"
+        f"<b>{html.escape(card)}</b>\n\n"
+        f"{html.escape(meaning)}"
+    )
+
+
+def _card_of_day_message_flow(chat_id: int, card: str, meaning: str):
+    caption = _build_card_of_day_caption(card, meaning)
+
+    path = _get_card_image_path(card)
+    if path:
+        yield from _card_photo_flow(
+            chat_id,
+            path,
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=_build_main_menu(),
+        )
+        return
+
+    yield _api(
+        "send_message",
+        chat_id,
+        caption,
+        parse_mode="HTML",
+        reply_markup=_build_main_menu(),
+    )
+
+
+_DAILY_LIMIT_MESSAGES = {
+    READING_TYPE_SINGLE: (
+        "✨ Вселенная уже ответила тебе сегодня. Приходи завтра, когда "
+        "энергия обновится 🌙"
+    ),
+    READING_TYPE_YES_NO: (
+        "✨ Сегодня лимит на ответ да/нет уже исчерпан. Приходи завтра, "
+        "а если хочешь разобрать вопрос глубже — доступен расклад с "
+        "тарологом за 100 звёзд 🌙"
+    ),
+    READING_TYPE_TWO_CARDS: (
+        "✨ Сегодня лимит на расклад из двух карт уже исчерпан. Приходи "
+        "завтра за новой энергией 🌙"
+    ),
+    READING_TYPE_THREE_CARDS: (
+        "✨ Сегодня лимит на расклад из трёх карт уже исчерпан. Приходи "
+        "завтра за новой энергией 🌙"
+    ),
+}
+
+
+def _get_daily_limit_text(reading_type: str) -> str:
+    text = _DAILY_LIMIT_MESSAGES.get(reading_type)
+
+    if text is None:
+        text = (
+            "✨ На сегодня лимит раскладов исчерпан. Попробуй снова завтра."
+        )
+
+    return text
 
 
-def _build_yes_no_prompt_keyboard() -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("🔁 Получить ответ", callback_data=YES_NO_CALLBACK_DRAW))
-    return markup
+def _daily_limit_message_flow(chat_id: int, reading_type: str):
+    yield _api("send_message", chat_id, _get_daily_limit_text(reading_type))
+    yield from _consultation_offer_flow(chat_id)
+
+
+# === Главное меню ===
+@bot.message_handler(commands=['start'])
+def send_welcome(message):
+    _run_flow(_send_welcome_flow(message))
+
+
+def _send_welcome_flow(message):
+    _increment_daily_event(DAILY_EVENT_START)
+    user_id = getattr(getattr(message, "from_user", None), "id", None)
+    if user_id is None:
+        user_id = getattr(getattr(message, "chat", None), "id", None)
+    yield _local(_register_user_id, user_id)
+    yield _api(
+        "send_message",
+        message.chat.id,
+        "🌙 Привет! Я Таро-бот. Выбери расклад:",
+        reply_markup=_build_main_menu(),
+    )
+
 
+# === Одна карта с лимитом и выбором темы ===
 
-def _build_yes_no_repeat_keyboard() -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("🔁 Спросить ещё", callback_data=YES_NO_CALLBACK_DRAW))
-    return markup
+SINGLE_CARD_TOPICS = [
+    "❤️ Любовь",
+    "💼 Карьера",
+    "💰 Финансы",
+    "🧘‍♀️ Здоровье",
+    "🧿 Совет дня",
+]
 
 
-combinations_3cards_by_topic, _three_card_fallback_pool = _normalize_three_card_combinations(
-    _raw_three_card_data
-)
+def _refresh_user_usage(user_id: int) -> None:
+    """При общем хранилище перечитывает запись пользователя: её мог изменить другой процесс."""
+    if not _is_shared_state():
+        return
 
+    try:
+        with _observe_duration(_persist_seconds, "usage_store"):
+            user_usage = _usage_store.load_user(str(user_id))
+    except sqlite3.Error as exc:
+        print(f"Не удалось перечитать историю пользователя {user_id}: {exc}", flush=True)
+        return
 
-def _normalize_two_card_key(card1: str, card2: str) -> str:
-    """Возвращает ключ для двух карт в отсортированном виде."""
+    with _usage_lock:
+        _user_registry.replace_user(user_id, user_usage)
 
-    return "|".join(sorted([card1.strip(), card2.strip()]))
 
+def _has_used_reading_today(user_id: int, reading_type: str) -> bool:
+    """Проверяет, делал ли пользователь расклад указанного типа сегодня."""
+    today = _today_day()
+    _refresh_user_usage(user_id)
+    with _usage_lock:
+        return _user_registry.get_day(user_id, reading_type) == today
 
-def _draw_three_card_reading(topic_key: str) -> tuple[list[str], str] | None:
-    """Выбирает расклад из трёх карт по теме или из общего пула."""
 
-    topic_combinations = combinations_3cards_by_topic.get(topic_key)
+class _Reservation(NamedTuple):
+    """Занятый на сегодня расклад; previous — день, который вернуть при отмене (0 — не было)."""
 
-    if isinstance(topic_combinations, dict) and topic_combinations:
-        entries = list(topic_combinations.items())
-    else:
-        entries = list(_three_card_fallback_pool)
+    user_id: int | None
+    reading_type: str
+    day: int
+    previous: int
 
-    if not entries:
-        return None
 
-    combo_key, meaning = random.choice(entries)
-    cards = [part.strip() for part in combo_key.split("|") if part.strip()]
+def _reserve_reading_today(user_id: int | None, reading_type: str) -> _Reservation | None:
+    """Проверяет лимит и сразу занимает расклад. None — сегодня он уже был
+    (или в общем режиме хранилище недоступно и проверить это нельзя).
 
-    if len(cards) != 3:
-        return None
+    Админ и пользователь без id не ограничены: для них возвращается
+    пустая бронь, которую нечего отменять.
+    """
+    today = _today_day()
+    if user_id is None or user_id == ADMIN_ID:
+        return _Reservation(None, reading_type, today, 0)
 
-    return cards, meaning
+    if _is_shared_state():
+        # Память другого процесса не видна — решает общее хранилище.
+        try:
+            with _observe_duration(_persist_seconds, "usage_store"):
+                reserved, previous = _usage_store.reserve_reading(
+                    str(user_id), reading_type, _day_to_iso(today)
+                )
+        except sqlite3.Error as exc:
+            # Без хранилища лимит не проверить. Отказываем, а не выдаём
+            # расклад сверх лимита: пользователь сможет повторить позже.
+            print(
+                f"Не удалось занять расклад в хранилище, отказываем пользователю {user_id}: {exc}",
+                flush=True,
+            )
+            return None
 
+        with _usage_lock:
+            _user_registry.set_day(user_id, reading_type, today)
+        if not reserved:
+            return None
+        return _Reservation(user_id, reading_type, today, _iso_to_day(previous) or 0)
 
-def _split_two_card_key(key: str) -> list[str]:
-    """Разбивает ключ расклада на названия карт."""
+    with _usage_lock:
+        previous = _user_registry.get_day(user_id, reading_type)
+        if previous == today:
+            return None
+        _user_registry.set_day(user_id, reading_type, today)
 
-    if "|" in key:
-        parts = key.split("|")
-    elif "," in key:
-        parts = key.split(",")
-    else:
-        parts = key.split()
+    _persist_usage_event(
+        _usage_store.record_reading, str(user_id), reading_type, _day_to_iso(today)
+    )
+    return _Reservation(user_id, reading_type, today, previous)
 
-    return [part.strip() for part in parts if isinstance(part, str) and part.strip()]
 
+def _release_reading(reservation: _Reservation) -> None:
+    """Отменяет бронь, если расклад так и не дошёл до пользователя."""
+    if reservation.user_id is None:
+        return
 
-def _extract_two_card_meaning(value) -> str | None:
-    """Достаёт текст толкования из разных структур данных."""
+    with _usage_lock:
+        if _user_registry.get_day(reservation.user_id, reservation.reading_type) == reservation.day:
+            _user_registry.set_day(reservation.user_id, reservation.reading_type, reservation.previous)
+
+    _persist_usage_event(
+        _usage_store.release_reading,
+        str(reservation.user_id),
+        reservation.reading_type,
+        _day_to_iso(reservation.day),
+        _day_to_iso(reservation.previous) if reservation.previous else None,
+    )
 
-    if isinstance(value, str):
-        value = value.strip()
-        return value or None
 
-    if isinstance(value, dict):
-        for key in ("meaning", "text", "description", "value"):
-            nested = value.get(key)
-            if isinstance(nested, str) and nested.strip():
-                return nested.strip()
+def _released_on_failure_flow(reservation: _Reservation, flow):
+    """Если отправка расклада упала, слот возвращается пользователю."""
+    try:
+        return (yield from flow)
+    except BaseException:
+        yield _local(_release_reading, reservation)
+        raise
 
-    return None
 
+def _persist_usage_event(write, *args):
+    """Пишет событие в хранилище уже после освобождения _usage_lock.
 
-def _normalize_two_card_combinations(raw_data) -> Dict[str, str]:
-    """Приводит данные раскладов на две карты к словарю."""
+    Возвращает результат write или None, если запись не удалась.
+    """
+    try:
+        with _observe_duration(_persist_seconds, "usage_store"):
+            return write(*args)
+    except sqlite3.Error as exc:
+        print(
+            f"Не удалось сохранить историю вытягивания карт: {exc}",
+            flush=True,
+        )
+        return None
 
-    normalized: Dict[str, str] = {}
 
-    def _add_pair(card1: str, card2: str, meaning: str) -> None:
-        if not (isinstance(card1, str) and isinstance(card2, str) and isinstance(meaning, str)):
-            return
+def _has_used_single_card_today(user_id: int) -> bool:
+    """Проверяем, тянул ли пользователь карту сегодня."""
+    return _has_used_reading_today(user_id, READING_TYPE_SINGLE)
 
-        card1 = card1.strip()
-        card2 = card2.strip()
-        meaning = meaning.strip()
 
-        if not card1 or not card2 or not meaning:
-            return
+def _has_used_three_cards_today(user_id: int) -> bool:
+    return _has_used_reading_today(user_id, READING_TYPE_THREE_CARDS)
 
-        normalized[_normalize_two_card_key(card1, card2)] = meaning
 
-    def _process(obj) -> None:
-        if isinstance(obj, dict):
-            cards_field = obj.get("cards")
-            meaning_field = _extract_two_card_meaning(obj)
+def _has_used_yes_no_today(user_id: int) -> bool:
+    return _has_used_reading_today(user_id, READING_TYPE_YES_NO)
 
-            if isinstance(cards_field, (list, tuple)) and len(cards_field) >= 2 and meaning_field:
-                cards = [
-                    card for card in cards_field if isinstance(card, str) and card.strip()
-                ]
-                if len(cards) >= 2:
-                    _add_pair(cards[0], cards[1], meaning_field)
 
-            else:
-                card1 = obj.get("card1")
-                card2 = obj.get("card2")
-                if isinstance(card1, str) and isinstance(card2, str) and meaning_field:
-                    _add_pair(card1, card2, meaning_field)
+def _register_user_id(user_id: int | None) -> None:
+    """Добавляет пользователя в хранилище, если его там ещё нет."""
 
-            for key, value in obj.items():
-                if isinstance(key, str):
-                    parts = _split_two_card_key(key)
-                    if len(parts) == 2:
-                        meaning = _extract_two_card_meaning(value)
-                        if meaning:
-                            _add_pair(parts[0], parts[1], meaning)
-                            continue
+    if user_id is None:
+        return
 
-                _process(value)
+    _refresh_user_usage(user_id)
+    today = _today_day()
 
-        elif isinstance(obj, list):
-            for item in obj:
-                _process(item)
+    with _usage_lock:
+        is_new = _user_registry.add(user_id)
+        # Пользователь снова пишет боту — значит, больше не заблокировал его.
+        reactivated = not is_new and _user_registry.get(user_id, USER_INACTIVE_KEY) is not None
+        if reactivated:
+            _user_registry.set(user_id, USER_INACTIVE_KEY, None)
+        seen_today = _user_registry.get_day(user_id, USER_LAST_SEEN_KEY) == today
+        if not seen_today:
+            _user_registry.set_day(user_id, USER_LAST_SEEN_KEY, today)
+
+    if reactivated:
+        _persist_usage_event(_usage_store.forget_reading, str(user_id), USER_INACTIVE_KEY)
+    if not seen_today:
+        # Заодно регистрирует нового пользователя в хранилище.
+        _persist_usage_event(
+            _usage_store.record_reading, str(user_id), USER_LAST_SEEN_KEY, _day_to_iso(today)
+        )
 
-    _process(raw_data)
 
-    return normalized
+def _mark_user_inactive(user_id: int) -> None:
+    """Исключает пользователя из рассылок, пока он снова не напишет боту."""
+    today = _today_day()
 
+    with _usage_lock:
+        _user_registry.set_day(user_id, USER_INACTIVE_KEY, today)
 
-TWO_CARDS_URL = "https://raw.githubusercontent.com/nimixiss/tarot-webapp/main/two_card_combinations_full.json"
-try:
-    response = requests.get(TWO_CARDS_URL, timeout=15)
-    response.raise_for_status()
-    combinations_2cards_raw = response.json()
-    combinations_2cards = _normalize_two_card_combinations(combinations_2cards_raw)
-except requests.RequestException as exc:
-    combinations_2cards = {}
-    print(
-        f"Не удалось загрузить комбинации для двух карт: {exc}",
-        flush=True,
+    _persist_usage_event(
+        _usage_store.record_reading, str(user_id), USER_INACTIVE_KEY, _day_to_iso(today)
     )
 
 
-def _get_two_card_meaning(card1: str, card2: str) -> str | None:
-    """Возвращает толкование для пары карт, если оно известно."""
+def _collect_known_user_ids() -> list[int]:
+    """Возвращает список идентификаторов пользователей для рассылки."""
+    if _is_shared_state():
+        # Пользователи, пришедшие в другие процессы, есть только в хранилище.
+        _load_user_registry()
 
-    if not (isinstance(card1, str) and isinstance(card2, str)):
-        return None
+    with _usage_lock:
+        user_ids = _user_registry.active_user_ids()
 
-    key = _normalize_two_card_key(card1, card2)
-    meaning = combinations_2cards.get(key)
-    if isinstance(meaning, str) and meaning.strip():
-        return meaning
+    if ADMIN_ID not in user_ids:
+        user_ids.append(ADMIN_ID)
 
-    return None
+    return user_ids
 
 
-def _pick_random_card_meaning(card_name: str) -> str | None:
-    """Возвращает случайное значение для отдельной карты."""
+# === Жизненный цикл пользователей ===
+# Кто не появлялся USERS_ARCHIVE_AFTER_DAYS дней, переезжает из памяти и
+# хранилища в архив — файл JSON Lines, который бот только дописывает.
+# Туда же после рассылки попадают те, кому Telegram писать не даёт.
+# Вернувшийся пользователь просто регистрируется заново: его старые даты
+# раскладов на лимиты уже не влияют.
+USERS_ARCHIVE_AFTER_DAYS = int(os.getenv("USERS_ARCHIVE_AFTER_DAYS", "180"))  # 0 — не архивировать
+USERS_ARCHIVE_PATH = os.path.join(STATE_DIR, "users_archive.jsonl")
+USERS_PRUNE_INTERVAL_SECONDS = 6 * 3600
+USERS_FORGET_BATCH_SIZE = 1000
 
-    data = tarot_deck.get(card_name)
-    meanings = _collect_all_meanings(data)
-    if meanings:
-        return random.choice(meanings)
 
-    return None
+def _append_to_users_archive(records: list[dict]) -> bool:
+    try:
+        with _interprocess_lock(f"{USERS_ARCHIVE_PATH}.lock"):
+            with open(USERS_ARCHIVE_PATH, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                # Из хранилища пользователей удалим сразу после, так что
+                # архив должен лежать на диске раньше.
+                os.fsync(f.fileno())
+    except OSError as exc:
+        print(f"Не удалось дописать архив пользователей: {exc}", flush=True)
+        return False
+    return True
 
 
-def _draw_general_two_card_fallback() -> tuple[str, str, str] | None:
-    """Создаёт толкование по отдельным картам, если комбинаций нет."""
+def _evict_users(user_ids: list[int], reason: str) -> int:
+    """Переносит пользователей в архив и убирает их из памяти и хранилища."""
+    archived_at = datetime.now(timezone.utc).date().isoformat()
 
-    deck_cards = [card for card in tarot_deck.keys() if isinstance(card, str)]
-    if len(deck_cards) < 2:
-        return None
+    with _usage_lock:
+        records = []
+        for user_id in user_ids:
+            usage = _user_registry.get_user(user_id)
+            if usage is not None and user_id != ADMIN_ID:
+                records.append(
+                    {"user_id": user_id, "reason": reason, "archived_at": archived_at, "usage": usage}
+                )
+
+    if not records or not _append_to_users_archive(records):
+        return 0
+
+    # Пока писался архив, пользователь мог снова написать боту. Удаляем
+    # только тех, чьи данные не изменились со снимка; запись в архиве
+    # у вернувшегося просто останется историей.
+    snapshots = {record["user_id"]: record["usage"] for record in records}
+    with _usage_lock:
+        evicted = [
+            user_id
+            for user_id, usage in snapshots.items()
+            if _user_registry.get_user(user_id) == usage
+        ]
+        _user_registry.remove_many(evicted)
+
+    expected = {
+        str(user_id): {
+            field: snapshots[user_id][field]
+            for field in _USER_DAY_FIELDS
+            if field in snapshots[user_id]
+        }
+        for user_id in evicted
+    }
+    forgotten = {
+        int(user_id)
+        for user_id in _persist_usage_event(_usage_store.forget_users, expected) or ()
+    }
+
+    # В базе даты уже другие (пользователь пришёл через другой процесс, или
+    # запись не удалась) — возвращаем в память то, что лежит в базе.
+    for user_id in evicted:
+        if user_id not in forgotten:
+            try:
+                usage = _usage_store.load_user(str(user_id))
+            except sqlite3.Error as exc:
+                print(f"Не удалось перечитать пользователя {user_id}: {exc}", flush=True)
+                continue
+            with _usage_lock:
+                _user_registry.replace_user(user_id, usage)
 
-    card1, card2 = random.sample(deck_cards, 2)
-    meaning1 = _pick_random_card_meaning(card1)
-    meaning2 = _pick_random_card_meaning(card2)
+    # Пользователь написал этому процессу уже после удаления из памяти:
+    # он снова в реестре, а его строки могли попасть под удаление в базе.
+    with _usage_lock:
+        returned = {
+            user_id: usage
+            for user_id in forgotten
+            if (usage := _user_registry.get_user(user_id)) is not None
+        }
+    if returned:
+        _persist_usage_event(
+            _usage_store.record_many,
+            [
+                (str(user_id), key, value)
+                for user_id, usage in returned.items()
+                for key, value in usage.items()
+            ],
+        )
+    return len(forgotten) - len(returned)
 
-    parts = ["(Резервное толкование по отдельным картам)"]
-    if meaning1:
-        parts.append(f"• {card1}: {meaning1}")
-    else:
-        parts.append(f"• {card1}: значение не найдено.")
 
-    if meaning2:
-        parts.append(f"• {card2}: {meaning2}")
-    else:
-        parts.append(f"• {card2}: значение не найдено.")
+def _prune_inactive_users() -> int:
+    if USERS_ARCHIVE_AFTER_DAYS <= 0:
+        return 0
 
-    return card1, card2, "\n".join(parts)
+    if _is_shared_state():
+        # Другой процесс мог уже кого-то заархивировать или увидеть вернувшимся.
+        _load_user_registry()
 
-bot = telebot.TeleBot(TOKEN)
+    today = _today_day()
+    with _usage_lock:
+        stale, undated = _user_registry.stale_user_ids(today - USERS_ARCHIVE_AFTER_DAYS)
+        # Старые записи без единой даты: отсчёт неактивности начинаем с сегодня.
+        for user_id in undated:
+            _user_registry.set_day(user_id, USER_LAST_SEEN_KEY, today)
+
+    if undated:
+        today_str = _day_to_iso(today)
+        _persist_usage_event(
+            _usage_store.record_many,
+            [(str(user_id), USER_LAST_SEEN_KEY, today_str) for user_id in undated],
+        )
 
+    return _evict_users(stale, "inactive")
 
-def _build_main_menu() -> ReplyKeyboardMarkup:
-    """Создаёт главное меню с раскладами."""
-    markup = ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(
-        KeyboardButton("🃏 Одна карта"),
-        KeyboardButton("🧿 Две карты", web_app=WebAppInfo(url=WEBAPP_URL)),
-    )
-    markup.add(
-        KeyboardButton("🔮 Три карты"),
-        KeyboardButton(YES_NO_BUTTON_LABEL),
-    )
-    markup.add(KeyboardButton(CARD_OF_DAY_BUTTON_LABEL))
-    markup.add(KeyboardButton(CONSULTATION_MENU_LABEL))
-    return markup
 
+def _purge_unreachable_users() -> int:
+    """После рассылки убирает тех, кто заблокировал бота или удалил аккаунт."""
+    with _usage_lock:
+        user_ids = _user_registry.unreachable_user_ids()
+    return _evict_users(user_ids, "unreachable")
 
-_TOPIC_SELECTION_LAYOUT = (
-    ("❤️ Любовь", "💼 Карьера"),
-    ("💰 Финансы", "🧘‍♀️ Здоровье"),
-    ("🧿 Совет дня",),
-)
 
+def _user_prune_loop() -> None:
+    while True:
+        try:
+            archived = _prune_inactive_users()
+        except Exception as exc:  # noqa: BLE001 - поток архивации не должен умирать
+            print(f"Ошибка архивации пользователей: {exc}", flush=True)
+        else:
+            if archived:
+                print(f"В архив перенесено неактивных пользователей: {archived}", flush=True)
+        time.sleep(USERS_PRUNE_INTERVAL_SECONDS)
 
-def _build_topic_selection_keyboard() -> ReplyKeyboardMarkup:
-    """Клавиатура с выбором тематики расклада."""
 
-    markup = ReplyKeyboardMarkup(resize_keyboard=True)
-    for row in _TOPIC_SELECTION_LAYOUT:
-        buttons = [KeyboardButton(title) for title in row]
-        markup.add(*buttons)
-    markup.add(KeyboardButton(BACK_TO_MENU_LABEL))
-    return markup
+def _start_user_pruner() -> None:
+    if USERS_ARCHIVE_AFTER_DAYS <= 0:
+        return
+    thread = threading.Thread(target=_user_prune_loop, name="user-pruner", daemon=True)
+    thread.start()
+
+
+# === Рассылка ===
+# Telegram разрешает боту около 30 сообщений в секунду суммарно и не
+# больше одного сообщения в секунду в один чат.
+BROADCAST_STATE_PATH = os.path.join(STATE_DIR, "broadcast_state.json")
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+BROADCAST_PER_CHAT_INTERVAL_SECONDS = 1.0
+BROADCAST_PROGRESS_INTERVAL_SECONDS = 5.0
+BROADCAST_MAX_ATTEMPTS = 5
+
+
+class _TokenBucket:
+    """Ограничитель скорости: общий поток токенов плюс интервал для каждого чата."""
+
+    def __init__(self, rate: float, per_chat_interval: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.per_chat_interval = per_chat_interval
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next_slot: dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает все отправки, например по retry_after из ответа 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def acquire(self, chat_id: int) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                wait = max(
+                    self._paused_until - now,
+                    self._chat_next_slot.get(chat_id, 0.0) - now,
+                    (1.0 - self._tokens) / self.rate,
+                )
+                if wait <= 0:
+                    self._tokens -= 1.0
+                    self._chat_next_slot[chat_id] = now + self.per_chat_interval
+                    return
 
+            time.sleep(wait)
+
+
+class _BroadcastJob:
+    """Фоновая рассылка с сохранением прогресса в state_path."""
+
+    state_path = BROADCAST_STATE_PATH
+
+    def __init__(self, state: dict) -> None:
+        self.text: str = state["text"]
+        self.admin_chat_id: int = state["admin_chat_id"]
+        self.progress_message_id: int | None = state.get("progress_message_id")
+        self.recipients: list[int] = state["recipients"]
+        self.cursor: int = state.get("cursor", 0)
+        self.delivered: int = state.get("delivered", 0)
+        self.failed: int = state.get("failed", 0)
+        self.blocked: int = state.get("blocked", 0)
+        self.started_at: float = state.get("started_at", time.time())
+        self.purged = 0
+
+        # Всё, что меньше cursor, уже обработано; выше курсора воркеры
+        # завершают отправки не по порядку, поэтому держим отметки.
+        self._done = bytearray(len(self.recipients))
+        self._next_index = self.cursor
+        self._lock = threading.Lock()
+        self._limiter = _TokenBucket(BROADCAST_GLOBAL_RATE, BROADCAST_PER_CHAT_INTERVAL_SECONDS)
+
+    def to_state(self) -> dict:
+        with self._lock:
+            return {
+                "text": self.text,
+                "admin_chat_id": self.admin_chat_id,
+                "progress_message_id": self.progress_message_id,
+                "recipients": self.recipients,
+                "cursor": self.cursor,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "blocked": self.blocked,
+                "started_at": self.started_at,
+            }
 
-TOPIC_SELECTION_KEYBOARD = _build_topic_selection_keyboard()
+    def save(self) -> None:
+        try:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.to_state(), f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+        except OSError as exc:
+            print(f"Не удалось сохранить состояние рассылки: {exc}", flush=True)
+
+    def _take_index(self) -> int | None:
+        with self._lock:
+            if self._next_index >= len(self.recipients):
+                return None
+            index = self._next_index
+            self._next_index += 1
+            return index
+
+    def _finish_index(self, index: int, outcome: str) -> None:
+        with self._lock:
+            if outcome == "delivered":
+                self.delivered += 1
+            elif outcome == "blocked":
+                self.blocked += 1
+            else:
+                self.failed += 1
 
+            self._done[index] = 1
+            while self.cursor < len(self.recipients) and self._done[self.cursor]:
+                self.cursor += 1
 
-def _build_consultation_keyboard() -> InlineKeyboardMarkup:
-    """Кнопка с предложением личной консультации."""
-    markup = InlineKeyboardMarkup()
-    markup.add(
-        InlineKeyboardButton(
-            f"Получить консультацию за {CONSULTATION_PRICE_STARS}⭐️",
-            callback_data="buy_consultation",
-        )
-    )
-    return markup
+    def _send_one(self, chat_id: int) -> str:
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            self._limiter.acquire(chat_id)
+            try:
+                self._deliver(chat_id)
+                return "delivered"
+            except ApiTelegramException as exc:
+                if exc.error_code == 429:
+                    parameters = exc.result_json.get("parameters") or {}
+                    retry_after = parameters.get("retry_after", 1)
+                    self._limiter.pause(float(retry_after))
+                    continue
+
+                # 403 — бот заблокирован или аккаунт удалён; «chat not found» —
+                # такого чата больше нет. Писать им бесполезно.
+                if exc.error_code == 403 or (
+                    exc.error_code == 400 and "chat not found" in str(exc.description).lower()
+                ):
+                    _mark_user_inactive(chat_id)
+                    return "blocked"
+
+                print(
+                    f"Не удалось отправить сообщение пользователю {chat_id}: {exc}",
+                    flush=True,
+                )
+                return "failed"
+            except Exception as exc:  # noqa: BLE001 - хотим залогировать любые ошибки
+                print(
+                    f"Не удалось отправить сообщение пользователю {chat_id}: {exc}",
+                    flush=True,
+                )
+                return "failed"
+
+        print(f"Сообщение пользователю {chat_id} не отправлено: слишком много 429.", flush=True)
+        return "failed"
+
+    def _deliver(self, chat_id: int) -> None:
+        bot.send_message(chat_id, self.text)
+
+    def _worker(self) -> None:
+        while True:
+            index = self._take_index()
+            if index is None:
+                return
+            self._finish_index(index, self._send_one(self.recipients[index]))
+
+    def _format_progress(self, finished: bool = False) -> str:
+        with self._lock:
+            processed = self.delivered + self.failed + self.blocked
+            elapsed = max(time.time() - self.started_at, 1e-6)
+            lines = [
+                "📣 Рассылка завершена." if finished else "📣 Идёт рассылка…",
+                f"Всего получателей: {len(self.recipients)}",
+                f"Обработано: {processed}",
+                f"Успешно доставлено: {self.delivered}",
+                f"Заблокировали бота: {self.blocked}",
+                f"С ошибкой: {self.failed}",
+                f"Скорость: {processed / elapsed:.1f} сообщ./с",
+            ]
+            if finished:
+                lines.append(f"Убрано из базы недоступных: {self.purged}")
+        return "\n".join(lines)
+
+    def _report_progress(self, finished: bool = False) -> None:
+        text = self._format_progress(finished)
+        try:
+            if self.progress_message_id is None:
+                self.progress_message_id = bot.send_message(self.admin_chat_id, text).message_id
+            else:
+                bot.edit_message_text(text, self.admin_chat_id, self.progress_message_id)
+        except ApiTelegramException as exc:
+            # «message is not modified» и прочие мелочи не должны мешать рассылке.
+            print(f"Не удалось обновить прогресс рассылки: {exc}", flush=True)
 
+    def run(self) -> None:
+        workers = [
+            threading.Thread(target=self._worker, name=f"broadcast-{i}", daemon=True)
+            for i in range(max(1, BROADCAST_WORKERS))
+        ]
+        for worker in workers:
+            worker.start()
+
+        while any(worker.is_alive() for worker in workers):
+            # Ждём всех воркеров, но не дольше интервала прогресса: ожидание
+            # одного уже завершившегося потока вернулось бы сразу.
+            deadline = time.monotonic() + BROADCAST_PROGRESS_INTERVAL_SECONDS
+            for worker in workers:
+                worker.join(max(0.0, deadline - time.monotonic()))
+            self.save()
+            self._report_progress()
 
-def _send_consultation_offer(chat_id: int) -> None:
-    """
-    Отправляет предложение о личной консультации.
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
 
-    Даже если STARS_PROVIDER_TOKEN пустой, для цифровых услуг оплата
-    звёздами по доке Telegram разрешена, поэтому мы просто шлём инвойс
-    с тем, что есть.
-    """
-    bot.send_message(
-        chat_id,
-        f"💫 Хочешь разобрать вопрос глубже? Доступна личная консультация "
-        f"с тарологом за {CONSULTATION_PRICE_STARS} звёзд Telegram.",
-        reply_markup=_build_consultation_keyboard(),
-    )
+        self.purged = _purge_unreachable_users()
+        self._report_progress(finished=True)
 
 
-def _get_card_of_day_for_date(date: datetime | None = None) -> tuple[str, str] | None:
-    target_date = (date or datetime.now(timezone.utc).date()).isoformat()
-    payload = card_of_day_schedule.get(target_date)
+_broadcast_lock = threading.Lock()
+_active_broadcast: _BroadcastJob | None = None
+# Файл-замок держит процесс, который сейчас ведёт рассылку: при общем
+# STATE_DIR второй процесс не начнёт свою и не подхватит чужую.
+BROADCAST_LOCK_PATH = f"{BROADCAST_STATE_PATH}.lock"
 
-    if not isinstance(payload, dict):
-        return None
 
-    card = payload.get("card")
-    meaning = payload.get("meaning")
+def _run_broadcast_job(job: _BroadcastJob, lock_file) -> None:
+    global _active_broadcast
 
-    if isinstance(card, str) and isinstance(meaning, str):
-        return card, meaning
+    try:
+        job.run()
+    except Exception as exc:  # noqa: BLE001 - состояние останется на диске для повтора
+        print(f"Рассылка прервана: {exc}", flush=True)
+    finally:
+        with _broadcast_lock:
+            _active_broadcast = None
+        lock_file.close()
+
+
+def _start_broadcast_job(job: _BroadcastJob, lock_file=None) -> bool:
+    global _active_broadcast
+
+    with _broadcast_lock:
+        if _active_broadcast is not None:
+            return False
+
+        if lock_file is None:
+            lock_file = _try_interprocess_lock(BROADCAST_LOCK_PATH)
+            if lock_file is None:
+                return False
+        _active_broadcast = job
+
+    job.save()
+    threading.Thread(
+        target=_run_broadcast_job, args=(job, lock_file), name="broadcast", daemon=True
+    ).start()
+    return True
+
+
+def _resume_pending_broadcast() -> None:
+    """Продолжает рассылку, прерванную перезапуском бота."""
+    if not os.path.exists(BROADCAST_STATE_PATH):
+        return
 
-    return None
+    lock_file = _try_interprocess_lock(BROADCAST_LOCK_PATH)
+    if lock_file is None:
+        print("Рассылку уже продолжает другой процесс.", flush=True)
+        return
 
+    # Файл читаем под замком: другой процесс мог успеть закончить рассылку.
+    try:
+        with open(BROADCAST_STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        job = _BroadcastJob(state)
+    except FileNotFoundError:
+        lock_file.close()
+        return
+    except (OSError, json.JSONDecodeError, KeyError, TypeError) as exc:
+        print(f"Не удалось восстановить рассылку: {exc}", flush=True)
+        lock_file.close()
+        return
 
-def _send_card_of_day_message(chat_id: int, card: str, meaning: str) -> None:
-    caption = (
-        "🗓️ <b>Карта дня</b>\n"
-        f"<b>{html.escape(card)}</b>\n\n"
-        f"{html.escape(meaning)}"
+    print(
+        f"Продолжаем рассылку с позиции {job.cursor} из {len(job.recipients)}.",
+        flush=True,
     )
+    if not _start_broadcast_job(job, lock_file):
+        lock_file.close()
 
-    path = _get_card_image_path(card)
-    if path:
-        with open(path, "rb") as photo:
-            bot.send_photo(
-                chat_id,
-                photo,
-                caption=caption,
-                parse_mode="HTML",
-                reply_markup=_build_main_menu(),
-            )
+
+def _perform_broadcast_flow(message, text: str):
+    recipients = yield _local(_collect_known_user_ids)
+
+    if not recipients:
+        yield _api(
+            "send_message",
+            message.chat.id,
+            "Пока некого уведомлять — список пользователей пуст.",
+        )
         return
 
-    bot.send_message(
-        chat_id,
-        caption,
-        parse_mode="HTML",
-        reply_markup=_build_main_menu(),
+    job = _BroadcastJob(
+        {"text": text, "admin_chat_id": message.chat.id, "recipients": recipients}
     )
 
+    if not (yield _local(_start_broadcast_job, job)):
+        yield _api(
+            "send_message",
+            message.chat.id,
+            "Предыдущая рассылка ещё идёт — дождись её завершения.",
+        )
 
-_DAILY_LIMIT_MESSAGES = {
-    READING_TYPE_SINGLE: (
-        "✨ Вселенная уже ответила тебе сегодня. Приходи завтра, когда "
-        "энергия обновится 🌙"
-    ),
-    READING_TYPE_YES_NO: (
-        "✨ Сегодня лимит на ответ да/нет уже исчерпан. Приходи завтра, "
-        "а если хочешь разобрать вопрос глубже — доступен расклад с "
-        "тарологом за 100 звёзд 🌙"
-    ),
-    READING_TYPE_TWO_CARDS: (
-        "✨ Сегодня лимит на расклад из двух карт уже исчерпан. Приходи "
-        "завтра за новой энергией 🌙"
-    ),
-    READING_TYPE_THREE_CARDS: (
-        "✨ Сегодня лимит на расклад из трёх карт уже исчерпан. Приходи "
-        "завтра за новой энергией 🌙"
-    ),
-}
 
+# === Карта дня по подписке ===
+# Подписчики (/daily) получают карту дня в CARD_OF_DAY_PUSH_TIME по своему
+# часовому поясу. Для каждого пояса, где наступило это время, собирается
+# одна подпись и список получателей, и дальше это обычная рассылка: тот же
+# ограничитель скорости, сохранение прогресса и замок — рассылка админа
+# и карта дня не делят лимит Telegram друг с другом одновременно.
+# Картинка загружается один раз, остальным уходит её file_id.
+CARD_OF_DAY_PUSH_TIME = os.getenv("CARD_OF_DAY_PUSH_TIME", "09:00").strip()  # пусто — выключено
+CARD_OF_DAY_DEFAULT_UTC_OFFSET = os.getenv("CARD_OF_DAY_DEFAULT_UTC_OFFSET", "+03:00")
+CARD_OF_DAY_PUSH_STATE_PATH = os.path.join(STATE_DIR, "card_of_day_push.json")
+CARD_OF_DAY_PUSH_JOB_PATH = os.path.join(STATE_DIR, "card_of_day_push_job.json")
+CARD_OF_DAY_PUSH_CHECK_SECONDS = 30
+# Если бот лежал в нужный момент, карту дня досылаем не позже, чем через столько.
+CARD_OF_DAY_PUSH_CATCHUP_HOURS = 3
+
+_card_of_day_pushes = _CounterMetric(
+    "taro_card_of_day_push_total", "Отправки карты дня подписчикам.", ("outcome",)
+)
 
-def _send_daily_limit_message(chat_id: int, reading_type: str) -> None:
-    text = _DAILY_LIMIT_MESSAGES.get(reading_type)
 
-    if text is None:
-        text = (
-            "✨ На сегодня лимит раскладов исчерпан. Попробуй снова завтра."
-        )
+class _CardOfDayPushJob(_BroadcastJob):
+    """Рассылка карты дня подписчикам одного часового пояса."""
 
-    bot.send_message(chat_id, text)
-    _send_consultation_offer(chat_id)
+    state_path = CARD_OF_DAY_PUSH_JOB_PATH
 
+    def __init__(self, state: dict) -> None:
+        super().__init__(state)
+        self.utc_offset: str = state["utc_offset"]
+        self.local_date: str = state["local_date"]
+        self.card: str = state["card"]
+        self._image_path = _get_card_image_path(self.card)
+        self._reply_markup = _build_main_menu()
+        self._upload_lock = threading.Lock()
 
-# === Главное меню ===
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
-    _increment_daily_event(DAILY_EVENT_START)
-    user_id = getattr(getattr(message, "from_user", None), "id", None)
-    if user_id is None:
-        user_id = getattr(getattr(message, "chat", None), "id", None)
-    _register_user_id(user_id)
-    bot.send_message(
-        message.chat.id,
-        "🌙 Привет! Я Таро-бот. Выбери расклад:",
-        reply_markup=_build_main_menu(),
-    )
+    def to_state(self) -> dict:
+        state = super().to_state()
+        state.update(utc_offset=self.utc_offset, local_date=self.local_date, card=self.card)
+        return state
 
+    def _deliver(self, chat_id: int) -> None:
+        kwargs = {"parse_mode": "HTML", "reply_markup": self._reply_markup}
+        if not self._image_path:
+            bot.send_message(chat_id, self.text, **kwargs)
+        elif _get_cached_photo_file_id(self._image_path):
+            _send_card_photo(chat_id, self._image_path, caption=self.text, **kwargs)
+        else:
+            # Пока file_id нет, картинку загружает один воркер, остальные ждут его.
+            with self._upload_lock:
+                _send_card_photo(chat_id, self._image_path, caption=self.text, **kwargs)
 
-# === Одна карта с лимитом и выбором темы ===
+    def _finish_index(self, index: int, outcome: str) -> None:
+        _card_of_day_pushes.inc(outcome)
+        super()._finish_index(index, outcome)
 
-SINGLE_CARD_TOPICS = [
-    "❤️ Любовь",
-    "💼 Карьера",
-    "💰 Финансы",
-    "🧘‍♀️ Здоровье",
-    "🧿 Совет дня",
-]
+    def _report_progress(self, finished: bool = False) -> None:
+        if not finished:
+            return
+        with self._lock:
+            elapsed = max(time.time() - self.started_at, 1e-6)
+            processed = self.delivered + self.failed + self.blocked
+            print(
+                f"Карта дня {self.local_date} для UTC{self.utc_offset}: "
+                f"доставлено {self.delivered} из {len(self.recipients)}, "
+                f"заблокировали {self.blocked}, с ошибкой {self.failed}, "
+                f"{elapsed:.1f} с, {processed / elapsed:.1f} сообщ./с",
+                flush=True,
+            )
 
 
-def _has_used_reading_today(user_id: int, reading_type: str) -> bool:
-    """Проверяет, делал ли пользователь расклад указанного типа сегодня."""
-    today = datetime.now(timezone.utc).date().isoformat()
-    with _usage_lock:
-        return (
-            single_card_usage.get(str(user_id), {}).get(reading_type) == today
-        )
+def _get_card_of_day_push_time() -> tuple[int, int] | None:
+    hours_str, _, minutes_str = CARD_OF_DAY_PUSH_TIME.partition(":")
+    try:
+        hours, minutes = int(hours_str), int(minutes_str or 0)
+    except ValueError:
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours, minutes
 
 
-def _mark_reading_used_today(user_id: int, reading_type: str) -> None:
-    """Помечает расклад указанного типа выполненным сегодня."""
-    today = datetime.now(timezone.utc).date().isoformat()
-    with _usage_lock:
-        user_usage = single_card_usage.setdefault(str(user_id), {})
-        user_usage[reading_type] = today
-        _save_single_card_usage()
+def _load_card_of_day_push_state() -> dict[str, str]:
+    """Часовой пояс → последняя местная дата, за которую карта дня уже ушла."""
+    if not os.path.exists(CARD_OF_DAY_PUSH_STATE_PATH):
+        return {}
 
+    try:
+        with open(CARD_OF_DAY_PUSH_STATE_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as exc:
+        print(f"Не удалось прочитать состояние рассылки карты дня: {exc}", flush=True)
+        return {}
 
-def _has_used_single_card_today(user_id: int) -> bool:
-    """Проверяем, тянул ли пользователь карту сегодня."""
-    return _has_used_reading_today(user_id, READING_TYPE_SINGLE)
+    return data if isinstance(data, dict) else {}
 
 
-def _mark_single_card_used_today(user_id: int) -> None:
-    _mark_reading_used_today(user_id, READING_TYPE_SINGLE)
+def _save_card_of_day_push_state(sent: dict[str, str]) -> None:
+    try:
+        tmp_path = f"{CARD_OF_DAY_PUSH_STATE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(sent, f, ensure_ascii=False)
+        os.replace(tmp_path, CARD_OF_DAY_PUSH_STATE_PATH)
+    except OSError as exc:
+        print(f"Не удалось сохранить состояние рассылки карты дня: {exc}", flush=True)
+
 
+def _resume_card_of_day_push() -> _CardOfDayPushJob | None:
+    if not os.path.exists(CARD_OF_DAY_PUSH_JOB_PATH):
+        return None
 
-def _has_used_two_cards_today(user_id: int) -> bool:
-    return _has_used_reading_today(user_id, READING_TYPE_TWO_CARDS)
+    try:
+        with open(CARD_OF_DAY_PUSH_JOB_PATH, "r", encoding="utf-8") as f:
+            job = _CardOfDayPushJob(json.load(f))
+    except (OSError, json.JSONDecodeError, KeyError, TypeError) as exc:
+        print(f"Не удалось восстановить рассылку карты дня: {exc}", flush=True)
+        return None
 
+    print(
+        f"Продолжаем карту дня для UTC{job.utc_offset} с позиции {job.cursor} "
+        f"из {len(job.recipients)}.",
+        flush=True,
+    )
+    return job
 
-def _mark_two_cards_used_today(user_id: int) -> None:
-    _mark_reading_used_today(user_id, READING_TYPE_TWO_CARDS)
 
+def _next_card_of_day_push() -> _CardOfDayPushJob | None:
+    """Собирает рассылку для первого часового пояса, где пора слать карту дня."""
+    push_time = _get_card_of_day_push_time()
+    if push_time is None:
+        return None
 
-def _has_used_three_cards_today(user_id: int) -> bool:
-    return _has_used_reading_today(user_id, READING_TYPE_THREE_CARDS)
+    sent = _load_card_of_day_push_state()
+    now = datetime.now(timezone.utc)
+    with _usage_lock:
+        slots = _user_registry.push_slots()
+
+    job = None
+    changed = False
+    for slot in sorted(slots):
+        offset = _push_slot_to_offset(slot)
+        utc_offset = _format_utc_offset(offset)
+        # Местное время пояса, записанное как UTC: так удобно сравнивать.
+        local_now = now + timedelta(minutes=offset)
+        local_date = local_now.date()
+        if sent.get(utc_offset) == local_date.isoformat():
+            continue
 
+        lateness = local_now - local_now.replace(
+            hour=push_time[0], minute=push_time[1], second=0, microsecond=0
+        )
+        if lateness < timedelta(0):
+            continue
 
-def _mark_three_cards_used_today(user_id: int) -> None:
-    _mark_reading_used_today(user_id, READING_TYPE_THREE_CARDS)
+        sent[utc_offset] = local_date.isoformat()
+        changed = True
+        if lateness > timedelta(hours=CARD_OF_DAY_PUSH_CATCHUP_HOURS):
+            print(f"Карту дня для UTC{utc_offset} пропускаем: слишком поздно.", flush=True)
+            continue
 
+        result = _get_card_of_day_for_date(local_date)
+        if result is None:
+            print(f"Карты дня на {local_date} нет — UTC{utc_offset} пропускаем.", flush=True)
+            continue
 
-def _has_used_yes_no_today(user_id: int) -> bool:
-    return _has_used_reading_today(user_id, READING_TYPE_YES_NO)
+        if _is_shared_state():
+            # Подписаться могли через другой процесс.
+            _load_user_registry()
+        with _usage_lock:
+            recipients = _user_registry.push_subscribers(slot)
+        if not recipients:
+            continue
 
+        card, meaning = result
+        job = _CardOfDayPushJob(
+            {
+                "text": _build_card_of_day_caption(card, meaning)
+                + "\n\n<i>Отписаться: /daily off</i>",
+                "admin_chat_id": ADMIN_ID,
+                "recipients": recipients,
+                "utc_offset": utc_offset,
+                "local_date": local_date.isoformat(),
+                "card": card,
+            }
+        )
+        # Сначала сохраняем саму рассылку: упади бот между записями — она
+        # продолжится после перезапуска, а не потеряется.
+        job.save()
+        break
 
-def _mark_yes_no_used_today(user_id: int) -> None:
-    _mark_reading_used_today(user_id, READING_TYPE_YES_NO)
+    if changed:
+        _save_card_of_day_push_state(sent)
+    return job
 
 
-def _register_user_id(user_id: int | None) -> None:
-    """Добавляет пользователя в хранилище, если его там ещё нет."""
+def _run_due_card_of_day_push() -> None:
+    with _broadcast_lock:
+        if _active_broadcast is not None:
+            return
 
-    if user_id is None:
+    lock_file = _try_interprocess_lock(BROADCAST_LOCK_PATH)
+    if lock_file is None:
         return
 
-    str_user_id = str(user_id)
+    # Всё решаем под замком: другой процесс мог только что разослать этот пояс.
+    job = _resume_card_of_day_push() or _next_card_of_day_push()
+    if job is None or not _start_broadcast_job(job, lock_file):
+        lock_file.close()
 
-    with _usage_lock:
-        if str_user_id in single_card_usage:
-            return
 
-        single_card_usage[str_user_id] = {}
-        _save_single_card_usage()
+def _card_of_day_push_loop() -> None:
+    while True:
+        try:
+            _run_due_card_of_day_push()
+        except Exception as exc:  # noqa: BLE001 - планировщик не должен умирать
+            print(f"Ошибка рассылки карты дня: {exc}", flush=True)
+        time.sleep(CARD_OF_DAY_PUSH_CHECK_SECONDS)
 
 
-def _collect_known_user_ids() -> list[int]:
-    """Возвращает список идентификаторов пользователей для рассылки."""
+def _start_card_of_day_pusher() -> None:
+    if _get_card_of_day_push_time() is None:
+        if CARD_OF_DAY_PUSH_TIME:
+            print(f"Не понимаю CARD_OF_DAY_PUSH_TIME={CARD_OF_DAY_PUSH_TIME!r}, нужно ЧЧ:ММ.", flush=True)
+        return
+    thread = threading.Thread(target=_card_of_day_push_loop, name="card-of-day-push", daemon=True)
+    thread.start()
+
 
+def _set_card_of_day_push(user_id: int, utc_offset: str | None) -> None:
     with _usage_lock:
-        user_ids: list[int] = []
+        _user_registry.set(user_id, USER_CARD_OF_DAY_PUSH_KEY, utc_offset)
 
-        for stored_id in single_card_usage.keys():
-            try:
-                user_ids.append(int(stored_id))
-            except (TypeError, ValueError):
-                continue
+    _persist_usage_event(_usage_store.set_card_of_day_push, str(user_id), utc_offset)
 
-    if ADMIN_ID not in user_ids:
-        user_ids.append(ADMIN_ID)
 
-    return user_ids
+# Для режима с одной картой у каждого пользователя своя «колода»: карты не
+# повторяются, пока он не вытянет все 78. Вместо списка храним только seed
+# перестановки и позицию в ней.
+_anonymous_deck_cursor = f"{random.getrandbits(31)}:0"
+# Курсор сдвигается на каждом раскладе. В локальном режиме пишем его не сразу,
+# а пачкой раз в DECK_CURSOR_FLUSH_SECONDS: при падении теряются лишь последние
+# шаги по колоде. В общем режиме другой процесс перечитывает курсор из базы,
+# поэтому там он пишется сразу.
+DECK_CURSOR_FLUSH_SECONDS = float(os.getenv("DECK_CURSOR_FLUSH_SECONDS", "5"))
+_dirty_deck_cursors: set[int] = set()
 
 
-def _broadcast_message_to_all(text: str) -> tuple[int, int, int]:
-    """Отправляет сообщение всем известным пользователям."""
+@functools.lru_cache(maxsize=4096)
+def _deck_permutation(seed: int, size: int) -> tuple[int, ...]:
+    order = list(range(size))
+    random.Random(seed).shuffle(order)
+    return tuple(order)
 
-    delivered = 0
-    failed = 0
-    recipients = _collect_known_user_ids()
 
-    if not recipients:
-        return 0, delivered, failed
+def _parse_deck_cursor(raw: str | None) -> tuple[int, int] | None:
+    if not raw:
+        return None
+    seed_str, _, index_str = raw.partition(":")
+    try:
+        return int(seed_str), int(index_str)
+    except ValueError:
+        return None
 
-    for chat_id in recipients:
-        try:
-            bot.send_message(chat_id, text)
-            delivered += 1
-        except ApiTelegramException as exc:
-            failed += 1
-            print(
-                f"Не удалось отправить сообщение пользователю {chat_id}: {exc}",
-                flush=True,
-            )
-        except Exception as exc:  # noqa: BLE001 - хотим залогировать любые ошибки
-            failed += 1
-            print(
-                f"Не удалось отправить сообщение пользователю {chat_id}: {exc}",
-                flush=True,
-            )
 
-        time.sleep(0.1)
+def _advance_deck_cursor(raw: str | None, size: int) -> tuple[int, str]:
+    """Возвращает номер карты в колоде и новое значение курсора."""
+    parsed = _parse_deck_cursor(raw)
+    if parsed is None or parsed[1] >= size:
+        seed, index = random.getrandbits(31), 0
+    else:
+        seed, index = parsed
 
-    return len(recipients), delivered, failed
+    position = _deck_permutation(seed, size)[index]
+    return position, f"{seed}:{index + 1}"
 
 
-def _send_broadcast_summary(message, total: int, delivered: int, failed: int) -> None:
-    if total == 0:
-        bot.send_message(
-            message.chat.id,
-            "Пока некого уведомлять — список пользователей пуст.",
-        )
-        return
+@_traced_content
+def _draw_random_card(user_id: int | None = None) -> str:
+    """Возвращает случайную карту, гарантируя равномерный обход колоды."""
+    global _anonymous_deck_cursor
 
-    lines = [
-        "📣 Рассылка завершена.",
-        f"Всего получателей: {total}",
-        f"Успешно доставлено: {delivered}",
-        f"С ошибкой: {failed}",
-    ]
+    deck_cards = _draw_tables.deck_cards
+    size = len(deck_cards)
 
-    bot.send_message(message.chat.id, "\n".join(lines))
+    if user_id is None:
+        with _usage_lock:
+            position, _anonymous_deck_cursor = _advance_deck_cursor(_anonymous_deck_cursor, size)
+        return deck_cards[position]
+
+    _refresh_user_usage(user_id)
+    with _usage_lock:
+        position, cursor = _advance_deck_cursor(_user_registry.get(user_id, DECK_CURSOR_KEY), size)
+        _user_registry.set(user_id, DECK_CURSOR_KEY, cursor)
+        if not _is_shared_state():
+            _dirty_deck_cursors.add(user_id)
+            return deck_cards[position]
+
+    _persist_usage_event(
+        _usage_store.save_deck_cursors, [(str(user_id), *_encode_deck_cursor(cursor))]
+    )
+    return deck_cards[position]
 
 
-def _perform_broadcast(message, text: str) -> None:
-    total, delivered, failed = _broadcast_message_to_all(text)
-    _send_broadcast_summary(message, total, delivered, failed)
+def _flush_deck_cursors() -> None:
+    """Пишет в хранилище курсоры, сдвинутые с прошлого сброса."""
+    with _usage_lock:
+        rows = [
+            (str(user_id), *cursor)
+            for user_id in _dirty_deck_cursors
+            if (cursor := _encode_deck_cursor(_user_registry.get(user_id, DECK_CURSOR_KEY)))
+        ]
+        _dirty_deck_cursors.clear()
 
+    if rows:
+        _persist_usage_event(_usage_store.save_deck_cursors, rows)
 
-def _draw_random_card() -> str:
-    """Возвращает случайную карту, гарантируя равномерный обход колоды."""
-    global _shuffled_single_card_deck
 
-    if not _shuffled_single_card_deck:
-        _shuffled_single_card_deck = list(tarot_deck.keys())
-        random.shuffle(_shuffled_single_card_deck)
+def _deck_cursor_flush_loop() -> None:
+    while True:
+        time.sleep(DECK_CURSOR_FLUSH_SECONDS)
+        try:
+            _flush_deck_cursors()
+        except Exception as exc:  # noqa: BLE001 - поток сброса не должен умирать
+            print(f"Ошибка сброса курсоров колоды: {exc}", flush=True)
+
 
-    return _shuffled_single_card_deck.pop()
+def _start_deck_cursor_flusher() -> None:
+    thread = threading.Thread(target=_deck_cursor_flush_loop, name="deck-cursor-flusher", daemon=True)
+    thread.start()
+    atexit.register(_flush_deck_cursors)
 
 
 @bot.message_handler(commands=["stats"])
 def handle_stats_command(message):
+    _run_flow(_handle_stats_command_flow(message))
+
+
+def _handle_stats_command_flow(message):
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
 
     if user_id != ADMIN_ID:
-        bot.reply_to(message, "Команда доступна только администратору.")
+        yield _api("reply_to", message, "Команда доступна только администратору.")
         return
 
     text = (message.text or "").strip()
@@ -1050,134 +5046,284 @@ def handle_stats_command(message):
 
     if len(parts) == 1:
         date_str = today.isoformat()
-        stats = _load_daily_stats_for_date(date_str)
-        bot.send_message(message.chat.id, _format_daily_stats(date_str, stats))
+        stats = yield _local(_get_daily_stats, date_str)
+        yield _api("send_message", message.chat.id, _format_daily_stats(date_str, stats))
         return
 
     command_arg = parts[1].lower()
 
     if command_arg in ("today", "сегодня"):
         date_str = today.isoformat()
-        stats = _load_daily_stats_for_date(date_str)
-        bot.send_message(message.chat.id, _format_daily_stats(date_str, stats))
+        stats = yield _local(_get_daily_stats, date_str)
+        yield _api("send_message", message.chat.id, _format_daily_stats(date_str, stats))
         return
 
     if command_arg in ("yesterday", "вчера"):
         date_str = (today - timedelta(days=1)).isoformat()
-        stats = _load_daily_stats_for_date(date_str)
-        bot.send_message(message.chat.id, _format_daily_stats(date_str, stats))
+        stats = yield _local(_get_daily_stats, date_str)
+        yield _api("send_message", message.chat.id, _format_daily_stats(date_str, stats))
+        return
+
+    if command_arg in ("funnel", "воронка"):
+        period_arg = parts[2].lower() if len(parts) > 2 else "30d"
+        period = yield _local(_resolve_stats_period, period_arg)
+        if period is None:
+            yield _api(
+                "send_message", message.chat.id, "Период для воронки: 7d, 30d, 2026-09 или 2026-W41."
+            )
+            return
+
+        label, stats = period
+        yield _api("send_message", message.chat.id, _format_funnel(label, stats))
+        return
+
+    period = yield _local(_resolve_stats_period, command_arg)
+    if period is not None:
+        label, stats = period
+        yield _api("send_message", message.chat.id, _format_daily_stats(label, stats))
         return
 
     if command_arg in ("export", "csv", "выгрузка"):
-        result = _prepare_stats_csv()
+        start = end = None
+        if len(parts) > 2:
+            try:
+                start, end = _parse_stats_date_range(parts[2])
+            except ValueError:
+                yield _api(
+                    "send_message",
+                    message.chat.id,
+                    "Не понял период. Пример: /stats export 2026-01-01..2026-03-31",
+                )
+                return
+
+        result = yield _local(_prepare_stats_csv, start, end)
         if result is None:
-            bot.send_message(message.chat.id, "Выгрузить нечего — нет файлов статистики.")
+            yield _api("send_message", message.chat.id, "Выгрузить нечего — нет файлов статистики.")
             return
 
-        filename, buffer, totals = result
+        filename, export_file, totals = result
         summary_lines = [f"📈 {filename} готов."]
 
         if totals:
             summary_lines.append("")
-            summary_lines.append("Итоги по всем дням:")
+            summary_lines.append("Итоги за период:" if start or end else "Итоги по всем дням:")
             for event_name, count in sorted(totals.items()):
                 summary_lines.append(f"• {_format_event_label(event_name)}: {count}")
 
         caption = "\n".join(summary_lines)
-        bot.send_document(
-            message.chat.id,
-            buffer,
-            caption=caption,
-        )
+        with export_file:
+            yield _api(
+                "send_document",
+                message.chat.id,
+                telebot.types.InputFile(export_file, file_name=filename),
+                caption=caption,
+            )
         return
 
     date_candidate = parts[1]
     try:
         requested_date = datetime.fromisoformat(date_candidate).date()
     except ValueError:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
-            "Не понял дату. Используй формат ГГГГ-ММ-ДД или команды export/today/yesterday.",
+            "Не понял дату. Используй формат ГГГГ-ММ-ДД, период 7d/30d/ГГГГ-ММ/ГГГГ-Wнн "
+            "или команды export/funnel/today/yesterday.",
         )
         return
 
     date_str = requested_date.isoformat()
-    stats = _load_daily_stats_for_date(date_str)
-    bot.send_message(message.chat.id, _format_daily_stats(date_str, stats))
+    stats = yield _local(_get_daily_stats, date_str)
+    yield _api("send_message", message.chat.id, _format_daily_stats(date_str, stats))
+
+
+@bot.message_handler(commands=["profile"])
+def handle_profile_command(message):
+    _run_flow(_handle_profile_command_flow(message))
+
+
+def _handle_profile_command_flow(message):
+    user = getattr(message, "from_user", None)
+    user_id = getattr(user, "id", None)
+
+    if user_id != ADMIN_ID:
+        yield _api("reply_to", message, "Команда доступна только администратору.")
+        return
+
+    parts = (message.text or "").split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 60
+    except ValueError:
+        yield _api(
+            "send_message", message.chat.id, "Укажи длительность в секундах, например: /profile 60"
+        )
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if not (yield _local(_start_profile_session, message.chat.id, seconds)):
+        yield _api("send_message", message.chat.id, "Профилирование уже идёт — дождись отчёта.")
+        return
+
+    yield _api(
+        "send_message",
+        message.chat.id,
+        f"⏱ Профилирую обработчики {seconds} с, потом пришлю отчёт.",
+    )
 
 
 @bot.message_handler(commands=["broadcast"])
 def handle_broadcast_command(message):
+    _run_flow(_handle_broadcast_command_flow(message))
+
+
+def _handle_broadcast_command_flow(message):
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
 
     if user_id != ADMIN_ID:
-        bot.reply_to(message, "Команда доступна только администратору.")
+        yield _api("reply_to", message, "Команда доступна только администратору.")
         return
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     raw_text = (message.text or "").strip()
     parts = raw_text.split(maxsplit=1)
     payload = parts[1].strip() if len(parts) > 1 else ""
 
     if payload:
-        _perform_broadcast(message, payload)
+        yield from _perform_broadcast_flow(message, payload)
         return
 
-    prompt = bot.send_message(
+    yield _api(
+        "send_message",
         message.chat.id,
         "Отправь текст рассылки одним сообщением. Чтобы отменить, напиши /cancel.",
     )
-    bot.register_next_step_handler(prompt, _handle_broadcast_text_step)
+    yield _local(_register_next_step, message.chat.id, STEP_BROADCAST_TEXT)
 
 
 def _handle_broadcast_text_step(message):
+    _run_flow(_handle_broadcast_text_step_flow(message))
+
+
+def _handle_broadcast_text_step_flow(message):
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
 
     if user_id != ADMIN_ID:
-        bot.reply_to(message, "Команда доступна только администратору.")
+        yield _api("reply_to", message, "Команда доступна только администратору.")
         return
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     text = (message.text or "").strip()
 
     if not text or text.lower() in {"/cancel", "cancel", "отмена"}:
-        bot.send_message(message.chat.id, "Рассылка отменена.")
+        yield _api("send_message", message.chat.id, "Рассылка отменена.")
+        return
+
+    yield from _perform_broadcast_flow(message, text)
+
+
+def _get_card_of_day_push(user_id: int) -> str | None:
+    with _usage_lock:
+        return _user_registry.get(user_id, USER_CARD_OF_DAY_PUSH_KEY)
+
+
+@bot.message_handler(commands=["daily"])
+def handle_daily_command(message):
+    """/daily — статус, /daily on, /daily +5 — подписка с поясом, /daily off — отписка."""
+    _run_flow(_handle_daily_command_flow(message))
+
+
+def _handle_daily_command_flow(message):
+    user_id = getattr(getattr(message, "from_user", None), "id", None)
+    if user_id is None:
+        return
+
+    if _get_card_of_day_push_time() is None:
+        yield _api("reply_to", message, "Ежедневная карта дня сейчас не рассылается.")
+        return
+
+    yield _local(_register_user_id, user_id)
+
+    parts = (message.text or "").split()
+    command_arg = parts[1].lower() if len(parts) > 1 else ""
+    current = yield _local(_get_card_of_day_push, user_id)
+
+    if command_arg in {"off", "stop", "выкл"}:
+        yield _local(_set_card_of_day_push, user_id, None)
+        yield _api("reply_to", message, "🔕 Больше не присылаю карту дня. Вернуть: /daily on")
+        return
+
+    if not command_arg:
+        if current:
+            text = (
+                f"🔔 Карта дня приходит каждый день в {CARD_OF_DAY_PUSH_TIME} по UTC{current}.\n"
+                "Сменить часовой пояс: /daily +5\nОтписаться: /daily off"
+            )
+        else:
+            text = (
+                f"Могу присылать карту дня каждый день в {CARD_OF_DAY_PUSH_TIME}.\n"
+                f"Подписаться: /daily on (время UTC{CARD_OF_DAY_DEFAULT_UTC_OFFSET}) "
+                "или /daily +5 — со своим часовым поясом."
+            )
+        yield _api("reply_to", message, text)
+        return
+
+    if command_arg in {"on", "start", "вкл"}:
+        offset = _parse_utc_offset(current or CARD_OF_DAY_DEFAULT_UTC_OFFSET)
+    else:
+        offset = _parse_utc_offset(command_arg)
+
+    if offset is None:
+        yield _api(
+            "reply_to", message, "Не понял часовой пояс. Примеры: /daily +3, /daily -5, /daily +05:30"
+        )
         return
 
-    _perform_broadcast(message, text)
+    utc_offset = _format_utc_offset(offset)
+    yield _local(_set_card_of_day_push, user_id, utc_offset)
+    yield _api(
+        "reply_to",
+        message,
+        f"🔔 Готово! Карта дня будет приходить в {CARD_OF_DAY_PUSH_TIME} по UTC{utc_offset}.",
+    )
 
 
 @bot.message_handler(func=lambda msg: msg.text == YES_NO_BUTTON_LABEL)
 def prompt_yes_no_reading(message):
+    _run_flow(_prompt_yes_no_reading_flow(message))
+
+
+def _prompt_yes_no_reading_flow(message):
     _increment_daily_event(DAILY_EVENT_YES_NO_BUTTON)
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
     if user_id is None:
         user_id = getattr(getattr(message, "chat", None), "id", None)
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     if (
         user_id is not None
         and user_id != ADMIN_ID
-        and _has_used_yes_no_today(user_id)
+        and (yield _local(_has_used_yes_no_today, user_id))
     ):
-        _send_daily_limit_message(message.chat.id, READING_TYPE_YES_NO)
+        yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_YES_NO)
         return
 
     if not _yes_no_answers:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Сейчас ответы да/нет недоступны. Попробуй немного позже.",
             reply_markup=_build_main_menu(),
         )
         return
 
-    bot.send_message(
+    yield _api(
+        "send_message",
         message.chat.id,
         YES_NO_PROMPT_TEXT,
         reply_markup=_build_yes_no_prompt_keyboard(),
@@ -1186,17 +5332,22 @@ def prompt_yes_no_reading(message):
 
 @bot.message_handler(func=lambda msg: msg.text == CARD_OF_DAY_BUTTON_LABEL)
 def handle_card_of_day_button(message):
+    _run_flow(_handle_card_of_day_button_flow(message))
+
+
+def _handle_card_of_day_button_flow(message):
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
     if user_id is None:
         user_id = getattr(getattr(message, "chat", None), "id", None)
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     result = _get_card_of_day_for_date()
 
     if result is None:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "✨ На сегодня карта дня ещё не готова. Загляни позже!",
             reply_markup=_build_main_menu(),
@@ -1204,47 +5355,57 @@ def handle_card_of_day_button(message):
         return
 
     card, meaning = result
-    _send_card_of_day_message(message.chat.id, card, meaning)
+    yield from _card_of_day_message_flow(message.chat.id, card, meaning)
 
 
 @bot.message_handler(func=lambda msg: msg.text == "🃏 Одна карта")
 def ask_single_card_topic(message):
+    _run_flow(_ask_single_card_topic_flow(message))
+
+
+def _ask_single_card_topic_flow(message):
     _increment_daily_event(DAILY_EVENT_SINGLE_CARD_BUTTON)
     user = getattr(message, "from_user", None)
     user_id = getattr(user, "id", None)
     if user_id is None:
         user_id = getattr(getattr(message, "chat", None), "id", None)
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     # Админ (ты) может пользоваться без ограничений
     if (
         user_id is not None
         and user_id != ADMIN_ID
-        and _has_used_single_card_today(user_id)
+        and (yield _local(_has_used_single_card_today, user_id))
     ):
-        _send_daily_limit_message(message.chat.id, READING_TYPE_SINGLE)
+        yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_SINGLE)
         return
 
-    msg = bot.send_message(
+    yield _api(
+        "send_message",
         message.chat.id,
         "Выбери сферу, о которой хочешь спросить:",
         reply_markup=_build_topic_selection_keyboard(),
     )
-    bot.register_next_step_handler(msg, send_single_card_with_topic, user_id)
+    yield _local(_register_next_step, message.chat.id, STEP_SINGLE_CARD_TOPIC, user_id)
 
 
 @bot.message_handler(func=lambda msg: msg.text == CONSULTATION_MENU_LABEL)
 def show_consultation_offer(message):
     """Показывает предложение консультации из главного меню."""
-    _send_consultation_offer(message.chat.id)
+    _run_flow(_consultation_offer_flow(message.chat.id))
 
 
 def send_single_card_with_topic(message, user_id: int | None):
+    _run_flow(_send_single_card_with_topic_flow(message, user_id))
+
+
+def _send_single_card_with_topic_flow(message, user_id: int | None):
     topic = message.text
 
     if topic == BACK_TO_MENU_LABEL:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Возвращаемся в главное меню 🌙",
             reply_markup=_build_main_menu(),
@@ -1252,64 +5413,69 @@ def send_single_card_with_topic(message, user_id: int | None):
         return
 
     if topic not in SINGLE_CARD_TOPICS:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Я жду выбор одной из сфер: любовь, карьера, финансы, здоровье или совет дня 💫",
         )
         return
 
+    reservation = yield _local(_reserve_reading_today, user_id, READING_TYPE_SINGLE)
+    if reservation is None:
+        yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_SINGLE)
+        return
+
     # Тянем карту
-    card = _draw_random_card()
-    if user_id is not None:
-        _mark_single_card_used_today(user_id)
+    card = yield _local(_draw_random_card, user_id)
+    meaning = _pick_single_card_meaning(card, TOPIC_TO_KEY[topic])
+
+    yield from _released_on_failure_flow(
+        reservation, _single_card_reply_flow(message.chat.id, card, topic, meaning)
+    )
     _increment_daily_event(DAILY_EVENT_SINGLE_CARD_READING)
-    category_key = TOPIC_TO_KEY[topic]
 
-    # Берём значение по категории из tarot_topics
-    if card in tarot_topics and category_key in tarot_topics[card]:
-        meaning_list = tarot_topics[card][category_key]
-        meaning = random.choice(meaning_list)
-    else:
-        # запасной вариант — если вдруг для карты нет записей в новом файле
-        fallback_values = _collect_all_meanings(tarot_deck.get(card))
-        if fallback_values:
-            meaning = random.choice(fallback_values)
-        else:
-            meaning = "Значение не найдено — доверься своей интуиции."
+    if user_id is None or user_id != ADMIN_ID:
+        yield from _consultation_offer_flow(message.chat.id)
 
-    # В первую очередь пытаемся взять расширенные описания из tarot_deck.
-    card_data = tarot_deck.get(card)
-    if isinstance(card_data, dict):
-        expanded_values = card_data.get(category_key)
-        if isinstance(expanded_values, list):
-            meaning_list = [value for value in expanded_values if isinstance(value, str)]
 
-    _send_single_card_reply(message.chat.id, card, topic, meaning)
+@_traced_content
+def _pick_single_card_meaning(card: str, category_key: str) -> str:
+    # Берём значение по категории из tarot_topics
+    if card in tarot_topics and category_key in tarot_topics[card]:
+        return random.choice(tarot_topics[card][category_key])
+
+    # запасной вариант — если вдруг для карты нет записей в новом файле
+    fallback_values = _draw_tables.card_meanings.get(card)
+    if fallback_values:
+        return random.choice(fallback_values)
 
-    if user_id is None or user_id != ADMIN_ID:
-        _send_consultation_offer(message.chat.id)
+    return "Значение не найдено — доверься своей интуиции."
 
 
-def _send_single_card_reply(chat_id: int, card: str, topic: str, meaning: str) -> None:
-    caption = (
+def _build_single_card_caption(card: str, topic: str, meaning: str) -> str:
+    return (
         f"🃏 *{card}*\n"
         f"Сфера: {topic}\n"
         f"_{meaning}_"
     )
 
+
+def _single_card_reply_flow(chat_id: int, card: str, topic: str, meaning: str):
+    caption = _build_single_card_caption(card, topic, meaning)
+
     path = _get_card_image_path(card)
     if path:
-        with open(path, "rb") as photo:
-            bot.send_photo(
-                chat_id,
-                photo,
-                caption=caption,
-                parse_mode="Markdown",
-                reply_markup=_build_main_menu(),
-            )
-            return
+        yield from _card_photo_flow(
+            chat_id,
+            path,
+            caption=caption,
+            parse_mode="Markdown",
+            reply_markup=_build_main_menu(),
+        )
+        return
 
-    bot.send_message(
+    yield _api(
+        "send_message",
         chat_id,
         caption,
         parse_mode="Markdown",
@@ -1317,130 +5483,152 @@ def _send_single_card_reply(chat_id: int, card: str, topic: str, meaning: str) -
     )
 
 
+def _build_yes_no_caption(card: str, answer: str) -> str:
+    return f"🎯 *{card}*\nОтвет: *{answer}*"
+
+
 @bot.callback_query_handler(func=lambda call: getattr(call, "data", None) == YES_NO_CALLBACK_DRAW)
 def handle_yes_no_callback(call):
+    _run_flow(_handle_yes_no_callback_flow(call))
+
+
+def _handle_yes_no_callback_flow(call):
     user = getattr(call, "from_user", None)
     user_id = getattr(user, "id", None)
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
-    if (
-        user_id is not None
-        and user_id != ADMIN_ID
-        and _has_used_yes_no_today(user_id)
-    ):
-        bot.answer_callback_query(
+    reservation = yield _local(_reserve_reading_today, user_id, READING_TYPE_YES_NO)
+    if reservation is None:
+        yield _api(
+            "answer_callback_query",
             call.id,
             text="Сегодня лимит по ответу да/нет уже исчерпан.",
             show_alert=True,
         )
         message = getattr(call, "message", None)
         if message is not None:
-            _send_daily_limit_message(message.chat.id, READING_TYPE_YES_NO)
+            yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_YES_NO)
         return
 
     result = _draw_yes_no_answer()
 
     if result is None:
-        bot.answer_callback_query(
+        yield _local(_release_reading, reservation)
+        yield _api(
+            "answer_callback_query",
             call.id,
             text="Сейчас ответы недоступны. Попробуй позже.",
             show_alert=True,
         )
         message = getattr(call, "message", None)
         if message is not None:
-            bot.send_message(
+            yield _api(
+                "send_message",
                 message.chat.id,
                 "Сейчас ответы да/нет недоступны. Попробуй немного позже.",
                 reply_markup=_build_main_menu(),
             )
         return
 
-    _increment_daily_event(DAILY_EVENT_YES_NO_READING)
-
     card, answer = result
-    caption = f"🎯 *{card}*\nОтвет: *{answer}*"
+    caption = _build_yes_no_caption(card, answer)
     image_path = _get_card_image_path(card)
     message = getattr(call, "message", None)
 
-    bot.answer_callback_query(call.id, text="✨ Ответ готов!")
+    delivered = yield from _released_on_failure_flow(
+        reservation, _yes_no_answer_flow(call, message, caption, image_path)
+    )
+    if not delivered:
+        # Ответ показать некуда — расклад не считается.
+        yield _local(_release_reading, reservation)
+        return
+
+    _increment_daily_event(DAILY_EVENT_YES_NO_READING)
+
+
+def _yes_no_answer_flow(call, message, caption: str, image_path: str | None):
+    """Показывает ответ да/нет; False — сообщения, куда его прислать, нет."""
+    yield _api("answer_callback_query", call.id, text="✨ Ответ готов!")
 
     if message is None:
-        return
+        return False
 
     chat_id = message.chat.id
     reply_markup = _build_yes_no_repeat_keyboard()
 
     if image_path:
-        with open(image_path, "rb") as photo:
-            bot.send_photo(
-                chat_id,
-                photo,
-                caption=caption,
-                parse_mode="Markdown",
-                reply_markup=reply_markup,
-            )
-        if user_id is not None and user_id != ADMIN_ID:
-            _mark_yes_no_used_today(user_id)
-        return
-
-    bot.send_message(
-        chat_id,
-        caption,
-        parse_mode="Markdown",
-        reply_markup=reply_markup,
-    )
-    if user_id is not None and user_id != ADMIN_ID:
-        _mark_yes_no_used_today(user_id)
+        yield from _card_photo_flow(
+            chat_id,
+            image_path,
+            caption=caption,
+            parse_mode="Markdown",
+            reply_markup=reply_markup,
+        )
+    else:
+        yield _api(
+            "send_message",
+            chat_id,
+            caption,
+            parse_mode="Markdown",
+            reply_markup=reply_markup,
+        )
+    return True
 
 
-def _send_two_card_message(
-    chat_id: int, card1: str, card2: str, meaning: str, *, user_id: int | None = None
-) -> None:
-    response = (
+def _build_two_card_text(card1: str, card2: str, meaning: str) -> str:
+    return (
         "🧿 *Две карты:*\n\n"
         f"• {card1}\n"
         f"• {card2}\n\n"
         f"{meaning}"
     )
 
-    if user_id is not None:
-        _mark_two_cards_used_today(user_id)
 
-    _increment_daily_event(DAILY_EVENT_TWO_CARDS_READING)
+def _two_card_message_flow(
+    chat_id: int, card1: str, card2: str, meaning: str, *, user_id: int | None = None
+):
+    response = _build_two_card_text(card1, card2, meaning)
 
-    bot.send_message(
-        chat_id,
-        response,
-        parse_mode="Markdown",
-        reply_markup=_build_main_menu(),
+    reservation = yield _local(_reserve_reading_today, user_id, READING_TYPE_TWO_CARDS)
+    if reservation is None:
+        yield from _daily_limit_message_flow(chat_id, READING_TYPE_TWO_CARDS)
+        return
+
+    yield from _released_on_failure_flow(
+        reservation,
+        _api_flow(
+            "send_message",
+            chat_id,
+            response,
+            parse_mode="Markdown",
+            reply_markup=_build_main_menu(),
+        ),
     )
+    _increment_daily_event(DAILY_EVENT_TWO_CARDS_READING)
 
     if user_id is not None and user_id != ADMIN_ID:
-        _send_consultation_offer(chat_id)
+        yield from _consultation_offer_flow(chat_id)
 
 
+@_traced_content
 def _draw_random_two_card_combination():
     """Возвращает случайную комбинацию для расклада на две карты."""
-    if not combinations_2cards:
-        return None
-
-    key = random.choice(list(combinations_2cards.keys()))
-    cards = key.split("|", 1)
-    if len(cards) != 2:
-        return None
-
-    card1, card2 = cards
-    meaning = combinations_2cards.get(key)
-    if not isinstance(meaning, str):
+    table = _two_card_draw_table
+    if not table:
         return None
 
-    return card1, card2, meaning
+    return random.choice(table)
 
 
 # === Оплата консультации звёздами ===
 
 @bot.callback_query_handler(func=lambda call: call.data == "buy_consultation")
 def handle_buy_consultation(call):
+    _run_flow(_handle_buy_consultation_flow(call))
+
+
+def _handle_buy_consultation_flow(call):
+    _increment_daily_event(DAILY_EVENT_CONSULTATION_CLICK)
     prices = [
         LabeledPrice(
             label="Личная консультация",
@@ -1449,7 +5637,8 @@ def handle_buy_consultation(call):
     ]
 
     try:
-        bot.send_invoice(
+        yield _api(
+            "send_invoice",
             call.message.chat.id,
             CONSULTATION_TITLE,
             CONSULTATION_DESCRIPTION,
@@ -1460,7 +5649,8 @@ def handle_buy_consultation(call):
             start_parameter=CONSULTATION_START_PARAMETER,
         )
     except ApiTelegramException as exc:
-        bot.answer_callback_query(
+        yield _api(
+            "answer_callback_query",
             call.id,
             "Не удалось открыть оплату. Попробуй ещё раз чуть позже.",
             show_alert=True,
@@ -1468,24 +5658,33 @@ def handle_buy_consultation(call):
         print(f"Ошибка отправки счёта: {exc}", flush=True)
         return
 
-    bot.answer_callback_query(call.id)
+    yield _api("answer_callback_query", call.id)
 
 
 @bot.pre_checkout_query_handler(func=lambda query: True)
 def process_pre_checkout_query(pre_checkout_query):
+    _run_flow(_process_pre_checkout_query_flow(pre_checkout_query))
+
+
+def _process_pre_checkout_query_flow(pre_checkout_query):
     if pre_checkout_query.invoice_payload != CONSULTATION_PAYLOAD:
-        bot.answer_pre_checkout_query(
+        yield _api(
+            "answer_pre_checkout_query",
             pre_checkout_query.id,
             ok=False,
             error_message="Не удалось обработать оплату. Попробуй позже.",
         )
         return
 
-    bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    yield _api("answer_pre_checkout_query", pre_checkout_query.id, ok=True)
 
 
 @bot.message_handler(content_types=['successful_payment'])
 def successful_payment_handler(message):
+    _run_flow(_successful_payment_flow(message))
+
+
+def _successful_payment_flow(message):
     payload = message.successful_payment.invoice_payload
     if payload != CONSULTATION_PAYLOAD:
         return
@@ -1499,6 +5698,8 @@ def successful_payment_handler(message):
         )
         return
 
+    _increment_daily_event(DAILY_EVENT_CONSULTATION_PAID)
+
     markup = InlineKeyboardMarkup()
     markup.add(
         InlineKeyboardButton(
@@ -1507,7 +5708,8 @@ def successful_payment_handler(message):
         )
     )
 
-    bot.send_message(
+    yield _api(
+        "send_message",
         message.chat.id,
         CONSULTATION_SUCCESS_MESSAGE,
         reply_markup=markup,
@@ -1517,51 +5719,45 @@ def successful_payment_handler(message):
 # === Три карты ===
 @bot.message_handler(func=lambda msg: msg.text == "🔮 Три карты")
 def ask_three_card_topic(message):
+    _run_flow(_ask_three_card_topic_flow(message))
+
+
+def _ask_three_card_topic_flow(message):
     _increment_daily_event(DAILY_EVENT_THREE_CARDS_BUTTON)
     user_id = getattr(getattr(message, "from_user", None), "id", None)
 
-    _register_user_id(user_id)
+    yield _local(_register_user_id, user_id)
 
     if (
         user_id is not None
         and user_id != ADMIN_ID
-        and _has_used_three_cards_today(user_id)
+        and (yield _local(_has_used_three_cards_today, user_id))
     ):
-        _send_daily_limit_message(message.chat.id, READING_TYPE_THREE_CARDS)
+        yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_THREE_CARDS)
         return
 
-    prompt = bot.send_message(
+    yield _api(
+        "send_message",
         message.chat.id,
         "Выбери сферу для расклада из трёх карт:",
         reply_markup=_build_topic_selection_keyboard(),
     )
-    bot.register_next_step_handler(prompt, send_three_cards_with_topic)
+    yield _local(_register_next_step, message.chat.id, STEP_THREE_CARD_TOPIC)
 
 
 def send_three_cards_with_topic(message):
-    topic = message.text
-    user_id = getattr(getattr(message, "from_user", None), "id", None)
+    _run_flow(_send_three_cards_with_topic_flow(message))
 
-    _register_user_id(user_id)
 
-    if (
-        user_id is not None
-        and user_id != ADMIN_ID
-        and _has_used_three_cards_today(user_id)
-    ):
-        _send_daily_limit_message(message.chat.id, READING_TYPE_THREE_CARDS)
-        return
+def _send_three_cards_with_topic_flow(message):
+    topic = message.text
+    user_id = getattr(getattr(message, "from_user", None), "id", None)
 
-    if topic == BACK_TO_MENU_LABEL:
-        bot.send_message(
-            message.chat.id,
-            "Возвращаемся в главное меню 🌙",
-            reply_markup=_build_main_menu(),
-        )
-        return
+    yield _local(_register_user_id, user_id)
 
     if topic == BACK_TO_MENU_LABEL:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Возвращаемся в главное меню 🌙",
             reply_markup=_build_main_menu(),
@@ -1569,19 +5765,21 @@ def send_three_cards_with_topic(message):
         return
 
     if topic not in SINGLE_CARD_TOPICS:
-        prompt = bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Я жду выбор одной из сфер: любовь, карьера, финансы, здоровье или совет дня 💫",
             reply_markup=_build_topic_selection_keyboard(),
         )
-        bot.register_next_step_handler(prompt, send_three_cards_with_topic)
+        yield _local(_register_next_step, message.chat.id, STEP_THREE_CARD_TOPIC)
         return
 
     topic_key = TOPIC_TO_KEY.get(topic)
     result = _draw_three_card_reading(topic_key) if topic_key else None
 
     if not result:
-        bot.send_message(
+        yield _api(
+            "send_message",
             message.chat.id,
             "Не удалось подобрать расклад. Попробуй ещё раз чуть позже.",
             reply_markup=_build_main_menu(),
@@ -1589,26 +5787,54 @@ def send_three_cards_with_topic(message):
         return
 
     cards, meaning = result
-    if user_id is not None:
-        _mark_three_cards_used_today(user_id)
-
-    _increment_daily_event(DAILY_EVENT_THREE_CARDS_READING)
+    reservation = yield _local(_reserve_reading_today, user_id, READING_TYPE_THREE_CARDS)
+    if reservation is None:
+        yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_THREE_CARDS)
+        return
 
-    names = "\n".join(f"• {card}" for card in cards)
-    bot.send_message(
-        message.chat.id,
-        f"🔮 *Три карты — {topic}:*\n\n{names}\n\n{meaning}",
-        parse_mode="Markdown",
-        reply_markup=_build_main_menu(),
+    yield from _released_on_failure_flow(
+        reservation,
+        _api_flow(
+            "send_message",
+            message.chat.id,
+            _build_three_card_text(topic, cards, meaning),
+            parse_mode="Markdown",
+            reply_markup=_build_main_menu(),
+        ),
     )
+    _increment_daily_event(DAILY_EVENT_THREE_CARDS_READING)
 
     if user_id is not None and user_id != ADMIN_ID:
-        _send_consultation_offer(message.chat.id)
+        yield from _consultation_offer_flow(message.chat.id)
+
+
+def _build_three_card_text(topic: str, cards, meaning: str) -> str:
+    names = "\n".join(f"• {card}" for card in cards)
+    return f"🔮 *Три карты — {topic}:*\n\n{names}\n\n{meaning}"
 
 
 # === Обработка WebApp данных ===
+def _is_web_app_limit_reported(data: dict) -> bool:
+    """WebApp может сам сообщить, что дневной лимит уже исчерпан."""
+    limit_flags = [
+        "limit_exceeded",
+        "limitExceeded",
+        "daily_limit",
+        "dailyLimit",
+    ]
+    if any(bool(data.get(flag)) for flag in limit_flags):
+        return True
+
+    error_value = data.get("error")
+    return isinstance(error_value, str) and "limit" in error_value.lower()
+
+
 @bot.message_handler(content_types=['web_app_data'])
 def handle_web_app_data(message):
+    _run_flow(_handle_web_app_data_flow(message))
+
+
+def _handle_web_app_data_flow(message):
     try:
         data = json.loads(message.web_app_data.data)
         card1 = data.get("card1")
@@ -1616,34 +5842,16 @@ def handle_web_app_data(message):
 
         user_id = getattr(getattr(message, "from_user", None), "id", None)
 
-        _register_user_id(user_id)
+        yield _local(_register_user_id, user_id)
 
-        if (
-            user_id is not None
-            and user_id != ADMIN_ID
-            and _has_used_two_cards_today(user_id)
-        ):
-            _send_daily_limit_message(message.chat.id, READING_TYPE_TWO_CARDS)
-            return
-
-        limit_flags = [
-            "limit_exceeded",
-            "limitExceeded",
-            "daily_limit",
-            "dailyLimit",
-        ]
-        limit_detected = any(bool(data.get(flag)) for flag in limit_flags)
-
-        error_value = data.get("error")
-        if isinstance(error_value, str) and "limit" in error_value.lower():
-            limit_detected = True
+        limit_detected = _is_web_app_limit_reported(data)
 
         if not card1 or not card2:
             if user_id == ADMIN_ID:
                 fallback = _draw_random_two_card_combination()
                 if fallback:
                     fallback_card1, fallback_card2, fallback_meaning = fallback
-                    _send_two_card_message(
+                    yield from _two_card_message_flow(
                         message.chat.id,
                         fallback_card1,
                         fallback_card2,
@@ -1653,15 +5861,15 @@ def handle_web_app_data(message):
                     return
 
             if limit_detected:
-                _send_daily_limit_message(message.chat.id, READING_TYPE_TWO_CARDS)
+                yield from _daily_limit_message_flow(message.chat.id, READING_TYPE_TWO_CARDS)
             else:
-                bot.send_message(message.chat.id, "Ошибка: не удалось получить карты.")
+                yield _api("send_message", message.chat.id, "Ошибка: не удалось получить карты.")
             return
 
         meaning = _get_two_card_meaning(card1, card2)
 
         if meaning:
-            _send_two_card_message(
+            yield from _two_card_message_flow(
                 message.chat.id,
                 card1,
                 card2,
@@ -1673,7 +5881,7 @@ def handle_web_app_data(message):
                 fallback = _draw_random_two_card_combination()
                 if fallback:
                     fallback_card1, fallback_card2, fallback_meaning = fallback
-                    _send_two_card_message(
+                    yield from _two_card_message_flow(
                         message.chat.id,
                         fallback_card1,
                         fallback_card2,
@@ -1682,11 +5890,483 @@ def handle_web_app_data(message):
                     )
                     return
 
-            bot.send_message(message.chat.id, "❌ Ошибка: трактовка не найдена.")
+            yield _api("send_message", message.chat.id, "❌ Ошибка: трактовка не найдена.")
     except Exception as e:
-        bot.send_message(message.chat.id, f"Ошибка обработки: {e}")
+        yield _api("send_message", message.chat.id, f"Ошибка обработки: {e}")
+
+
+# === Раздача апдейтов по воркерам ===
+# Апдейты одного чата всегда попадают к одному воркеру и выполняются по
+# порядку: двойное нажатие «Одна карта» не обгонит следующий шаг диалога.
+# Разные чаты обрабатываются параллельно. Если очередь воркера заполнена,
+# апдейт отбрасывается, а пользователь получает короткое «попробуй позже».
+# Оплату не отбрасываем никогда — на pre_checkout нужно ответить за 10 секунд.
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+if os.getenv("WEBHOOK_WORKERS"):
+    print(
+        "WEBHOOK_WORKERS больше не используется, число воркеров задаёт DISPATCH_WORKERS "
+        f"(сейчас {DISPATCH_WORKERS}).",
+        flush=True,
+    )
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "100"))  # на каждого воркера
+DISPATCH_BUSY_TEXT = "⏳ Сейчас очень много запросов. Попробуй ещё раз через минуту."
+DISPATCH_BUSY_REPLY_INTERVAL_SECONDS = 30
+POLLING_RETRY_DELAY_SECONDS = 3
+
+_shed_updates = _CounterMetric(
+    "taro_shed_updates_total", "Апдейты, отброшенные из-за перегрузки.", ("kind",)
+)
+_busy_reply_queue: "queue.Queue[telebot.types.Update]" = queue.Queue(maxsize=100)
+_busy_replied_at: dict[int, float] = {}
+
+
+def _update_kind(update) -> str:
+    for kind in ("message", "edited_message", "callback_query", "pre_checkout_query"):
+        if getattr(update, kind, None) is not None:
+            return kind
+    return "other"
+
+
+def _update_routing_key(update) -> int:
+    """Чат, к которому относится апдейт; по нему выбирается воркер."""
+    callback_query = update.callback_query
+    for message in (update.message, update.edited_message, getattr(callback_query, "message", None)):
+        if message is not None:
+            return message.chat.id
+
+    for event in (callback_query, update.pre_checkout_query, update.my_chat_member):
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            return user.id
+
+    return update.update_id
+
+
+def _is_payment_update(update) -> bool:
+    return update.pre_checkout_query is not None or (
+        update.message is not None and update.message.successful_payment is not None
+    )
+
+
+class _UpdateDispatcher:
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self._shards = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+
+        for index, shard in enumerate(self._shards):
+            threading.Thread(
+                target=self._work, args=(shard,), name=f"dispatch-{index}", daemon=True
+            ).start()
+        threading.Thread(target=_busy_reply_loop, name="dispatch-busy", daemon=True).start()
+
+    def depth(self) -> int:
+        return sum(shard.qsize() for shard in self._shards)
+
+    def submit(self, update, timeout: float = 0) -> bool:
+        """Ставит апдейт в очередь его чата. False — очередь полна, апдейт не принят."""
+        shard = self._shards[_update_routing_key(update) % len(self._shards)]
+
+        if _is_payment_update(update):
+            shard.put(update)
+            return True
+
+        try:
+            if timeout > 0:
+                shard.put(update, timeout=timeout)
+            else:
+                shard.put_nowait(update)
+        except queue.Full:
+            _shed_updates.inc(_update_kind(update))
+            return False
+        return True
+
+    @staticmethod
+    def _work(shard: queue.Queue) -> None:
+        while True:
+            update = shard.get()
+            try:
+                bot.process_new_updates([update])
+            except Exception as exc:  # noqa: BLE001 - воркер не должен умирать из-за одного апдейта
+                print(f"Ошибка обработки апдейта {update.update_id}: {exc}", flush=True)
+            finally:
+                shard.task_done()
+
+
+def _shed_update(update) -> None:
+    """Отвечает на отброшенный апдейт «попробуй позже», но не чаще раза в 30 с на чат."""
+    chat_id = _update_routing_key(update)
+    now = time.monotonic()
+
+    last_reply = _busy_replied_at.get(chat_id)
+    if last_reply is not None and now - last_reply < DISPATCH_BUSY_REPLY_INTERVAL_SECONDS:
+        return
+
+    if len(_busy_replied_at) > 10_000:
+        for stale_chat_id, replied_at in list(_busy_replied_at.items()):
+            if now - replied_at >= DISPATCH_BUSY_REPLY_INTERVAL_SECONDS:
+                _busy_replied_at.pop(stale_chat_id, None)
+    _busy_replied_at[chat_id] = now
+
+    try:
+        _busy_reply_queue.put_nowait(update)
+    except queue.Full:
+        pass
+
+
+def _busy_reply_loop() -> None:
+    while True:
+        update = _busy_reply_queue.get()
+        try:
+            if update.callback_query is not None:
+                bot.answer_callback_query(update.callback_query.id, DISPATCH_BUSY_TEXT)
+            elif update.message is not None:
+                bot.send_message(update.message.chat.id, DISPATCH_BUSY_TEXT)
+        except (ApiTelegramException, requests.RequestException) as exc:
+            print(f"Не удалось ответить «занято»: {exc}", flush=True)
+
+
+_dispatcher = _UpdateDispatcher(DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE)
+_register_queue_depth("dispatch", _dispatcher.depth)
+
+
+def _run_polling() -> None:
+    """Long polling, который раздаёт апдейты воркерам диспетчера."""
+    _dispatcher.start()
+    offset = None
+
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=60, long_polling_timeout=30)
+        except (ApiTelegramException, requests.RequestException) as exc:
+            print(f"Не удалось получить апдейты: {exc}", flush=True)
+            time.sleep(POLLING_RETRY_DELAY_SECONDS)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            if not _dispatcher.submit(update):
+                _shed_update(update)
+
+
+# === Webhook ===
+# Вместо long polling Telegram сам присылает обновления POST-запросами.
+# Так можно поднять несколько копий бота за балансировщиком. Для локальной
+# проверки достаточно отправить записанный JSON апдейта:
+#   curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET_TOKEN" \
+#        -d @update.json http://127.0.0.1:8080/telegram/webhook
+# По умолчанию слушаем только локальный адрес (снаружи — обратный прокси).
+# Открыть порт наружу можно лишь с WEBHOOK_SECRET_TOKEN: без него любой,
+# кто достучится до порта, подсунет апдейт от имени админа.
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "polling").strip().lower()
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "127.0.0.1")
+WEBHOOK_LISTEN_PORT = int(os.getenv("WEBHOOK_LISTEN_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_PUBLIC_URL = os.getenv("WEBHOOK_PUBLIC_URL", "")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+WEBHOOK_ENQUEUE_TIMEOUT_SECONDS = 2.0
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+
+
+class _WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Принимает апдейты от Telegram и складывает их в очередь воркеров."""
+
+    def _reply(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # noqa: N802 - имя задаёт http.server
+        # Проверка живости для балансировщика.
+        self._reply(200, f"ok queue={_dispatcher.depth()}".encode("utf-8"))
+
+    def do_POST(self) -> None:  # noqa: N802 - имя задаёт http.server
+        if self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(secret, WEBHOOK_SECRET_TOKEN):
+            self._reply(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > WEBHOOK_MAX_BODY_BYTES:
+            self._reply(400)
+            return
+
+        try:
+            payload = json.loads(self.rfile.read(length))
+            if not isinstance(payload, dict):
+                raise TypeError(f"ожидался объект, пришёл {type(payload).__name__}")
+            update = telebot.types.Update.de_json(payload)
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            print(f"Не удалось разобрать апдейт: {exc}", flush=True)
+            self._reply(400)
+            return
+
+        if not _dispatcher.submit(update, timeout=WEBHOOK_ENQUEUE_TIMEOUT_SECONDS):
+            # Telegram повторит доставку позже — это и есть обратное давление.
+            self._reply(503, b"busy")
+            return
+
+        self._reply(200)
+
+    def log_message(self, format, *args) -> None:  # noqa: A002 - сигнатура http.server
+        pass
+
+
+def _is_loopback_host(host: str) -> bool:
+    return host in {"localhost", "127.0.0.1", "::1"} or host.startswith("127.")
+
+
+def _run_webhook_server() -> None:
+    if not WEBHOOK_SECRET_TOKEN and not _is_loopback_host(WEBHOOK_LISTEN_HOST):
+        print(
+            f"Webhook на {WEBHOOK_LISTEN_HOST} без WEBHOOK_SECRET_TOKEN не запускаем: "
+            "любой смог бы прислать поддельный апдейт. Задай секрет или слушай 127.0.0.1.",
+            flush=True,
+        )
+        sys.exit(1)
+
+    _dispatcher.start()
+
+    if WEBHOOK_PUBLIC_URL:
+        bot.set_webhook(
+            url=WEBHOOK_PUBLIC_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            max_connections=DISPATCH_WORKERS,
+        )
+
+    server = http.server.ThreadingHTTPServer(
+        (WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT), _WebhookRequestHandler
+    )
+    print(
+        f"Webhook слушает {WEBHOOK_LISTEN_HOST}:{WEBHOOK_LISTEN_PORT}{WEBHOOK_PATH}",
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# === Асинхронный режим ===
+# BOT_RUN_MODE=async: обработчики — корутины на telebot.async_telebot, так
+# что сетевой вызов к Telegram не держит поток. Сценарии те же, что и в
+# синхронном режиме: _async_run_flow ждёт вызовы API на AsyncTeleBot, а
+# запись в хранилища и чтение файлов уносит в asyncio.to_thread.
+_async_bot = None
+
+
+async def _async_run_flow(flow):
+    """Выполняет сценарий в цикле событий, через _async_bot."""
+    result = error = None
+    while True:
+        try:
+            step = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        result = error = None
+        try:
+            if isinstance(step, _ApiCall):
+                result = await getattr(_async_bot, step.method)(*step.args, **step.kwargs)
+            else:
+                result = await asyncio.to_thread(step.func, *step.args)
+        except BaseException as exc:  # noqa: BLE001 - исключение уходит обратно в сценарий
+            error = exc
+
+
+async def _async_has_next_step(message) -> bool:
+    return await asyncio.to_thread(_conversation_store.has, message.chat.id)
+
+
+async def _async_dispatch_next_step(message):
+    pending = await asyncio.to_thread(_conversation_store.pop, message.chat.id)
+    if pending is None:
+        # Шаг успел истечь или его забрала другая копия бота.
+        return
+
+    step, args = pending
+    await _timed_handler(_step_callbacks()[step][1])(message, *args)
+
+
+async def _async_send_welcome(message):
+    await _async_run_flow(_send_welcome_flow(message))
+
+
+async def _async_handle_stats_command(message):
+    await _async_run_flow(_handle_stats_command_flow(message))
+
+
+async def _async_handle_profile_command(message):
+    await _async_run_flow(_handle_profile_command_flow(message))
+
+
+async def _async_handle_broadcast_command(message):
+    await _async_run_flow(_handle_broadcast_command_flow(message))
+
+
+async def _async_handle_broadcast_text_step(message):
+    await _async_run_flow(_handle_broadcast_text_step_flow(message))
+
+
+async def _async_handle_daily_command(message):
+    await _async_run_flow(_handle_daily_command_flow(message))
+
+
+async def _async_prompt_yes_no_reading(message):
+    await _async_run_flow(_prompt_yes_no_reading_flow(message))
+
+
+async def _async_handle_card_of_day_button(message):
+    await _async_run_flow(_handle_card_of_day_button_flow(message))
+
+
+async def _async_ask_single_card_topic(message):
+    await _async_run_flow(_ask_single_card_topic_flow(message))
+
+
+async def _async_show_consultation_offer(message):
+    await _async_run_flow(_consultation_offer_flow(message.chat.id))
+
+
+async def _async_send_single_card_with_topic(message, user_id: int | None):
+    await _async_run_flow(_send_single_card_with_topic_flow(message, user_id))
+
+
+async def _async_handle_yes_no_callback(call):
+    await _async_run_flow(_handle_yes_no_callback_flow(call))
+
+
+async def _async_handle_buy_consultation(call):
+    await _async_run_flow(_handle_buy_consultation_flow(call))
+
+
+async def _async_process_pre_checkout_query(pre_checkout_query):
+    await _async_run_flow(_process_pre_checkout_query_flow(pre_checkout_query))
+
+
+async def _async_successful_payment_handler(message):
+    await _async_run_flow(_successful_payment_flow(message))
+
+
+async def _async_ask_three_card_topic(message):
+    await _async_run_flow(_ask_three_card_topic_flow(message))
+
+
+async def _async_send_three_cards_with_topic(message):
+    await _async_run_flow(_send_three_cards_with_topic_flow(message))
+
+
+async def _async_handle_web_app_data(message):
+    await _async_run_flow(_handle_web_app_data_flow(message))
+
+
+def _register_async_handlers(async_bot) -> None:
+    # Как и в telebot, ожидаемый «следующий шаг» важнее обычных обработчиков.
+    async_bot.register_message_handler(
+        _async_dispatch_next_step, func=_async_has_next_step
+    )
+    async_bot.register_message_handler(_async_send_welcome, commands=["start"])
+    async_bot.register_message_handler(_async_handle_stats_command, commands=["stats"])
+    async_bot.register_message_handler(_async_handle_profile_command, commands=["profile"])
+    async_bot.register_message_handler(_async_handle_daily_command, commands=["daily"])
+    async_bot.register_message_handler(_async_handle_broadcast_command, commands=["broadcast"])
+    async_bot.register_message_handler(
+        _async_prompt_yes_no_reading, func=lambda msg: msg.text == YES_NO_BUTTON_LABEL
+    )
+    async_bot.register_message_handler(
+        _async_handle_card_of_day_button, func=lambda msg: msg.text == CARD_OF_DAY_BUTTON_LABEL
+    )
+    async_bot.register_message_handler(
+        _async_ask_single_card_topic, func=lambda msg: msg.text == "🃏 Одна карта"
+    )
+    async_bot.register_message_handler(
+        _async_show_consultation_offer, func=lambda msg: msg.text == CONSULTATION_MENU_LABEL
+    )
+    async_bot.register_message_handler(
+        _async_ask_three_card_topic, func=lambda msg: msg.text == "🔮 Три карты"
+    )
+    async_bot.register_message_handler(
+        _async_successful_payment_handler, content_types=["successful_payment"]
+    )
+    async_bot.register_message_handler(
+        _async_handle_web_app_data, content_types=["web_app_data"]
+    )
+    async_bot.register_callback_query_handler(
+        _async_handle_yes_no_callback,
+        func=lambda call: getattr(call, "data", None) == YES_NO_CALLBACK_DRAW,
+    )
+    async_bot.register_callback_query_handler(
+        _async_handle_buy_consultation, func=lambda call: call.data == "buy_consultation"
+    )
+    async_bot.register_pre_checkout_query_handler(
+        _async_process_pre_checkout_query, func=lambda query: True
+    )
+
+
+def _run_async_bot() -> None:
+    global _async_bot
+
+    # aiohttp нужен только этому режиму, поэтому импортируем его здесь.
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    _async_bot = AsyncTeleBot(TOKEN)
+    _register_async_handlers(_async_bot)
+    _instrument_handlers(_async_bot)
+    _instrument_async_telegram_api(asyncio_helper)
+    asyncio.run(_async_main())
+
+
+async def _async_main() -> None:
+    global _async_loop
+
+    _async_loop = asyncio.get_running_loop()
+    await _async_bot.infinity_polling(timeout=60, request_timeout=90)
 
 
 # === Запуск бота ===
 if __name__ == "__main__":
-    bot.polling(timeout=60, long_polling_timeout=30)
+    if sys.argv[1:] == ["compile-content"]:
+        sys.exit(_compile_content())
+
+    if sys.argv[1:2] == ["build-images"]:
+        sys.exit(_build_image_variants(*sys.argv[2:3]))
+
+    if sys.argv[1:2] == ["usage-convert"] and len(sys.argv) == 4:
+        sys.exit(_convert_usage_file(sys.argv[2], sys.argv[3]))
+
+    # nohup/systemd гасят бота через SIGTERM — превращаем его в обычный
+    # выход, чтобы atexit успел сбросить накопленную статистику.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    _instrument_telegram_api()
+    _instrument_handlers(bot)
+    _start_metrics_server()
+    _start_two_card_refresher()
+    _start_conversation_sweeper()
+    _start_user_pruner()
+    _start_image_index_poller()
+    _resume_pending_broadcast()
+    _start_card_of_day_pusher()
+    _start_deck_cursor_flusher()
+
+    if BOT_RUN_MODE == "webhook":
+        _run_webhook_server()
+    elif BOT_RUN_MODE == "async":
+        _run_async_bot()
+    else:
+        _run_polling()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# bot.py читает настройки при импорте: состояние уводим во временный каталог,
+# чтобы тесты не трогали файлы рядом с ботом.
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ["STATE_DIR"] = tempfile.mkdtemp(prefix="taro-bot-tests-")
+os.environ["BOT_RUN_MODE"] = "polling"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
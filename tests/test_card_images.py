@@ -0,0 +1,76 @@
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+def test_unknown_card_names_do_not_grow_the_index():
+    size = len(bot._card_image_index)
+
+    for i in range(500):
+        assert bot._get_card_image_path(f"Карта из WebApp №{i}") is None
+
+    assert len(bot._card_image_index) == size
+
+
+def test_known_card_is_served_from_the_index():
+    card = next(name for name, image in bot._card_image_index.items() if image)
+
+    assert bot._get_card_image_path(card) == bot._card_image_index[card].path
+
+
+def _api_error(description: str, code: int = 400) -> ApiTelegramException:
+    return ApiTelegramException(
+        "sendPhoto", None, {"error_code": code, "description": description}
+    )
+
+
+@pytest.fixture
+def cached_photo(monkeypatch):
+    path = next(image.path for image in bot._card_image_index.values() if image)
+    calls = []
+    monkeypatch.setattr(bot, "_get_cached_photo_file_id", lambda p: "CACHED")
+    monkeypatch.setattr(bot, "_forget_photo_file_id", lambda p: calls.append("forget"))
+    monkeypatch.setattr(bot, "_remember_photo_file_id", lambda p, sent: calls.append("remember"))
+    return path, calls
+
+
+def test_stale_file_id_is_uploaded_again(monkeypatch, cached_photo):
+    path, calls = cached_photo
+    sent = []
+
+    def send_photo(chat_id, photo, **kwargs):
+        sent.append(photo)
+        if photo == "CACHED":
+            raise _api_error("Bad Request: wrong file identifier/HTTP URL specified")
+        return "message"
+
+    monkeypatch.setattr(bot.bot, "send_photo", send_photo)
+
+    assert bot._send_card_photo(1, path) == "message"
+    assert sent[0] == "CACHED" and sent[1] != "CACHED"
+    assert calls == ["forget", "remember"]
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        _api_error("Bad Request: can't parse entities: unsupported start tag"),
+        _api_error("Bad Request: chat not found"),
+        _api_error("Forbidden: bot was blocked by the user", code=403),
+    ],
+)
+def test_other_errors_do_not_upload_again(monkeypatch, cached_photo, error):
+    path, calls = cached_photo
+    sent = []
+
+    def send_photo(chat_id, photo, **kwargs):
+        sent.append(photo)
+        raise error
+
+    monkeypatch.setattr(bot.bot, "send_photo", send_photo)
+
+    with pytest.raises(ApiTelegramException):
+        bot._send_card_photo(1, path)
+    assert sent == ["CACHED"]
+    assert calls == []
@@ -0,0 +1,53 @@
+import pytest
+
+import bot
+
+USER_ID = 777
+
+
+@pytest.fixture
+def usage(monkeypatch, tmp_path):
+    store = bot._SqliteUsageStore(str(tmp_path / "usage.sqlite3"))
+    monkeypatch.setattr(bot, "_usage_store", store)
+    monkeypatch.setattr(bot, "STATE_BACKEND", "local")
+    monkeypatch.setattr(bot, "_user_registry", bot._UserRegistry())
+    yield store
+    store.close()
+
+
+def _readings(store) -> list[tuple]:
+    return store._conn.execute("SELECT reading_type, date FROM readings").fetchall()
+
+
+def test_subscription_survives_restart_outside_readings(usage):
+    bot._set_card_of_day_push(USER_ID, "+03:00")
+
+    restarted = bot._SqliteUsageStore(usage.path).load()
+    assert restarted.get(USER_ID, bot.USER_CARD_OF_DAY_PUSH_KEY) == "+03:00"
+    assert restarted.push_subscribers(bot._offset_to_push_slot(180)) == [USER_ID]
+    assert _readings(usage) == []
+
+
+def test_unsubscribe_removes_the_timezone(usage):
+    bot._set_card_of_day_push(USER_ID, "+03:00")
+    bot._set_card_of_day_push(USER_ID, None)
+
+    assert usage.load_user(str(USER_ID)) == {}
+    assert bot._SqliteUsageStore(usage.path).load().push_slots() == frozenset()
+
+
+def test_timezone_kept_in_readings_is_moved_to_its_table(tmp_path):
+    path = str(tmp_path / "usage.sqlite3")
+    store = bot._SqliteUsageStore(path)
+    store._conn.execute(
+        "INSERT INTO readings (user_id, reading_type, date) VALUES (?, ?, ?)",
+        (str(USER_ID), bot.USER_CARD_OF_DAY_PUSH_KEY, "-05:00"),
+    )
+    store._conn.execute("DELETE FROM meta")
+    store.close()
+
+    migrated = bot._SqliteUsageStore(path)
+
+    assert _readings(migrated) == []
+    assert migrated.load_user(str(USER_ID)) == {bot.USER_CARD_OF_DAY_PUSH_KEY: "-05:00"}
+    migrated.close()
@@ -0,0 +1,53 @@
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+import bot
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b"",
+        b"not a pickle at all",
+        # GLOBAL на модуль, которого нет: ModuleNotFoundError.
+        b"cno_such_module\nContent\n.",
+        # Протокол из будущего: ValueError.
+        b"\x80\x09.",
+        pickle.dumps({"version": bot.CONTENT_ARTIFACT_VERSION})[:-3],
+    ],
+    ids=["empty", "garbage", "foreign-module", "unknown-protocol", "truncated"],
+)
+def test_broken_artifact_falls_back_to_json(monkeypatch, tmp_path, payload):
+    artifact = tmp_path / "content.pickle"
+    artifact.write_bytes(payload)
+    monkeypatch.setattr(bot, "CONTENT_ARTIFACT_PATH", str(artifact))
+
+    assert bot._load_compiled_content() is None
+
+
+def test_compile_content_does_not_start_stores(tmp_path):
+    # Копия бота из симлинков: content.pickle ляжет во временный каталог.
+    for name in ("bot.py", bot.CARDS_FOLDER, *bot.CONTENT_SOURCE_FILES):
+        if os.path.exists(os.path.join(REPO_DIR, name)):
+            os.symlink(os.path.join(REPO_DIR, name), tmp_path / name)
+    state_dir = tmp_path / "state"
+    state_dir.mkdir()
+
+    result = subprocess.run(
+        [sys.executable, "bot.py", "compile-content"],
+        cwd=tmp_path,
+        env=dict(os.environ, STATE_DIR=str(state_dir)),
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert (tmp_path / "content.pickle").exists()
+    assert os.listdir(state_dir) == []
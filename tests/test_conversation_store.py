@@ -0,0 +1,91 @@
+import telebot
+
+import bot
+
+CHAT_ID = 4242
+
+
+def _make_bot(store) -> telebot.TeleBot:
+    return telebot.TeleBot(
+        "123456:test-token",
+        threaded=False,
+        next_step_backend=bot._PersistentNextStepBackend(store),
+    )
+
+
+def _text_message(text: str) -> telebot.types.Message:
+    return telebot.types.Message.de_json(
+        {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": CHAT_ID, "type": "private"},
+            "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        }
+    )
+
+
+def test_next_step_survives_restart(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "conversations.sqlite3")
+    sent = []
+
+    def send_message(chat_id, text, **kwargs):
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    monkeypatch.setattr(bot, "_get_card_image_path", lambda card: None)
+    monkeypatch.setattr(
+        bot,
+        "_reserve_reading_today",
+        lambda user_id, reading_type: bot._Reservation(None, reading_type, 0, 0),
+    )
+
+    before_restart = _make_bot(bot._SqliteConversationStore(db_path))
+    before_restart.register_next_step_handler_by_chat_id(
+        CHAT_ID, bot.send_single_card_with_topic, CHAT_ID
+    )
+
+    # «Перезапуск»: новые хранилище, бэкенд и бот поверх того же файла.
+    store = bot._SqliteConversationStore(db_path)
+    assert store.has(CHAT_ID)
+    after_restart = _make_bot(store)
+    topic = bot.SINGLE_CARD_TOPICS[0]
+    after_restart.process_new_messages([_text_message(topic)])
+
+    # Расклад по выбранной сфере и следом предложение консультации.
+    assert [chat_id for chat_id, _ in sent] == [CHAT_ID, CHAT_ID]
+    assert f"Сфера: {topic}" in sent[0][1]
+    assert not store.has(CHAT_ID)
+
+
+def test_backend_restores_step_arguments(tmp_path):
+    db_path = str(tmp_path / "conversations.sqlite3")
+    bot._PersistentNextStepBackend(bot._SqliteConversationStore(db_path)).register_handler(
+        CHAT_ID, telebot.Handler(bot.send_single_card_with_topic, 77)
+    )
+
+    restarted = bot._PersistentNextStepBackend(bot._SqliteConversationStore(db_path))
+    handlers = restarted.get_handlers(CHAT_ID)
+
+    assert len(handlers) == 1
+    assert handlers[0]["callback"].__wrapped__ is bot.send_single_card_with_topic
+    assert handlers[0]["args"] == (77,)
+
+
+def test_expired_step_is_dropped_and_swept(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "conversations.sqlite3")
+    store = bot._SqliteConversationStore(db_path)
+
+    monkeypatch.setattr(bot, "CONVERSATION_STATE_TTL_SECONDS", -1)
+    store.set(CHAT_ID, bot.STEP_SINGLE_CARD_TOPIC, [CHAT_ID])
+    store.set(CHAT_ID + 1, bot.STEP_SINGLE_CARD_TOPIC, [CHAT_ID + 1])
+    monkeypatch.setattr(bot, "CONVERSATION_STATE_TTL_SECONDS", 3600)
+    store.set(CHAT_ID + 2, bot.STEP_THREE_CARD_TOPIC, [])
+
+    restarted = bot._SqliteConversationStore(db_path)
+    assert not restarted.has(CHAT_ID)
+    assert bot._PersistentNextStepBackend(restarted).get_handlers(CHAT_ID) is None
+
+    assert restarted.sweep() == 1
+    assert restarted.has(CHAT_ID + 2)
+    assert restarted.sweep() == 0
@@ -0,0 +1,87 @@
+import pytest
+
+import bot
+
+USER_ID = 555
+
+
+@pytest.fixture
+def usage(monkeypatch, tmp_path):
+    store = bot._SqliteUsageStore(str(tmp_path / "usage.sqlite3"))
+    monkeypatch.setattr(bot, "_usage_store", store)
+    monkeypatch.setattr(bot, "STATE_BACKEND", "local")
+    monkeypatch.setattr(bot, "_user_registry", bot._UserRegistry())
+    monkeypatch.setattr(bot, "_dirty_deck_cursors", set())
+    yield store
+    store.close()
+
+
+def _draw(count: int) -> list[str]:
+    return [bot._draw_random_card(USER_ID) for _ in range(count)]
+
+
+def test_no_repeats_until_the_deck_is_exhausted(usage):
+    deck_size = len(bot._draw_tables.deck_cards)
+
+    drawn = _draw(deck_size)
+
+    assert sorted(drawn) == sorted(bot._draw_tables.deck_cards)
+
+
+def test_new_permutation_starts_after_the_deck_is_exhausted(usage):
+    deck_size = len(bot._draw_tables.deck_cards)
+    _draw(deck_size)
+    first_seed = bot._user_registry.get(USER_ID, bot.DECK_CURSOR_KEY).partition(":")[0]
+
+    drawn = _draw(deck_size)
+
+    assert sorted(drawn) == sorted(bot._draw_tables.deck_cards)
+    assert bot._user_registry.get(USER_ID, bot.DECK_CURSOR_KEY).partition(":")[0] != first_seed
+
+
+def test_cursor_survives_restart_without_touching_readings(monkeypatch, usage):
+    deck_size = len(bot._draw_tables.deck_cards)
+    before_restart = _draw(30)
+
+    # Локально курсор копится в памяти и уходит в базу при сбросе.
+    assert usage.load_user(str(USER_ID)) is None
+    bot._flush_deck_cursors()
+
+    restarted = bot._SqliteUsageStore(usage.path)
+    monkeypatch.setattr(bot, "_usage_store", restarted)
+    monkeypatch.setattr(bot, "_user_registry", restarted.load())
+    after_restart = _draw(deck_size - 30)
+    restarted.close()
+
+    assert sorted(before_restart + after_restart) == sorted(bot._draw_tables.deck_cards)
+    assert usage._conn.execute(
+        "SELECT COUNT(*) FROM readings WHERE reading_type = ?", (bot.DECK_CURSOR_KEY,)
+    ).fetchone() == (0,)
+
+
+def test_shared_state_writes_cursor_immediately(monkeypatch, usage):
+    monkeypatch.setattr(bot, "STATE_BACKEND", "shared")
+
+    _draw(3)
+
+    assert usage._conn.execute(
+        "SELECT position FROM deck_cursors WHERE user_id = ?", (str(USER_ID),)
+    ).fetchone() == (3,)
+    assert not bot._dirty_deck_cursors
+
+
+def test_cursor_kept_in_readings_is_moved_to_its_table(tmp_path):
+    path = str(tmp_path / "usage.sqlite3")
+    store = bot._SqliteUsageStore(path)
+    store._conn.execute(
+        "INSERT INTO readings (user_id, reading_type, date) VALUES (?, ?, ?)",
+        (str(USER_ID), bot.DECK_CURSOR_KEY, "12345:7"),
+    )
+    store._conn.execute("DELETE FROM meta")
+    store.close()
+
+    migrated = bot._SqliteUsageStore(path)
+
+    assert migrated._conn.execute("SELECT COUNT(*) FROM readings").fetchone() == (0,)
+    assert migrated.load_user(str(USER_ID)) == {bot.DECK_CURSOR_KEY: "12345:7"}
+    migrated.close()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import random
+
+import pytest
+import telebot
+
+import bot
+
+USER_ID = 5151
+
+
+class _RecordingBot:
+    """Вместо Telegram: запоминает вызовы Bot API, разметку — в виде JSON."""
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def _record(self, method: str, args: tuple, kwargs: dict) -> None:
+        kwargs = {
+            key: value.to_json() if hasattr(value, "to_json") else value
+            for key, value in kwargs.items()
+        }
+        self.calls.append((method, args, kwargs))
+
+    def __getattr__(self, method: str):
+        def call(*args, **kwargs):
+            self._record(method, args, kwargs)
+
+        return call
+
+
+class _AsyncRecordingBot(_RecordingBot):
+    def __getattr__(self, method: str):
+        async def call(*args, **kwargs):
+            self._record(method, args, kwargs)
+
+        return call
+
+
+def _message(user_id: int, **fields) -> telebot.types.Message:
+    return telebot.types.Message.de_json(
+        {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            **fields,
+        }
+    )
+
+
+def _web_app_message(user_id: int, payload: dict) -> telebot.types.Message:
+    return _message(
+        user_id, web_app_data={"data": json.dumps(payload), "button_text": "🧿 Две карты"}
+    )
+
+
+def _run_mode(monkeypatch, tmp_path, mode: str, updates) -> dict:
+    """Прогоняет апдейты через обработчики одного режима на чистом состоянии."""
+    store = bot._SqliteUsageStore(str(tmp_path / f"{mode}.sqlite3"))
+    conversations = bot._MemoryConversationStore()
+    monkeypatch.setattr(bot, "STATE_BACKEND", "local")
+    monkeypatch.setattr(bot, "_usage_store", store)
+    monkeypatch.setattr(bot, "_user_registry", bot._UserRegistry())
+    monkeypatch.setattr(bot, "_conversation_store", conversations)
+    monkeypatch.setattr(bot, "_get_card_image_path", lambda card: None)
+    fake = _RecordingBot() if mode == "sync" else _AsyncRecordingBot()
+    monkeypatch.setattr(bot, "bot" if mode == "sync" else "_async_bot", fake)
+    random.seed(2026)
+
+    try:
+        for sync_handler, async_handler, args in updates:
+            if mode == "sync":
+                sync_handler(*args)
+            else:
+                asyncio.run(async_handler(*args))
+        return {
+            "calls": fake.calls,
+            "usage": bot._user_registry.to_usage(),
+            "stored": store.load().to_usage(),
+            "step": conversations.pop(USER_ID) or conversations.pop(bot.ADMIN_ID),
+        }
+    finally:
+        store.close()
+
+
+def _assert_same_in_both_modes(monkeypatch, tmp_path, updates) -> dict:
+    sync_result = _run_mode(monkeypatch, tmp_path, "sync", updates)
+    async_result = _run_mode(monkeypatch, tmp_path, "async", updates)
+
+    assert async_result == sync_result
+    return sync_result
+
+
+def test_two_card_reading_and_repeat_are_the_same_in_both_modes(monkeypatch, tmp_path):
+    card1, card2 = bot._draw_tables.deck_cards[:2]
+    pair = bot._normalize_two_card_key(card1, card2)
+    monkeypatch.setattr(bot, "combinations_2cards", {pair: "Две дороги сходятся в одну."})
+    message = _web_app_message(USER_ID, {"card1": card1, "card2": card2})
+    update = (bot.handle_web_app_data, bot._async_handle_web_app_data, (message,))
+
+    result = _assert_same_in_both_modes(monkeypatch, tmp_path, [update, update])
+
+    texts = [args[1] for method, args, _ in result["calls"]]
+    # Расклад и предложение консультации, затем лимит и снова предложение.
+    assert len(texts) == 4
+    assert texts[0].startswith("🧿 *Две карты:*")
+    assert texts[2] == bot._get_daily_limit_text(bot.READING_TYPE_TWO_CARDS)
+    assert result["stored"][str(USER_ID)][bot.READING_TYPE_TWO_CARDS]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [{"limit_exceeded": True}, {"card1": "Нет такой карты", "card2": "И такой", "dailyLimit": 1}],
+    ids=["no-cards", "unknown-pair"],
+)
+def test_web_app_errors_are_the_same_in_both_modes(monkeypatch, tmp_path, payload):
+    message = _web_app_message(USER_ID, payload)
+
+    _assert_same_in_both_modes(
+        monkeypatch,
+        tmp_path,
+        [(bot.handle_web_app_data, bot._async_handle_web_app_data, (message,))],
+    )
+
+
+def test_single_card_reading_is_the_same_in_both_modes(monkeypatch, tmp_path):
+    topic = bot.SINGLE_CARD_TOPICS[0]
+    updates = [
+        (
+            bot.ask_single_card_topic,
+            bot._async_ask_single_card_topic,
+            (_message(USER_ID, text="🃏 Одна карта"),),
+        ),
+        (
+            bot.send_single_card_with_topic,
+            bot._async_send_single_card_with_topic,
+            (_message(USER_ID, text=topic), USER_ID),
+        ),
+    ]
+
+    result = _assert_same_in_both_modes(monkeypatch, tmp_path, updates)
+
+    assert f"Сфера: {topic}" in result["calls"][1][1][1]
+    assert result["usage"][str(USER_ID)][bot.DECK_CURSOR_KEY]
+
+
+def test_broadcast_prompt_is_the_same_in_both_modes(monkeypatch, tmp_path):
+    message = _message(bot.ADMIN_ID, text="/broadcast")
+
+    result = _assert_same_in_both_modes(
+        monkeypatch,
+        tmp_path,
+        [(bot.handle_broadcast_command, bot._async_handle_broadcast_command, (message,))],
+    )
+
+    # Админ учтён среди пользователей, бот ждёт текст рассылки.
+    assert bot.USER_LAST_SEEN_KEY in result["usage"][str(bot.ADMIN_ID)]
+    assert result["step"] == (bot.STEP_BROADCAST_TEXT, [])
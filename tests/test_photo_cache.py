@@ -0,0 +1,72 @@
+import json
+import multiprocessing
+import os
+from types import SimpleNamespace
+
+import bot
+
+IMAGES_PER_WORKER = 15
+
+
+def _remember_in_process(state_dir: str, worker: int, barrier) -> None:
+    """Одна «копия бота» сохраняет file_id своих картинок в общий кэш."""
+    bot.STATE_DIR = state_dir
+    bot.PHOTO_FILE_ID_CACHE_PATH = os.path.join(state_dir, "photo_file_ids.json")
+    bot._load_photo_file_id_cache()
+    barrier.wait()
+    for i in range(IMAGES_PER_WORKER):
+        path = os.path.join(state_dir, f"card-{worker}-{i}.png")
+        sent = SimpleNamespace(photo=[SimpleNamespace(file_id=f"id-{worker}-{i}")])
+        bot._remember_photo_file_id(path, sent)
+
+
+def _make_images(state_dir, workers: int) -> None:
+    for worker in range(workers):
+        for i in range(IMAGES_PER_WORKER):
+            (state_dir / f"card-{worker}-{i}.png").write_bytes(f"{worker}-{i}".encode())
+
+
+def test_workers_do_not_overwrite_each_others_file_ids(tmp_path):
+    workers = 4
+    _make_images(tmp_path, workers)
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    processes = [
+        context.Process(target=_remember_in_process, args=(str(tmp_path), worker, barrier))
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+
+    assert all(process.exitcode == 0 for process in processes)
+    with open(tmp_path / "photo_file_ids.json", encoding="utf-8") as f:
+        cache = json.load(f)
+    assert len(cache) == workers * IMAGES_PER_WORKER
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_forget_keeps_entries_saved_by_other_process(monkeypatch, tmp_path):
+    _make_images(tmp_path, 2)
+    monkeypatch.setattr(bot, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(bot, "PHOTO_FILE_ID_CACHE_PATH", str(tmp_path / "photo_file_ids.json"))
+    monkeypatch.setattr(bot, "_photo_file_id_cache", {})
+
+    mine = str(tmp_path / "card-0-0.png")
+    bot._remember_photo_file_id(mine, SimpleNamespace(photo=[SimpleNamespace(file_id="mine")]))
+
+    # Другой процесс дописал свою запись в файл в обход нашей памяти.
+    with open(bot.PHOTO_FILE_ID_CACHE_PATH, encoding="utf-8") as f:
+        on_disk = json.load(f)
+    theirs = str(tmp_path / "card-1-0.png")
+    on_disk[theirs] = dict(on_disk[mine], file_id="theirs")
+    with open(bot.PHOTO_FILE_ID_CACHE_PATH, "w", encoding="utf-8") as f:
+        json.dump(on_disk, f)
+
+    bot._forget_photo_file_id(mine)
+
+    with open(bot.PHOTO_FILE_ID_CACHE_PATH, encoding="utf-8") as f:
+        assert list(json.load(f)) == [theirs]
+    assert bot._photo_file_id_cache[theirs]["file_id"] == "theirs"
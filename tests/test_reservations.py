@@ -0,0 +1,148 @@
+import multiprocessing
+import sqlite3
+import threading
+
+import pytest
+
+import bot
+
+TODAY = "2026-03-01"
+USER_IDS = [str(user_id) for user_id in range(1, 21)]
+
+
+def _race(target, workers: int) -> list:
+    """Запускает target в workers потоках разом и собирает результаты."""
+    barrier = threading.Barrier(workers)
+    results = []
+    results_lock = threading.Lock()
+
+    def run() -> None:
+        barrier.wait()
+        result = target()
+        with results_lock:
+            results.extend(result)
+
+    threads = [threading.Thread(target=run) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _reserve_all(db_path: str) -> list[str]:
+    """Одна «копия бота»: своё соединение, пытается занять расклад всем пользователям."""
+    store = bot._SqliteUsageStore(db_path)
+    try:
+        return [
+            user_id
+            for user_id in USER_IDS
+            if store.reserve_reading(user_id, bot.READING_TYPE_SINGLE, TODAY)[0]
+        ]
+    finally:
+        store.close()
+
+
+def _reserve_in_process(db_path: str, barrier, queue) -> None:
+    barrier.wait()
+    queue.put(_reserve_all(db_path))
+
+
+def test_reserve_reading_once_per_user_across_threads(tmp_path):
+    db_path = str(tmp_path / "usage.sqlite3")
+    bot._SqliteUsageStore(db_path).close()
+
+    winners = _race(lambda: _reserve_all(db_path), workers=16)
+
+    assert sorted(winners, key=int) == USER_IDS
+
+
+def test_reserve_reading_once_per_user_across_processes(tmp_path):
+    db_path = str(tmp_path / "usage.sqlite3")
+    bot._SqliteUsageStore(db_path).close()
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(4)
+    queue = context.Queue()
+    processes = [
+        context.Process(target=_reserve_in_process, args=(db_path, barrier, queue))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    winners = [user_id for _ in processes for user_id in queue.get(timeout=60)]
+    for process in processes:
+        process.join(timeout=60)
+
+    assert all(process.exitcode == 0 for process in processes)
+    assert sorted(winners, key=int) == USER_IDS
+
+
+def test_release_reading_returns_slot_and_keeps_previous_date(tmp_path):
+    store = bot._SqliteUsageStore(str(tmp_path / "usage.sqlite3"))
+    store.record_reading("1", bot.READING_TYPE_SINGLE, "2026-02-27")
+
+    reserved, previous = store.reserve_reading("1", bot.READING_TYPE_SINGLE, TODAY)
+    assert (reserved, previous) == (True, "2026-02-27")
+    assert store.reserve_reading("1", bot.READING_TYPE_SINGLE, TODAY)[0] is False
+
+    store.release_reading("1", bot.READING_TYPE_SINGLE, TODAY, previous)
+    assert store.load_user("1") == {bot.READING_TYPE_SINGLE: "2026-02-27"}
+    assert store.reserve_reading("1", bot.READING_TYPE_SINGLE, TODAY)[0] is True
+
+
+@pytest.fixture
+def fresh_usage(monkeypatch, tmp_path):
+    store = bot._SqliteUsageStore(str(tmp_path / "usage.sqlite3"))
+    monkeypatch.setattr(bot, "_usage_store", store)
+    monkeypatch.setattr(bot, "_user_registry", bot._UserRegistry())
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize("backend", ["local", "shared"])
+def test_reserve_reading_today_has_one_winner_per_user(monkeypatch, fresh_usage, backend):
+    monkeypatch.setattr(bot, "STATE_BACKEND", backend)
+    user_ids = [int(user_id) for user_id in USER_IDS]
+
+    def reserve_all() -> list:
+        return [
+            reservation.user_id
+            for user_id in user_ids
+            if (reservation := bot._reserve_reading_today(user_id, bot.READING_TYPE_YES_NO))
+        ]
+
+    winners = _race(reserve_all, workers=16)
+
+    assert sorted(winners) == user_ids
+    today = bot._day_to_iso(bot._today_day())
+    assert fresh_usage.load_user("1") == {bot.READING_TYPE_YES_NO: today}
+
+
+def test_failed_send_releases_the_reading(monkeypatch, fresh_usage):
+    monkeypatch.setattr(bot, "STATE_BACKEND", "shared")
+    reservation = bot._reserve_reading_today(7, bot.READING_TYPE_SINGLE)
+
+    def send_message(chat_id, text, **kwargs):
+        raise RuntimeError("Telegram недоступен")
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+
+    with pytest.raises(RuntimeError):
+        bot._run_flow(
+            bot._released_on_failure_flow(reservation, bot._api_flow("send_message", 7, "расклад"))
+        )
+
+    assert fresh_usage.load_user("7") == {}
+    assert bot._reserve_reading_today(7, bot.READING_TYPE_SINGLE) is not None
+
+
+def test_store_error_in_shared_mode_denies_the_reading(monkeypatch, fresh_usage):
+    monkeypatch.setattr(bot, "STATE_BACKEND", "shared")
+
+    def broken_reserve(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(fresh_usage, "reserve_reading", broken_reserve)
+
+    assert bot._reserve_reading_today(7, bot.READING_TYPE_SINGLE) is None
@@ -0,0 +1,95 @@
+import json
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import bot
+
+TODAY = datetime.now(timezone.utc).date()
+
+
+@pytest.fixture
+def stats_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "STATS_DIR", str(tmp_path))
+    monkeypatch.setattr(bot, "_stats_rollups", None)
+    monkeypatch.setattr(bot, "_daily_stats", {})
+    monkeypatch.setattr(bot, "_stats_pending_deltas", {})
+    return tmp_path
+
+
+def _write_days(stats_dir, days_back: range) -> dict[str, dict[str, int]]:
+    written = {}
+    for offset in days_back:
+        date_str = (TODAY - timedelta(days=offset)).isoformat()
+        written[date_str] = {
+            bot.DAILY_EVENT_START: offset % 7 + 1,
+            bot.DAILY_EVENT_SINGLE_CARD_READING: offset % 3,
+        }
+        # Событие, которого не было в первые дни, добавляет столбец в сводки.
+        if offset < 20:
+            written[date_str][bot.DAILY_EVENT_CONSULTATION_PAID] = 1
+        (stats_dir / f"{date_str}.json").write_text(json.dumps(written[date_str]))
+    return written
+
+
+def _expected(written: dict, start, end) -> dict[str, int]:
+    totals = Counter()
+    for date_str, stats in written.items():
+        if start.isoformat() <= date_str <= end.isoformat():
+            totals.update(stats)
+    return {name: count for name, count in totals.items() if count > 0}
+
+
+def test_period_totals_match_day_files(stats_dir):
+    written = _write_days(stats_dir, range(0, 90))
+
+    for days in (1, 2, 7, 30, 90, 365):
+        start = TODAY - timedelta(days=days - 1)
+        assert bot._get_stats_for_period(start, TODAY) == _expected(written, start, TODAY)
+
+    month = (TODAY - timedelta(days=40)).isoformat()[:7]
+    month_days = {d: s for d, s in written.items() if d.startswith(month)}
+    last_closed = bot._get_rollup_cutoff() - timedelta(days=1)
+    assert bot._get_stats_for_bucket("months", month) == _expected(
+        month_days, TODAY - timedelta(days=400), last_closed
+    )
+
+
+def test_queries_do_not_rescan_stats_dir_or_flush(monkeypatch, stats_dir):
+    written = _write_days(stats_dir, range(0, 10))
+    start = TODAY - timedelta(days=6)
+    assert bot._get_stats_for_period(start, TODAY) == _expected(written, start, TODAY)
+
+    def forbidden(*args):
+        raise AssertionError("повторный просмотр папки или сброс статистики")
+
+    monkeypatch.setattr(os, "listdir", forbidden)
+    monkeypatch.setattr(bot, "_load_stats_rollups", forbidden)
+    monkeypatch.setattr(bot, "_flush_daily_stats", forbidden)
+
+    for _ in range(3):
+        assert bot._get_stats_for_period(start, TODAY) == _expected(written, start, TODAY)
+
+
+def test_version_one_rollups_are_upgraded(stats_dir):
+    written = _write_days(stats_dir, range(0, 10))
+    last_closed = bot._get_rollup_cutoff() - timedelta(days=1)
+    closed = sorted(d for d in written if d <= last_closed.isoformat())
+    running, cumulative = Counter(), {}
+    for date_str in closed:
+        running.update(written[date_str])
+        cumulative[date_str] = dict(running)
+    (stats_dir / "rollups").mkdir()
+    (stats_dir / "rollups" / "rollups.json").write_text(
+        json.dumps(
+            {"closed_through": closed[-1], "weeks": {}, "months": {}, "cumulative": cumulative}
+        )
+    )
+
+    start = TODAY - timedelta(days=6)
+    assert bot._get_stats_for_period(start, TODAY) == _expected(written, start, TODAY)
+    saved = json.loads((stats_dir / "rollups" / "rollups.json").read_text())
+    assert saved["version"] == bot.STATS_ROLLUP_VERSION
+    assert saved["days"] == closed
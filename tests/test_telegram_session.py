@@ -0,0 +1,200 @@
+import http.server
+import json
+import socket
+import struct
+import threading
+import time
+
+import pytest
+import requests
+
+import bot
+
+
+class _FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    """Отвечает по сценарию сервера: ok, код 5xx, reset — обрыв, slow — долгий ответ."""
+
+    def do_POST(self) -> None:  # noqa: N802 - имя задаёт http.server
+        server = self.server
+        with server.lock:
+            server.hits.append(self.path.rsplit("/", 1)[-1])
+            action = server.script.pop(0) if server.script else "ok"
+
+        if action == "reset":
+            # SO_LINGER с нулевым таймаутом: close() шлёт RST вместо FIN.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+            return
+        if action == "slow":
+            time.sleep(1.0)
+            action = "ok"
+
+        status = 200 if action == "ok" else int(action)
+        body = json.dumps({"ok": status == 200, "result": True}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # noqa: A002 - сигнатура http.server
+        pass
+
+
+def _start_fake_server(port: int = 0) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _FakeTelegramHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.hits = []
+    server.script = []
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/bot123456:test-token"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _stop_fake_server(server) -> None:
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 3)
+
+    server = _start_fake_server()
+    yield server
+    _stop_fake_server(server)
+
+
+def _call(session, server, method: str, timeout=(1, 5)):
+    return session.request("post", f"{server.base_url}/{method}", timeout=timeout)
+
+
+def test_read_is_retried_after_connection_reset(fake_telegram):
+    fake_telegram.script = ["reset", "ok"]
+
+    response = _call(bot._TelegramSession(), fake_telegram, "getUpdates")
+
+    assert response.status_code == 200
+    assert fake_telegram.hits == ["getUpdates", "getUpdates"]
+
+
+def test_send_is_not_retried_after_connection_reset(fake_telegram):
+    fake_telegram.script = ["reset", "ok"]
+
+    # Соединение оборвалось, когда запрос уже ушёл: повтор мог бы задвоить сообщение.
+    with pytest.raises(requests.ConnectionError):
+        _call(bot._TelegramSession(), fake_telegram, "sendMessage")
+
+    assert fake_telegram.hits == ["sendMessage"]
+
+
+def test_send_is_retried_when_connection_is_refused(monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_RETRY_BASE_DELAY", 0.2)
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 3)
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    # Первая попытка упирается в закрытый порт, сервер поднимается к повтору.
+    servers = []
+    starter = threading.Timer(0.05, lambda: servers.append(_start_fake_server(port)))
+    starter.start()
+    try:
+        response = bot._TelegramSession().request(
+            "post", f"http://127.0.0.1:{port}/bot123456:test-token/sendMessage", timeout=(1, 5)
+        )
+    finally:
+        starter.join()
+        for server in servers:
+            _stop_fake_server(server)
+
+    assert response.status_code == 200
+    assert servers[0].hits == ["sendMessage"]
+
+
+def test_retries_server_errors(fake_telegram):
+    fake_telegram.script = ["502", "503", "ok"]
+
+    response = _call(bot._TelegramSession(), fake_telegram, "sendMessage")
+
+    assert response.status_code == 200
+    assert len(fake_telegram.hits) == 3
+
+
+def test_gives_up_after_max_retries(fake_telegram):
+    fake_telegram.script = ["500"] * 10
+
+    response = _call(bot._TelegramSession(), fake_telegram, "getMe")
+
+    assert response.status_code == 500
+    assert len(fake_telegram.hits) == bot.TELEGRAM_MAX_RETRIES + 1
+
+
+def test_send_is_not_retried_after_read_timeout(fake_telegram):
+    fake_telegram.script = ["slow", "ok"]
+
+    with pytest.raises(requests.ReadTimeout):
+        _call(bot._TelegramSession(), fake_telegram, "sendMessage", timeout=(1, 0.2))
+
+    # Сообщение могло уйти: второй попытки быть не должно.
+    assert fake_telegram.hits == ["sendMessage"]
+
+
+def test_read_is_retried_after_read_timeout(fake_telegram):
+    fake_telegram.script = ["slow", "ok"]
+
+    response = _call(bot._TelegramSession(), fake_telegram, "getUpdates", timeout=(1, 0.2))
+
+    assert response.status_code == 200
+    assert fake_telegram.hits == ["getUpdates", "getUpdates"]
+
+
+def test_breaker_opens_and_half_opens_after_cooldown(monkeypatch, fake_telegram):
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 0)
+    monkeypatch.setattr(bot, "TELEGRAM_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(bot, "TELEGRAM_BREAKER_COOLDOWN_SECONDS", 0.3)
+    session = bot._TelegramSession()
+    fake_telegram.script = ["500", "500", "500"]
+
+    assert _call(session, fake_telegram, "sendMessage").status_code == 500
+    assert _call(session, fake_telegram, "sendMessage").status_code == 500
+
+    # Цепь разомкнута: вызов падает сразу, до сервера он не доходит.
+    with pytest.raises(requests.ConnectionError):
+        _call(session, fake_telegram, "sendMessage")
+    assert len(fake_telegram.hits) == 2
+
+    # После паузы проходит один пробный запрос; он неудачен — цепь снова разомкнута.
+    time.sleep(0.35)
+    assert _call(session, fake_telegram, "sendMessage").status_code == 500
+    with pytest.raises(requests.ConnectionError):
+        _call(session, fake_telegram, "sendMessage")
+    assert len(fake_telegram.hits) == 3
+
+    # Удачная проба замыкает цепь, и вызовы снова идут как обычно.
+    time.sleep(0.35)
+    assert _call(session, fake_telegram, "sendMessage").status_code == 200
+    assert _call(session, fake_telegram, "sendMessage").status_code == 200
+    assert len(fake_telegram.hits) == 5
+
+
+def test_breaker_lets_only_one_probe_through(monkeypatch, fake_telegram):
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 0)
+    monkeypatch.setattr(bot, "TELEGRAM_BREAKER_THRESHOLD", 1)
+    monkeypatch.setattr(bot, "TELEGRAM_BREAKER_COOLDOWN_SECONDS", 0.3)
+    session = bot._TelegramSession()
+    fake_telegram.script = ["500", "slow"]
+
+    _call(session, fake_telegram, "getMe")
+    time.sleep(0.35)
+
+    probe = threading.Thread(target=_call, args=(session, fake_telegram, "getMe"))
+    probe.start()
+    time.sleep(0.1)
+    with pytest.raises(requests.ConnectionError):
+        _call(session, fake_telegram, "getMe")
+    probe.join()
+
+    assert len(fake_telegram.hits) == 2
@@ -0,0 +1,199 @@
+import json
+import random
+
+import pytest
+
+import bot
+
+STALE_USER = 101
+OTHER_STALE_USER = 102
+
+
+@pytest.fixture
+def usage(monkeypatch, tmp_path):
+    store = bot._SqliteUsageStore(str(tmp_path / "usage.sqlite3"))
+    monkeypatch.setattr(bot, "_usage_store", store)
+    monkeypatch.setattr(bot, "STATE_BACKEND", "local")
+    monkeypatch.setattr(bot, "USERS_ARCHIVE_PATH", str(tmp_path / "users_archive.jsonl"))
+    monkeypatch.setattr(bot, "USERS_ARCHIVE_AFTER_DAYS", 30)
+
+    long_ago = bot._day_to_iso(bot._today_day() - 400)
+    store.record_many(
+        [
+            (str(user_id), field, long_ago)
+            for user_id in (STALE_USER, OTHER_STALE_USER)
+            for field in (bot.READING_TYPE_SINGLE, bot.USER_LAST_SEEN_KEY)
+        ]
+    )
+    monkeypatch.setattr(bot, "_user_registry", store.load())
+    yield store
+    store.close()
+
+
+def _archived_ids() -> list[int]:
+    with open(bot.USERS_ARCHIVE_PATH, encoding="utf-8") as f:
+        return [json.loads(line)["user_id"] for line in f]
+
+
+def test_stale_users_are_archived_and_removed(usage):
+    assert bot._prune_inactive_users() == 2
+
+    assert sorted(_archived_ids()) == [STALE_USER, OTHER_STALE_USER]
+    assert len(bot._user_registry) == 0
+    assert usage.load_user(str(STALE_USER)) is None
+
+
+def test_user_who_returns_while_archiving_is_kept(monkeypatch, usage):
+    append = bot._append_to_users_archive
+
+    def append_while_user_writes(records):
+        written = append(records)
+        bot._register_user_id(STALE_USER)
+        return written
+
+    monkeypatch.setattr(bot, "_append_to_users_archive", append_while_user_writes)
+
+    assert bot._prune_inactive_users() == 1
+
+    today = bot._day_to_iso(bot._today_day())
+    assert bot._user_registry.get(STALE_USER, bot.USER_LAST_SEEN_KEY) == today
+    assert usage.load_user(str(STALE_USER))[bot.USER_LAST_SEEN_KEY] == today
+    assert usage.load_user(str(OTHER_STALE_USER)) is None
+
+
+def test_user_seen_by_another_process_is_kept(monkeypatch, usage):
+    today = bot._day_to_iso(bot._today_day())
+    append = bot._append_to_users_archive
+
+    def append_while_other_process_writes(records):
+        written = append(records)
+        other = bot._SqliteUsageStore(usage.path)
+        other.record_reading(str(STALE_USER), bot.USER_LAST_SEEN_KEY, today)
+        other.close()
+        return written
+
+    monkeypatch.setattr(bot, "_append_to_users_archive", append_while_other_process_writes)
+
+    assert bot._prune_inactive_users() == 1
+
+    assert usage.load_user(str(STALE_USER))[bot.USER_LAST_SEEN_KEY] == today
+    # Из памяти пользователь не пропал: его перечитали из базы.
+    assert bot._user_registry.get(STALE_USER, bot.USER_LAST_SEEN_KEY) == today
+    assert bot._user_registry.get(STALE_USER, bot.READING_TYPE_SINGLE) is not None
+
+
+def test_user_who_returns_before_store_delete_is_kept(monkeypatch, usage):
+    forget = usage.forget_users
+
+    def user_writes_then_forget(expected):
+        bot._register_user_id(STALE_USER)
+        return forget(expected)
+
+    monkeypatch.setattr(usage, "forget_users", user_writes_then_forget)
+
+    assert bot._prune_inactive_users() == 1
+
+    # Даты в базе уже не совпали со снимком: пользователь остался со всей историей.
+    today = bot._day_to_iso(bot._today_day())
+    assert usage.load_user(str(STALE_USER))[bot.USER_LAST_SEEN_KEY] == today
+    assert bot._user_registry.get_user(STALE_USER) == usage.load_user(str(STALE_USER))
+
+
+def test_user_who_returns_after_store_delete_is_saved_again(monkeypatch, usage):
+    forget = usage.forget_users
+
+    def forget_then_user_writes(expected):
+        forgotten = forget(expected)
+        bot._register_user_id(STALE_USER)
+        return forgotten
+
+    monkeypatch.setattr(usage, "forget_users", forget_then_user_writes)
+
+    assert bot._prune_inactive_users() == 1
+
+    today = bot._day_to_iso(bot._today_day())
+    assert bot._user_registry.get_user(STALE_USER) == {bot.USER_LAST_SEEN_KEY: today}
+    assert usage.load_user(str(STALE_USER)) == {bot.USER_LAST_SEEN_KEY: today}
+
+
+# === Реестр: двоичный формат и согласованность массивов ===
+
+LEGACY_USAGE = {
+    "1": {bot.READING_TYPE_SINGLE: "2026-03-01", bot.USER_LAST_SEEN_KEY: "2026-03-02"},
+    # Даты, которые не ложатся в столбец дней, живут в _extras как есть.
+    "2": {
+        bot.READING_TYPE_SINGLE: "01.03.2026",
+        bot.READING_TYPE_YES_NO: "2026-02-30",
+        bot.READING_TYPE_THREE_CARDS: "1970-01-01",
+        bot.READING_TYPE_TWO_CARDS: "2200-01-01",
+        "note": "из старой версии",
+    },
+    # Ни одного поля: в массивах одни нули, обратно — пустой словарь.
+    "3": {},
+    "4": {bot.DECK_CURSOR_KEY: "123:5", bot.USER_CARD_OF_DAY_PUSH_KEY: "+03:00"},
+    "5": {bot.DECK_CURSOR_KEY: "123:0", bot.USER_CARD_OF_DAY_PUSH_KEY: "+3"},
+    "6": {bot.USER_INACTIVE_KEY: "2026-01-15", bot.USER_CARD_OF_DAY_PUSH_KEY: "-09:30"},
+}
+
+
+def test_usage_round_trips_through_binary_registry(tmp_path):
+    source = tmp_path / "usage.json"
+    source.write_text(json.dumps(LEGACY_USAGE), encoding="utf-8")
+    binary = tmp_path / "users.bin"
+    result = tmp_path / "usage_back.json"
+
+    assert bot._convert_usage_file(str(source), str(binary)) == 0
+    assert bot._convert_usage_file(str(binary), str(result)) == 0
+
+    assert json.loads(result.read_text(encoding="utf-8")) == LEGACY_USAGE
+    with open(binary, "rb") as f:
+        registry = bot._UserRegistry.load(f)
+    assert registry.get_day(1, bot.READING_TYPE_SINGLE) == bot._iso_to_day("2026-03-01")
+    assert registry.get_day(2, bot.READING_TYPE_SINGLE) == 0
+    assert registry.get_day(3, bot.USER_LAST_SEEN_KEY) == 0
+    assert registry.push_slots() == frozenset(
+        {bot._offset_to_push_slot(180), bot._offset_to_push_slot(-570)}
+    )
+
+
+def _assert_consistent(registry, model: dict) -> None:
+    columns = registry._columns()
+    assert {len(column) for column in columns} == {len(model)}
+    assert list(registry._ids) == sorted(model)
+    assert set(registry._extras) <= set(model)
+    assert all(registry._extras.values())
+    assert registry.to_usage() == {str(user_id): usage for user_id, usage in model.items()}
+
+
+def test_registry_arrays_stay_consistent_under_sets_and_removals():
+    rng = random.Random(2026)
+    values = {
+        bot.READING_TYPE_SINGLE: ["2026-03-01", "2026-03-02", "01.03.2026", None],
+        bot.USER_LAST_SEEN_KEY: ["2026-03-05", "1970-01-01", None],
+        bot.DECK_CURSOR_KEY: ["7:1", "7:78", "bad", None],
+        bot.USER_CARD_OF_DAY_PUSH_KEY: ["+03:00", "+3", None],
+        "note": ["x", None],
+    }
+    registry = bot._UserRegistry()
+    model: dict[int, dict[str, str]] = {}
+
+    for _ in range(2000):
+        action = rng.random()
+        if action < 0.7:
+            user_id = rng.randrange(60)
+            key = rng.choice(list(values))
+            value = rng.choice(values[key])
+            registry.set(user_id, key, value)
+            usage = model.setdefault(user_id, {})
+            if value is None:
+                usage.pop(key, None)
+            else:
+                usage[key] = value
+        elif action < 0.9:
+            user_id = rng.randrange(60)
+            assert registry.remove(user_id) == (model.pop(user_id, None) is not None)
+        else:
+            doomed = rng.sample(range(60), 8)
+            removed = sum(model.pop(user_id, None) is not None for user_id in doomed)
+            assert registry.remove_many(doomed) == removed
+        _assert_consistent(registry, model)